@@ -0,0 +1,240 @@
+# Playhouse: Making buildings into interactive displays using remotely controllable lights.
+# Copyright (C) 2014  John Eriksson, Arvid Fahlström Myrman, Jonas Höglund,
+#                     Hannes Leskelä, Christian Lidström, Mattias Palo,
+#                     Markus Videll, Tomas Wickman, Emil Öhman.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Micro-benchmarks for the hot paths of the `playhouse` library.
+
+Run by executing ``python3 benchmark.py``. Each benchmark prints the time
+per operation both for the optimized code path and for the naive approach
+it replaces.
+"""
+
+import gc
+import json
+import timeit
+
+import tornado.concurrent
+import tornado.gen
+
+import playhouse
+
+STATES = [
+    {"hue": hue, "sat": 255, "bri": 200, "on": True, "transitiontime": 0}
+    for hue in range(0, 65536, 4096)
+]
+
+
+def report(name, optimized, naive, number):
+    optimized = optimized / number * 1e6
+    naive = naive / number * 1e6
+    print("{:<44}{:>12.3f} us{:>12.3f} us{:>12.3f} us saved".format(
+        name, optimized, naive, naive - optimized))
+
+
+def bench_encode_body(number=100000):
+    states = STATES * (number // len(STATES))
+    optimized = timeit.timeit(lambda: [playhouse.encode_body(s) for s in states], number=1)
+    naive = timeit.timeit(lambda: [json.dumps(s).encode() for s in states], number=1)
+    report("encode body", optimized, naive, len(states))
+
+
+def bench_state_url(number=100000):
+    username = "f321c5d40b3a79eed6adc08eb3997a5e"
+    light_urls = {i: '/lights/{}/state'.format(i) for i in range(50)}
+    cache = playhouse.LRUCache(512)
+
+    def optimized():
+        for i in range(number):
+            url = light_urls[i % 50]
+            full_url = cache.get(url)
+            if full_url is None:
+                full_url = "/api/{}{}".format(username, url)
+                cache.put(url, full_url)
+
+    def naive():
+        for i in range(number):
+            "/api/{}{}".format(username, '/lights/{}/state'.format(i % 50))
+
+    report("state url", timeit.timeit(optimized, number=1),
+           timeit.timeit(naive, number=1), number)
+
+
+class NaiveLightGrid(playhouse.LightGrid):
+    """`playhouse.LightGrid` committing the way it did before coordinates were indexed and
+    changes were batched: every buffered coordinate is looked up in the nested grid and
+    sent to its light using a separate `playhouse.Bridge.set_state`."""
+    @tornado.gen.coroutine
+    def commit(self):
+        futures = {}
+        exceptions = {}
+        for (x, y), changes in self._pending.items():
+            try:
+                if x >= self.width or y >= self.height or self.grid[y][x] is None:
+                    raise playhouse.OutsideGridException
+
+                mac, light = self.grid[y][x]
+                if mac not in self.bridges:
+                    raise playhouse.NoBridgeAtCoordinateException
+
+                bridge = self.bridges[mac]
+                futures[(x, y)] = bridge.set_state(light, **changes)
+            except (playhouse.OutsideGridException,
+                    playhouse.NoBridgeAtCoordinateException) as e:
+                exceptions[(x, y)] = e
+
+        self._pending = {}
+
+        _, exc = yield playhouse.ExceptionCatcher(futures)
+        exceptions.update(exc)
+        return exceptions
+
+
+class AcceptingBridge(playhouse.Bridge):
+    """`playhouse.Bridge` accepting every change at once without sending anything,
+    so that only the cost of the grid itself is measured. Changes passed to
+    `set_lights` are treated as a single group command, as identical changes would be."""
+    @staticmethod
+    def _accepted():
+        future = tornado.concurrent.Future()
+        future.set_result(None)
+        return future
+
+    def set_state(self, i, **args):
+        self._reduce_state(i, args)
+        return self._accepted()
+
+    def set_lights(self, changes):
+        for light, args in changes.items():
+            self._reduce_state(light, args)
+        return dict.fromkeys(changes, self._accepted())
+
+
+def make_grid(cls, width, height, lights_per_bridge=50):
+    grid = cls(buffered=True, assert_reachable=False)
+    rows = [[None] * width for _ in range(height)]
+    for i in range(width * height):
+        mac = "{:012x}".format(i // lights_per_bridge)
+        rows[i // width][i % width] = (mac, i % lights_per_bridge + 1)
+        if mac not in grid.bridges:
+            bridge = AcceptingBridge._create("10.{}.{}.1".format(*divmod(len(grid.bridges), 256)),
+                                             transport=playhouse.SimulatedTransport)
+            bridge.serial_number = mac
+            grid.bridges[mac] = bridge
+    grid.set_grid(rows)
+    return grid
+
+
+def bench_grid_commit(number=20, width=100, height=100):
+    def run(cls):
+        grid = make_grid(cls, width, height)
+        elapsed = 0
+        for i in range(number):
+            for y in range(height):
+                for x in range(width):
+                    grid.set_state(x, y, bri=i)
+            gc.disable()
+            start = timeit.default_timer()
+            grid.commit()
+            elapsed += timeit.default_timer() - start
+            gc.enable()
+        return elapsed
+
+    report("grid commit ({}x{}), per light".format(width, height),
+           run(playhouse.LightGrid), run(NaiveLightGrid), number * width * height)
+
+
+def bench_grid_resend(number=20, width=100, height=100):
+    """Buffer and commit whole frames of which only every hundredth cell changes."""
+    def run(cls):
+        grid = make_grid(cls, width, height)
+        for y in range(height):
+            for x in range(width):
+                grid.set_state(x, y, bri=0)
+        grid.commit()
+        elapsed = 0
+        for i in range(number):
+            gc.disable()
+            start = timeit.default_timer()
+            for y in range(height):
+                for x in range(width):
+                    grid.set_state(x, y, bri=i if (x + y * width) % 100 == 0 else 0)
+            grid.commit()
+            elapsed += timeit.default_timer() - start
+            gc.enable()
+        return elapsed
+
+    report("grid resend ({}x{}), per light".format(width, height),
+           run(playhouse.LightGrid), run(NaiveLightGrid), number * width * height)
+
+
+def bench_set_frame(number=20, width=64, height=64):
+    """Buffer whole frames using `set_frame`, both with and without NumPy, rather than
+    buffering the colour of each cell using `set_state`. Either every cell of each frame
+    changes colour, or only every hundredth cell does. The NumPy path is passed NumPy
+    arrays, and the others nested lists."""
+    def make_frame(i, step):
+        return [[((x * 4 + (i if (x + y * width) % step == 0 else 0) * 64) % 256, y * 4 % 256,
+                  x % 256) for x in range(width)] for y in range(height)]
+
+    def run(buffer, frames):
+        grid = make_grid(playhouse.LightGrid, width, height)
+        buffer(grid, frames[-1])
+        grid.commit()
+        elapsed = 0
+        for i in range(number):
+            gc.disable()
+            start = timeit.default_timer()
+            buffer(grid, frames[i % 2])
+            elapsed += timeit.default_timer() - start
+            gc.enable()
+            grid.commit()
+        return elapsed
+
+    def naive(grid, frame):
+        for y, row in enumerate(frame):
+            for x, pixel in enumerate(row):
+                grid.set_state(x, y, rgb=pixel)
+
+    for name, step in (("set frame", 1), ("set frame resend", 100)):
+        frames = [make_frame(i, step) for i in range(2)]
+        baseline = run(naive, frames)
+        if playhouse.numpy is not None:
+            arrays = [playhouse.numpy.array(frame) for frame in frames]
+            report("{} ({}x{}), NumPy, per frame".format(name, width, height),
+                   run(playhouse.LightGrid.set_frame, arrays), baseline, number)
+
+        numpy, playhouse.numpy = playhouse.numpy, None
+        try:
+            report("{} ({}x{}), Python, per frame".format(name, width, height),
+                   run(playhouse.LightGrid.set_frame, frames), baseline, number)
+        finally:
+            playhouse.numpy = numpy
+
+
+BENCHMARKS = [
+    bench_encode_body,
+    bench_state_url,
+    bench_grid_commit,
+    bench_grid_resend,
+    bench_set_frame,
+]
+
+if __name__ == '__main__':
+    print("{:<44}{:>15}{:>15}".format("benchmark", "optimized", "naive"))
+    for benchmark in BENCHMARKS:
+        benchmark()
@@ -33,8 +33,7 @@ Dependencies
 
 * Python 3.3+
 * Tornado 3.2+
-* PycURL 7.19.3+
-* libcurl 7.21.1+
+* PycURL 7.19.3+ and libcurl 7.21.1+ (optional, used for bridge discovery)
 * jsonschema 2.3.0+
 
 Setup
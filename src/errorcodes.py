@@ -41,6 +41,9 @@ E_INVALID_PASSWORD = "the supplied password was invalid"
 E_AUTH_NOT_ENABLED = "authentication is not enabled for this server instance"
 E_INVALID_NAME = "user name is too short or otherwise invalid"
 E_BULB_NOT_RESET = "failed to reset a bulb"
+E_NO_SUCH_SCENE = "no scene with the given name has been stored"
+E_BRIDGE_UNAVAILABLE = "the bridge with the MAC address '{mac}' is currently unreachable"
+E_SCHEDULE_FULL = "no more than {max_changes} delayed changes may be waiting at the same time"
 
 
 class ErrorCodeDict(dict):
@@ -33,8 +33,7 @@ Dependencies
 
 * Python 3.3+
 * Tornado 3.2+
-* PycURL 7.19.3+
-* libcurl 7.21.1+
+* PycURL 7.19.3+ and libcurl 7.21.1+ (optional, used for bridge discovery)
 * jsonschema 2.3.0+
 
 Setup
@@ -92,6 +91,53 @@ certfile                      String, path to file  If SSL is enabled, this file
                                                     be used as the SSL certificate.
 keyfile                       String, path to file  If SSL is enabled, this file will
                                                     be used as the SSL private key.
+bridge_rate                   Number                Maximum number of commands per second
+                                                    sent to each bridge (default: 10). Further
+                                                    state changes are queued and merged.
+bridge_connections            Integer               Number of persistent connections kept open
+                                                    to each bridge (default: 2).
+bridge_window                 Integer               Maximum number of commands in flight to
+                                                    each bridge at the same time (default: 4).
+max_queue_depth               Integer or null       Number of commands that may be queued for
+                                                    a bridge before requests to
+                                                    :http:post:`/lights` are held back until
+                                                    the queue shrinks (default: 32).
+fire_and_forget               Boolean               If true, state changes are considered
+                                                    sent as soon as they are written to the
+                                                    bridge, without waiting for the response
+                                                    (default: false).
+validation_sample             Integer               With fire_and_forget enabled, every n-th
+                                                    response is checked for errors
+                                                    (default: 16).
+sync_interval                 Number or null        Time in seconds between refreshing the
+                                                    state of two lights in the background,
+                                                    using spare room in the command budget.
+                                                    null disables refreshing (default: 5).
+simulate_bridges              Boolean               If true, bridges are simulated in-process
+                                                    rather than contacted over the network,
+                                                    for load testing without any hardware.
+                                                    Any IP address can be added as a bridge
+                                                    (default: false).
+snapshot_interval             Number or null        Time in seconds between saving the known
+                                                    light states to disk, in addition to when
+                                                    the server shuts down. null only saves
+                                                    them on shutdown (default: 60).
+snapshot_max_age              Number or null        Age in seconds after which saved light
+                                                    states are no longer trusted at startup;
+                                                    the lights are instead queried one by one
+                                                    (default: 600).
+commit_rate                   Number or null        Number of times per second to send the
+                                                    state changes of all requests received
+                                                    since the previous time at once, for
+                                                    example 20. Requests wait until their
+                                                    changes have been sent. null sends the
+                                                    changes of each request as soon as it is
+                                                    received (default: null).
+max_scheduled_changes         Integer or null       Number of changes with a ``delay`` that
+                                                    may be waiting to be applied at the same
+                                                    time; further requests to
+                                                    :http:post:`/lights` with delayed changes
+                                                    are rejected (default: 100000).
 ============================  ====================  ===========
 
 .. _api:
@@ -143,7 +189,6 @@ if __name__ == "__main__":
     import logging.config
     logging.config.fileConfig('logging.conf')
 
-import datetime
 import functools
 import inspect
 import json
@@ -173,13 +218,27 @@ import playhouse
 
 CONFIG_FILE = "config.json"
 BRIDGE_CONFIG_FILE = "bridge_setup.json"
+BRIDGE_CACHE_FILE = "bridge_cache.json"
+LIGHT_SNAPSHOT_FILE = "lights.snapshot"
 
 CONFIG = {
     "port": 4711,
     "require_password": False,
     "password": None,
     "validate_state_changes": True,
-    "ssl": False
+    "ssl": False,
+    "bridge_rate": 10,
+    "bridge_connections": 2,
+    "bridge_window": 4,
+    "max_queue_depth": 32,
+    "fire_and_forget": False,
+    "validation_sample": 16,
+    "sync_interval": 5,
+    "simulate_bridges": False,
+    "snapshot_interval": 60,
+    "snapshot_max_age": 600,
+    "commit_rate": None,
+    "max_scheduled_changes": 100000
 }
 
 GRID = playhouse.LightGrid(buffered=True)
@@ -208,6 +267,8 @@ def save_grid_changes():
         f.write(json_data)
         logging.debug("Wrote %s to %s", conf, BRIDGE_CONFIG_FILE)
 
+    save_bridge_cache()
+
 
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
@@ -267,11 +328,30 @@ def error_handler(func):
             self.write(errorcodes.E_NO_LINKBUTTON)
         except playhouse.BulbNotResetException:
             self.write(errorcodes.E_BULB_NOT_RESET)
+        except playhouse.UnknownSceneException:
+            self.write(errorcodes.E_NO_SUCH_SCENE)
+        except playhouse.ScheduleFullException as e:
+            self.write(errorcodes.E_SCHEDULE_FULL.format(max_changes=e.max_changes))
+        except playhouse.BridgeUnavailableException as e:
+            self.write(errorcodes.E_BRIDGE_UNAVAILABLE.format(
+                mac=e.bridge.serial_number).merge(mac=e.bridge.serial_number))
         except Exception as e: # should not happen
             self.write(errorcodes.E_INTERNAL_ERROR)
             logging.exception("Received an unexpected exception!")
     return new_func
 
+def handle_exceptions(exceptions):
+    # TODO: partial error reporting?
+    for (x, y), e in exceptions.items():
+        if isinstance(e, playhouse.NoBridgeAtCoordinateException):
+            logging.warning("No bridge added for (%s,%s)", x, y)
+            logging.debug("", exc_info=(type(e), e, e.__traceback__))
+        elif isinstance(e, playhouse.OutsideGridException):
+            logging.warning("(%s,%s) is outside grid bounds", x, y)
+            logging.debug("", exc_info=(type(e), e, e.__traceback__))
+        else:
+            raise e
+
 def read_json(schema=None):
     def decorator(func):
         if schema is not None:
@@ -364,6 +444,11 @@ class LightsHandler(BaseHandler):
     def post(self, data):
         """Change the state of the lights at the given coordinates.
 
+        Changes with a ``delay`` are applied that many seconds later, together with
+        any other changes due at the same time. If too many delayed changes are waiting
+        already (see ``max_scheduled_changes`` in :ref:`config`), the request is rejected
+        with the ``SCHEDULE_FULL`` error code, and none of its changes are made.
+
         **Example request**::
 
             [
@@ -389,37 +474,272 @@ class LightsHandler(BaseHandler):
 
         :request-format:
         """
-        def handle_exceptions(exceptions):
-            # TODO: partial error reporting?
-            for (x, y), e in exceptions.items():
-                if isinstance(e, playhouse.NoBridgeAtCoordinateException):
-                    logging.warning("No bridge added for (%s,%s)", x, y)
-                    logging.debug("", exc_info=(type(e), e, e.__traceback__))
-                elif isinstance(e, playhouse.OutsideGridException):
-                    logging.warning("(%s,%s) is outside grid bounds", x, y)
-                    logging.debug("", exc_info=(type(e), e, e.__traceback__))
-                else:
-                    raise e
+        # hold back new changes while the bridges are still busy with earlier ones
+        yield GRID.wait_for_capacity()
+
+        # delayed changes are applied in batches by the grid's scheduler
+        delayed = [(light['delay'], light['x'], light['y'], light['change'])
+                   for light in data if "delay" in light]
+        if delayed:
+            GRID.scheduler.schedule(delayed)
+        for light in data:
+            if "delay" not in light:
+                GRID.set_state(light['x'], light['y'], **light['change'])
 
-        @tornado.gen.coroutine
-        def set_state(light, do_commit=False):
-            GRID.set_state(light['x'], light['y'], **light['change'])
-            if do_commit:
-                handle_exceptions((yield GRID.commit()))
+        handle_exceptions((yield GRID.commit()))
 
-        for light in data:
-            if "delay" in light:
-                tornado.ioloop.IOLoop.instance().add_timeout(
-                    datetime.timedelta(seconds=light['delay']),
-                    functools.partial(set_state, light, do_commit=True))
-            else:
-                set_state(light)
+        self.write({"state": "success"})
+
+
+class LightsFrameHandler(BaseHandler):
+    @error_handler
+    @tornado.gen.coroutine
+    @authenticated
+    @read_json({
+        "type": "object",
+        "properties": {
+            "mode": { "enum": ["rgb", "hsb"] },
+            "frame": {
+                "type": "array",
+                "items": { "type": "array" }
+            },
+            "transitiontime": {
+                "type": "integer",
+                "minimum": 0
+            }
+        },
+        "required": ["frame"]
+    })
+    def post(self, data):
+        """Change the colour of every light in the grid at once. Only the lights whose
+        colour differs from the previous frame are sent a state change.
+
+        The frame is a list of rows, one for each y coordinate, each of which is a list
+        of colours, one for each x coordinate. The frame must cover the entire grid,
+        including any coordinates without a light. With ``mode`` set to ``rgb``
+        (the default), colours are ``[red, green, blue]`` triplets in the range 0-255,
+        as in the ``rgb`` state change; with ``mode`` set to ``hsb``, colours are
+        ``[hue, sat, bri]`` triplets in the ranges used by the Hue API. Every value must
+        be an integer; a frame holding anything else, or values out of range, is rejected
+        with the same error as any other request in an invalid format.
+
+        **Example request**::
+
+            {
+                "mode": "rgb",
+                "frame": [
+                    [[255, 0, 0], [0, 255, 0]],
+                    [[0, 0, 255], [255, 255, 255]]
+                ],
+                "transitiontime": 2
+            }
 
+        :request-format:
+        """
+        changes = {}
+        if 'transitiontime' in data:
+            changes['transitiontime'] = data['transitiontime']
+
+        yield GRID.wait_for_capacity()
+        try:
+            GRID.set_frame(data['frame'], data.get('mode', "rgb"), **changes)
+        except (ValueError, TypeError):
+            logging.debug("Frame didn't match the grid", exc_info=True)
+            raise errorcodes.RequestInvalidFormatException
         handle_exceptions((yield GRID.commit()))
 
         self.write({"state": "success"})
 
 
+class LightsRegionHandler(BaseHandler):
+    @error_handler
+    @tornado.gen.coroutine
+    @authenticated
+    @read_json({
+        "type": "object",
+        "properties": {
+            "x0": { "type": "integer" },
+            "y0": { "type": "integer" },
+            "x1": { "type": "integer" },
+            "y1": { "type": "integer" },
+            "change": _CHANGE_SPECIFICATION
+        },
+        "required": ["x0", "y0", "x1", "y1", "change"]
+    })
+    def post(self, data):
+        """Change the state of every light in a rectangular region of the grid, from
+        ``(x0, y0)`` to ``(x1, y1)`` inclusive. Parts of the region outside the grid
+        are ignored. Lights on the same bridge are changed using a single group command
+        where possible, rather than one command each.
+
+        **Example request**::
+
+            {
+                "x0": 0,
+                "y0": 0,
+                "x1": 29,
+                "y1": 19,
+                "change": {
+                    "hue": 46920,
+                    "sat": 255
+                }
+            }
+
+        :request-format:
+        """
+        yield GRID.wait_for_capacity()
+        handle_exceptions((yield GRID.set_region(data['x0'], data['y0'], data['x1'], data['y1'],
+                                                 **data['change'])))
+
+        self.write({"state": "success"})
+
+
+class LightsMaskHandler(BaseHandler):
+    @error_handler
+    @tornado.gen.coroutine
+    @authenticated
+    @read_json({
+        "type": "object",
+        "properties": {
+            "mask": {
+                "type": "array",
+                "items": {
+                    "type": "array",
+                    "items": { "type": ["boolean", "integer"] }
+                }
+            },
+            "change": _CHANGE_SPECIFICATION
+        },
+        "required": ["mask", "change"]
+    })
+    def post(self, data):
+        """Change the state of every light selected by a mask. The mask is a list of rows,
+        one for each y coordinate starting at 0, each of which is a list of values, one for
+        each x coordinate starting at 0; the lights at the coordinates of true or non-zero
+        values are changed. Parts of the mask outside the grid are ignored. Lights on the
+        same bridge are changed using a single group command where possible, rather than
+        one command each.
+
+        **Example request**::
+
+            {
+                "mask": [
+                    [1, 0, 1],
+                    [0, 1, 0]
+                ],
+                "change": {
+                    "on": false
+                }
+            }
+
+        :request-format:
+        """
+        yield GRID.wait_for_capacity()
+        handle_exceptions((yield GRID.set_mask(data['mask'], **data['change'])))
+
+        self.write({"state": "success"})
+
+
+class LightsAnimateHandler(BaseHandler):
+    @error_handler
+    @authenticated
+    @read_json({
+        "type": "object",
+        "properties": {
+            "cells": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "x": { "type": "integer" },
+                        "y": { "type": "integer" }
+                    },
+                    "required": ["x", "y"]
+                }
+            },
+            "region": {
+                "type": "object",
+                "properties": {
+                    "x0": { "type": "integer" },
+                    "y0": { "type": "integer" },
+                    "x1": { "type": "integer" },
+                    "y1": { "type": "integer" }
+                },
+                "required": ["x0", "y0", "x1", "y1"]
+            },
+            "keyframes": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "time": {
+                            "type": "number",
+                            "minimum": 0
+                        },
+                        "change": _CHANGE_SPECIFICATION
+                    },
+                    "required": ["time", "change"]
+                },
+                "minItems": 1
+            },
+            "repeat": { "type": "boolean" }
+        },
+        "required": ["keyframes"],
+        "anyOf": [
+            { "required": ["cells"] },
+            { "required": ["region"] }
+        ]
+    })
+    def post(self, data):
+        """Start an animation of the lights at the given coordinates, the given region
+        (as in :http:post:`/lights/region`), or both. The lights fade through the
+        keyframes, each of which gives the state the lights should reach ``time`` seconds
+        after the animation started. The ``bri``, ``hue``, ``sat``, ``ct``, ``xy`` and
+        ``rgb`` values are interpolated between keyframes; other changes are made when
+        their keyframe is reached. If ``repeat`` is true, the animation starts over after
+        the last keyframe until it is stopped.
+
+        The server sends the intermediate states itself, as often as each bridge's
+        command budget allows while leaving room for other requests, using
+        ``transitiontime`` to fade smoothly between them. Coordinates that are already
+        being animated are taken over by the new animation. The response is sent as soon
+        as the animation has started.
+
+        **Example request**::
+
+            {
+                "region": {"x0": 0, "y0": 0, "x1": 9, "y1": 4},
+                "keyframes": [
+                    {"time": 0, "change": {"hue": 0, "sat": 255, "bri": 50}},
+                    {"time": 5, "change": {"hue": 46920, "sat": 255, "bri": 255}},
+                    {"time": 10, "change": {"hue": 0, "sat": 255, "bri": 50}}
+                ],
+                "repeat": true
+            }
+
+        :request-format:
+        """
+        cells = [(cell['x'], cell['y']) for cell in data.get('cells', [])]
+        if 'region' in data:
+            region = data['region']
+            cells.extend(GRID.region(region['x0'], region['y0'], region['x1'], region['y1']))
+        GRID.animate(cells, [(keyframe['time'], keyframe['change'])
+                             for keyframe in data['keyframes']],
+                     data.get('repeat', False))
+
+        self.write({"state": "success"})
+
+    @error_handler
+    @authenticated
+    def delete(self):
+        """Stop all animations. The lights are left in their current state.
+
+        :request-format:
+        """
+        GRID.stop_animations()
+        self.write({"state": "success"})
+
+
 class LightsAllHandler(BaseHandler):
     @error_handler
     @tornado.gen.coroutine
@@ -438,6 +758,161 @@ class LightsAllHandler(BaseHandler):
         yield GRID.commit()
         self.write({"state": "success"})
 
+
+class LightsStateHandler(BaseHandler):
+    # distinguishes the versions of this instance from those of earlier instances
+    epoch = int(time.time())
+
+    @error_handler
+    @authenticated
+    def get(self):
+        """Retrieve the current state of every light in the grid, as last sent to the
+        lights or reported by the bridges. The bridges are not queried.
+
+        ``lights`` is a list of rows, one for each y coordinate, each of which is a list of
+        states, one for each x coordinate. Each state is a list of the values of the
+        attributes listed in ``keys``, with ``null`` for unknown values, or ``null`` if
+        there is no light at the coordinate.
+
+        The response carries an ``ETag`` header that changes whenever ``version`` does.
+        If the request has an ``If-None-Match`` header containing the current ETag,
+        the response is an empty ``304 Not Modified``.
+
+        :request-format:
+
+        **Example response**::
+
+            {
+                "state": "success",
+                "version": 42,
+                "width": 2,
+                "height": 2,
+                "keys": ["on", "bri", "hue", "sat", "ct", "xy"],
+                "lights": [
+                    [[true, 254, 0, 255, 153, [0.6736, 0.3221]], null],
+                    [[false, 100, null, null, null, null],
+                     [true, 1, 46920, 255, 500, [0.167, 0.04]]]
+                ]
+            }
+
+        **Successful response format**::
+
+            {
+                "type": "object",
+                "properties": {
+                    "state": {
+                        "enum": [
+                            "success"
+                        ]
+                    },
+                    "version": {
+                        "type": "integer",
+                        "description": "A number that increases whenever the state changes."
+                    },
+                    "width": { "type": "integer" },
+                    "height": { "type": "integer" },
+                    "keys": {
+                        "type": "array",
+                        "items": { "type": "string" }
+                    },
+                    "lights": {
+                        "type": "array",
+                        "items": {
+                            "type": "array",
+                            "items": {
+                                "anyOf": [
+                                    { "type": "array" },
+                                    { "type": "null" }
+                                ]
+                            }
+                        }
+                    }
+                },
+                "required": ["state", "version", "width", "height", "keys", "lights"]
+            }
+        """
+        version = GRID.state_version
+        etag = '"{}-{}"'.format(self.epoch, version)
+        self.set_header("Etag", etag)
+        match = self.request.headers.get("If-None-Match", "")
+        if etag in (tag.strip() for tag in match.split(",")):
+            self.set_status(304)
+            return
+
+        self.write({"state": "success", "version": version,
+                    "width": GRID.width, "height": GRID.height,
+                    "keys": GRID.state_keys, "lights": GRID.light_states()})
+
+class SceneHandler(BaseHandler):
+    @error_handler
+    @tornado.gen.coroutine
+    @authenticated
+    @read_json({
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "x": { "type": "integer" },
+                "y": { "type": "integer" },
+                "change": _CHANGE_SPECIFICATION
+            },
+            "required": ["x", "y", "change"]
+        }
+    })
+    def post(self, data, name):
+        """Store a picture as a named scene on the bridges, replacing any previous
+        scene with the same name.
+
+        The lights are not changed until the scene is recalled using
+        :http:post:`/scenes/(?P<name>[^/]+)/recall`, which only needs to send
+        a single command to each bridge.
+
+        :param name: The name of the scene.
+
+        **Example request**::
+
+            [
+                {
+                    "x": 0,
+                    "y": 0,
+                    "change": {"on": true, "hue": 0, "sat": 255, "bri": 255}
+                },
+                {
+                    "x": 1,
+                    "y": 0,
+                    "change": {"on": false}
+                }
+            ]
+
+        :request-format:
+        """
+        exceptions = yield GRID.store_scene(name, {
+            (light['x'], light['y']): light['change'] for light in data
+        })
+        for mac, e in exceptions.items():
+            logging.warning("Couldn't store scene %s on %s", name, mac)
+            logging.debug("", exc_info=(type(e), e, e.__traceback__))
+        self.write({"state": "success"})
+
+
+class SceneRecallHandler(BaseHandler):
+    @error_handler
+    @tornado.gen.coroutine
+    @authenticated
+    def post(self, name):
+        """Change the lights to a scene stored using :http:post:`/scenes/(?P<name>[^/]+)`.
+
+        :param name: The name of the scene.
+
+        :request-format:
+        """
+        exceptions = yield GRID.recall_scene(name)
+        for mac, e in exceptions.items():
+            logging.warning("Couldn't recall scene %s on %s", name, mac)
+            logging.debug("", exc_info=(type(e), e, e.__traceback__))
+        self.write({"state": "success"})
+
+
 class BridgesHandler(BaseHandler):
     @error_handler
     @tornado.gen.coroutine
@@ -456,13 +931,22 @@ class BridgesHandler(BaseHandler):
                         "ip": "192.168.0.101",
                         "username": null,
                         "valid_username": false,
-                        "lights": -1
+                        "lights": -1,
+                        "queue": {"depth": 0, "background": 0, "merged": 0, "sent": 0},
+                        "latency": {"rtt": null, "timeout": 2},
+                        "errors": {"http": 5},
+                        "breaker": {"state": "open", "failures": 5}
                     },
                     "f827aef865ca": {
                         "ip": "192.168.0.104",
                         "username": "my-username",
                         "valid_username": true,
-                        "lights": 3
+                        "lights": 3,
+                        "queue": {"depth": 2, "background": 1, "merged": 17,
+                                  "sent": 240},
+                        "latency": {"rtt": 0.043, "timeout": 0.25},
+                        "errors": {"201": 4},
+                        "breaker": {"state": "closed", "failures": 0}
                     }
                 }
             }
@@ -501,6 +985,73 @@ class BridgesHandler(BaseHandler):
                                         "type": "integer",
                                         "description": "Number of lights belonging """ \
                                             """to the bridge. -1 if valid_username is false."
+                                    },
+                                    "queue": {
+                                        "type": "object",
+                                        "description": "Statistics for the bridge's """ \
+                                            """outbound command queue.",
+                                        "properties": {
+                                            "depth": {
+                                                "type": "integer",
+                                                "description": "Number of commands """ \
+                                                    """waiting to be sent."
+                                            },
+                                            "background": {
+                                                "type": "integer",
+                                                "description": "Number of background """ \
+                                                    """requests waiting to be sent."
+                                            },
+                                            "merged": {
+                                                "type": "integer",
+                                                "description": "Number of state changes """ \
+                                                    """merged into a pending command."
+                                            },
+                                            "sent": {
+                                                "type": "integer",
+                                                "description": "Number of commands sent."
+                                            }
+                                        }
+                                    },
+                                    "latency": {
+                                        "type": "object",
+                                        "properties": {
+                                            "rtt": {
+                                                "type": ["number", "null"],
+                                                "description": "Estimated round-trip time """ \
+                                                    """in seconds. null if not yet measured."
+                                            },
+                                            "timeout": {
+                                                "type": "number",
+                                                "description": "Current request timeout """ \
+                                                    """in seconds."
+                                            }
+                                        }
+                                    },
+                                    "errors": {
+                                        "type": "object",
+                                        "description": "Map of Hue API error type, """ \
+                                            """or http for failed requests -> number """ \
+                                            """of errors.",
+                                        "additionalProperties": {
+                                            "type": "integer"
+                                        }
+                                    },
+                                    "breaker": {
+                                        "type": "object",
+                                        "properties": {
+                                            "state": {
+                                                "enum": ["closed", "open", "half-open"],
+                                                "description": "open if the bridge is """ \
+                                                    """unreachable and changes to its """ \
+                                                    """lights are rejected."
+                                            },
+                                            "failures": {
+                                                "type": "integer",
+                                                "description": "Number of consecutive """ \
+                                                    """requests that failed to reach """ \
+                                                    """the bridge."
+                                            }
+                                        }
                                     }
                                 }
                             }
@@ -509,9 +1060,9 @@ class BridgesHandler(BaseHandler):
                 }
             }
         """
-        lights = yield {mac: bridge.get_lights()
+        lights = yield {mac: bridge.get_lights(priority=playhouse.CommandQueue.BACKGROUND)
                         for mac, bridge in GRID.bridges.items()
-                        if bridge.logged_in}
+                        if bridge.logged_in and bridge.breaker.closed}
         res = {
             "state": "success",
             "bridges": {
@@ -519,7 +1070,22 @@ class BridgesHandler(BaseHandler):
                     "ip": bridge.ipaddress,
                     "username": bridge.username,
                     "valid_username": bridge.logged_in,
-                    "lights": len(lights[mac]) if bridge.logged_in else -1
+                    "lights": len(lights.get(mac, bridge.light_data)) if bridge.logged_in else -1,
+                    "queue": {
+                        "depth": bridge.queue.depth,
+                        "background": bridge.queue.background_depth,
+                        "merged": bridge.queue.merged,
+                        "sent": bridge.queue.sent
+                    },
+                    "latency": {
+                        "rtt": bridge.rtt.srtt,
+                        "timeout": bridge.timeout
+                    },
+                    "errors": {str(k): v for k, v in bridge.errors.items()},
+                    "breaker": {
+                        "state": bridge.breaker.state,
+                        "failures": bridge.breaker.failures
+                    }
                 }
                 for mac, bridge in GRID.bridges.items()
             }
@@ -714,7 +1280,10 @@ class BridgesMacHandler(BaseHandler):
 
         :request-format:
         """
-        GRID.remove_bridge(mac)
+        lost = GRID.remove_bridge(mac)
+        if len(lost) > 0:
+            logging.info("Removed bridge %s, leaving grid coordinates %s without a bridge",
+                         mac, lost)
         save_grid_changes()
         self.write({"state": "success"})
 
@@ -773,6 +1342,10 @@ class BridgeLightsHandler(BaseHandler):
             light['light']: GRID.bridges[mac].set_state(light['light'], **light['change'])
             for light in data
         })
+        for light, e in errors.items():
+            logging.warning("Couldn't change light %s on %s (grid coordinates %s)",
+                            light, mac, GRID.coordinates(mac, light))
+            logging.debug("", exc_info=(type(e), e, e.__traceback__))
         self.write({'state': 'success'})
 
 
@@ -1196,6 +1769,58 @@ class StatusHandler(BaseHandler):
         pass
 
 
+class MetricsHandler(BaseHandler):
+    def get(self):
+        """Retrieve request, error and queue statistics for every bridge, as well as
+        the number and approximate size of the delayed changes waiting to be applied
+        (see :http:post:`/lights`), in the Prometheus text format. Does not require
+        authentication, so that it can be scraped by a monitoring system.
+
+        **Example response**::
+
+            # HELP playhouse_bridge_requests_total Requests sent to the bridge, by HTTP method.
+            # TYPE playhouse_bridge_requests_total counter
+            playhouse_bridge_requests_total{bridge="001788fec193",method="GET"} 14
+            playhouse_bridge_requests_total{bridge="001788fec193",method="PUT"} 1052
+            # HELP playhouse_bridge_errors_total Failed requests (type http) and Hue API ...
+            # TYPE playhouse_bridge_errors_total counter
+            playhouse_bridge_errors_total{bridge="001788fec193",type="201",
+                                          error="DeviceIsOffException"} 3
+            ...
+            # HELP playhouse_scheduled_changes Delayed changes waiting to be applied.
+            # TYPE playhouse_scheduled_changes gauge
+            playhouse_scheduled_changes 0
+            ...
+
+        :request-format:
+        """
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(format_metrics(GRID.bridges, GRID.scheduler))
+
+
+def format_metrics(bridges, scheduler=None):
+    samples = {mac: bridge.metrics.samples() for mac, bridge in bridges.items()}
+    lines = []
+    for name, (metric_type, description) in playhouse.BridgeMetrics.descriptions.items():
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for mac in sorted(samples):
+            for suffix, labels, value in samples[mac][name]:
+                labels = ",".join('{}="{}"'.format(label, label_value)
+                                  for label, label_value in (("bridge", mac),) + labels)
+                lines.append("{}{}{{{}}} {}".format(name, suffix, labels, value))
+    if scheduler is not None:
+        for name, description, value in (
+                ("playhouse_scheduled_changes", "Delayed changes waiting to be applied.",
+                 scheduler.size),
+                ("playhouse_scheduled_bytes", "Approximate memory used by delayed changes "
+                 "waiting to be applied.", scheduler.memory)):
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+    return "\n".join(lines) + "\n"
+
+
 @tornado.gen.coroutine
 def init_lightgrid():
     logging.info("Initializing the LightGrid")
@@ -1212,21 +1837,76 @@ def init_lightgrid():
 
     GRID.set_usernames(bridge_config["usernames"])
     GRID.set_grid(bridge_config["grid"])
+    bridge_options = {"rate": CONFIG['bridge_rate'],
+                      "pool_size": CONFIG['bridge_connections'],
+                      "window": CONFIG['bridge_window'],
+                      "fire_and_forget": CONFIG['fire_and_forget'],
+                      "validation_sample": CONFIG['validation_sample'],
+                      "sync_interval": CONFIG['sync_interval']}
+    if CONFIG['simulate_bridges']:
+        logging.warning("Using simulated bridges")
+        bridge_options["transport"] = playhouse.SimulatedTransport
+    GRID.set_bridge_options(bridge_options)
+    GRID.set_max_queue_depth(CONFIG['max_queue_depth'])
+    GRID.set_commit_rate(CONFIG['commit_rate'])
+    GRID.scheduler.max_changes = CONFIG['max_scheduled_changes']
 
     logging.info("Adding preconfigured bridges")
 
-
-    res, exc = yield playhouse.ExceptionCatcher({ip: GRID.add_bridge(ip)
-                                                 for ip in bridge_config['ips']})
-    for ip, bridge in res.items():
-        logging.info("Added bridge %s at %s", bridge.serial_number, bridge.ipaddress)
+    cache = load_bridge_cache()
+    futures = {}
+    for ip in bridge_config['ips']:
+        try:
+            bridge = GRID.add_cached_bridge(cache[ip])
+            logging.info("Added cached bridge %s at %s", bridge.serial_number, ip)
+            futures[ip] = bridge.ready
+        except KeyError:
+            futures[ip] = GRID.add_bridge(ip)
+    load_snapshot()
+
+    _, exc = yield playhouse.ExceptionCatcher(futures)
     for ip, e in exc.items():
         logging.warning("Couldn't find a bridge at %s", ip)
         logging.debug("", exc_info=(type(e), e, e.__traceback__))
+    for bridge in GRID.bridges.values():
+        logging.info("Validated bridge %s at %s", bridge.serial_number, bridge.ipaddress)
 
     logging.info("Finished adding bridges")
+    save_bridge_cache()
 
-def init_http():
+def load_bridge_cache():
+    try:
+        with open(BRIDGE_CACHE_FILE, 'r') as f:
+            return tornado.escape.json_decode(f.read())
+    except (FileNotFoundError, ValueError):
+        logging.info("%s not found or contained invalid JSON, contacting all bridges",
+                     BRIDGE_CACHE_FILE)
+        return {}
+
+def load_snapshot():
+    try:
+        with open(LIGHT_SNAPSHOT_FILE, 'rb') as f:
+            restored = GRID.restore_snapshot(f.read(), CONFIG['snapshot_max_age'])
+            logging.info("Restored the state of %s lights from %s", restored, LIGHT_SNAPSHOT_FILE)
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        logging.warning("%s is not a valid light state snapshot", LIGHT_SNAPSHOT_FILE)
+
+def save_snapshot():
+    # write to a temporary file first, so that a crash can't leave a partial snapshot
+    with open(LIGHT_SNAPSHOT_FILE + ".tmp", 'wb') as f:
+        f.write(GRID.snapshot())
+    os.replace(LIGHT_SNAPSHOT_FILE + ".tmp", LIGHT_SNAPSHOT_FILE)
+    logging.debug("Wrote light state snapshot to %s", LIGHT_SNAPSHOT_FILE)
+
+def save_bridge_cache():
+    cache = {bridge.ipaddress: bridge.to_cache() for bridge in GRID.bridges.values()}
+    with open(BRIDGE_CACHE_FILE, 'w') as f:
+        f.write(tornado.escape.json_encode(cache))
+        logging.debug("Wrote bridge cache to %s", BRIDGE_CACHE_FILE)
+
+def init_config():
     logging.info("Reading configuration file (%s)", CONFIG_FILE)
 
     try:
@@ -1236,6 +1916,7 @@ def init_http():
         logging.warning("%s not found or contained invalid JSON, " \
                         "using default configuration values: %s", CONFIG_FILE, CONFIG)
 
+def init_http():
     if not CONFIG['validate_state_changes']:
         _CHANGE_SPECIFICATION.clear()
         _CHANGE_SPECIFICATION['type'] = 'object'
@@ -1265,6 +1946,13 @@ def init_http():
 application = tornado.web.Application([
     (r'/lights', LightsHandler),
     (r'/lights/all', LightsAllHandler),
+    (r'/lights/state', LightsStateHandler),
+    (r'/lights/frame', LightsFrameHandler),
+    (r'/lights/region', LightsRegionHandler),
+    (r'/lights/mask', LightsMaskHandler),
+    (r'/lights/animate', LightsAnimateHandler),
+    (r'/scenes/(?P<name>[^/]+)', SceneHandler),
+    (r'/scenes/(?P<name>[^/]+)/recall', SceneRecallHandler),
     (r'/bridges', BridgesHandler),
     (r'/bridges/add', BridgesAddHandler), # POST save_grid_changes
     (r'/bridges/search', BridgesSearchHandler), # POST save_grid_changes
@@ -1278,20 +1966,30 @@ application = tornado.web.Application([
     (r'/debug', DebugHandler),
     (r'/authenticate', AuthenticateHandler),
     (r'/status', StatusHandler),
+    (r'/metrics', MetricsHandler),
 ], cookie_secret=os.urandom(256))
 
 if __name__ == "__main__":
     loop = tornado.ioloop.IOLoop.current()
-    loop.run_sync(init_lightgrid)
-
+    init_config()
     init_http()
 
     logging.info("Server now listening at port %s", CONFIG['port'])
+
+    # bridges are added while the server is already running; cached bridges
+    # are usable right away, and are validated in the background
+    loop.add_future(init_lightgrid(), lambda future: future.result())
+
+    if CONFIG['snapshot_interval'] is not None:
+        tornado.ioloop.PeriodicCallback(save_snapshot,
+                                        CONFIG['snapshot_interval'] * 1000).start()
     
     @tornado.gen.coroutine  
     def on_shutdown(): 
         logging.info("Server received interrupt, shutting down") 
         yield GRID.set_all(**{"on": False}) 
+        save_bridge_cache()
+        save_snapshot()
         loop.stop() 
 
     signal.signal(signal.SIGINT, lambda sig, frame: loop.add_callback_from_signal(on_shutdown))
@@ -23,22 +23,32 @@ This library exposes the Philips Hue API, normally a JSON API, as an object orie
 These methods require that the `IOLoop <tornado.ioloop.IOLoop>` returned by `tornado.ioloop.IOLoop.current`
 is running in order to function.
 """
+import binascii
+import bisect
 import copy
 import colorsys
 import collections
 import datetime
 import errno
+import functools
+import io
 import itertools
 import json
 import logging
+import math
 import re
 import socket
+import struct
+import sys
+import time
+import zlib
 from xml.etree import ElementTree
 
 import tornado.concurrent
 import tornado.escape
 import tornado.gen
 import tornado.httpclient
+import tornado.httputil
 import tornado.ioloop
 import tornado.iostream
 
@@ -48,6 +58,11 @@ try:
 except ImportError:
     logging.warning("Couldn't import CurlAsyncHTTPClient, reverting to slow default implementation")
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TaskTimedOutException(Exception):
     pass
@@ -67,6 +82,15 @@ class NoBridgeAtCoordinateException(Exception):
 class BulbNotResetException(Exception):
     pass
 
+class RequestTimedOutException(tornado.httpclient.HTTPError):
+    def __init__(self):
+        super().__init__(599, "Timeout")
+
+class BridgeUnavailableException(tornado.httpclient.HTTPError):
+    def __init__(self, bridge):
+        super().__init__(599, "Bridge unavailable")
+        self.bridge = bridge
+
 class HueAPIException(Exception):
     def __init__(self, error, bridge):
         super().__init__("{}: {}".format(error["error"]["address"], error["error"]["description"]))
@@ -118,6 +142,14 @@ HUE_ERRORS = {
     901: InternalErrorException
 }
 
+class UnknownSceneException(Exception):
+    pass
+
+class ScheduleFullException(Exception):
+    def __init__(self, max_changes):
+        super().__init__()
+        self.max_changes = max_changes
+
 class UnknownBridgeException(Exception):
     def __init__(self, mac):
         super().__init__()
@@ -166,6 +198,38 @@ class ExceptionCatcher(tornado.gen.YieldPoint):
         return results, self.exceptions
 
 
+def gather_exceptions(futures):
+    """Wait for multiple futures to complete, collecting any exceptions raised.
+
+    Unlike `ExceptionCatcher`, this only keeps a single callback per future rather than
+    a `tornado.gen.YieldPoint`, which matters when waiting for thousands of futures.
+    The same future may be given under several keys.
+
+    :param dict futures: A dictionary of `tornado.concurrent.Future` objects.
+    :return: A `tornado.concurrent.Future` that resolves to a dictionary with the keys of
+             the futures that failed and the raised exception objects as values, once
+             all futures have completed.
+    :rtype: `dict`
+    """
+    result = tornado.concurrent.TracebackFuture()
+    exceptions = {}
+    remaining = len(futures)
+
+    def done(key, future):
+        nonlocal remaining
+        if future.exception() is not None:
+            exceptions[key] = future.exception()
+        remaining -= 1
+        if remaining == 0:
+            result.set_result(exceptions)
+
+    if len(futures) == 0:
+        result.set_result(exceptions)
+    for key, future in futures.items():
+        future.add_done_callback(functools.partial(done, key))
+    return result
+
+
 class TimeoutTask(tornado.gen.YieldPoint):
     def __init__(self, func, *args, timeout=2, **kwargs):
         assert "callback" not in kwargs
@@ -206,6 +270,1947 @@ class TimeoutTask(tornado.gen.YieldPoint):
             raise TaskTimedOutException
 
 
+class Response:
+    """A response to an HTTP request sent through a `ConnectionPool`."""
+    __slots__ = ("code", "headers", "body")
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    @property
+    def buffer(self):
+        """The response body as a file-like object."""
+        return io.BytesIO(self.body)
+
+
+class _Connection:
+    """A persistent HTTP/1.1 connection belonging to a `ConnectionPool`."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.stream = tornado.iostream.IOStream(socket.socket())
+        self.stream.set_close_callback(self._on_close)
+        self.future = None
+        self.written = None
+        self.requests = 0
+        self.sent = False
+        self.dropped = False
+
+        self._method = None
+        self._code = None
+        self._headers = None
+        self._chunks = None
+
+    def closed(self):
+        return self.stream.closed()
+
+    def connect(self):
+        self.future = tornado.concurrent.TracebackFuture()
+        self.stream.connect((self.pool.host, self.pool.port), self._on_connect)
+        return self.future
+
+    def _on_connect(self):
+        self._finish(self)
+
+    def request(self, method, url, body=None):
+        future = self.future = tornado.concurrent.TracebackFuture()
+        self.written = tornado.concurrent.TracebackFuture()
+        self.requests += 1
+        self.sent = False
+        self._method = method
+        if self.stream.closed():
+            self._on_close()
+            return future
+
+        lines = ["{} {} HTTP/1.1".format(method, url),
+                 "Host: {}:{}".format(self.pool.host, self.pool.port)]
+        if body is not None:
+            body = body.encode() if isinstance(body, str) else body
+            lines.append("Content-Length: {}".format(len(body)))
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("latin1")
+        if body is not None:
+            data += body
+
+        self.sent = True
+        self.stream.write(data, self._on_written)
+        self.stream.read_until(b"\r\n\r\n", self._on_headers)
+        return future
+
+    def _on_written(self):
+        if not self.written.done():
+            self.written.set_result(None)
+
+    def _on_headers(self, data):
+        status, _, header_data = data.decode("latin1").partition("\r\n")
+        try:
+            code = int(status.split(" ", 2)[1])
+        except (IndexError, ValueError):
+            self.abort("Malformed status line {!r}".format(status))
+            return
+        if 100 <= code < 200:
+            # interim responses such as 100 Continue precede the actual response
+            self.stream.read_until(b"\r\n\r\n", self._on_headers)
+            return
+        self._code = code
+        self._headers = tornado.httputil.HTTPHeaders.parse(header_data)
+
+        if self._method == "HEAD" or code in (204, 304):
+            self._on_body(b"")
+        elif "Content-Length" in self._headers:
+            try:
+                length = int(self._headers["Content-Length"])
+            except ValueError:
+                self.abort("Malformed Content-Length {!r}".format(self._headers["Content-Length"]))
+                return
+            self.stream.read_bytes(length, self._on_body)
+        elif self._headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self._chunks = []
+            self.stream.read_until(b"\r\n", self._on_chunk_length)
+        else:
+            self._headers["Connection"] = "close"
+            self.stream.read_until_close(self._on_body)
+
+    def _on_chunk_length(self, data):
+        try:
+            length = int(data.split(b";", 1)[0], 16)
+        except ValueError:
+            self.abort("Malformed chunk length {!r}".format(data))
+            return
+        if length == 0:
+            self.stream.read_until(b"\r\n", self._on_trailer)
+        else:
+            self.stream.read_bytes(length + 2, self._on_chunk)
+
+    def _on_chunk(self, data):
+        self._chunks.append(data[:-2])
+        self.stream.read_until(b"\r\n", self._on_chunk_length)
+
+    def _on_trailer(self, data):
+        # trailer fields are skipped up to the empty line ending the message
+        if data == b"\r\n":
+            self._on_body(b"".join(self._chunks))
+        else:
+            self.stream.read_until(b"\r\n", self._on_trailer)
+
+    def _on_body(self, body):
+        response = Response(self._code, self._headers, body)
+        self._chunks = None
+        if self._headers.get("Connection", "").lower() == "close":
+            self.stream.set_close_callback(None)
+            self.stream.close()
+        self._finish(response)
+
+    def _finish(self, result):
+        future, self.future = self.future, None
+        if future is not None:
+            future.set_result(result)
+
+    def abort(self, message):
+        """Close the connection, failing the request in progress."""
+        future, self.future = self.future, None
+        self.stream.set_close_callback(None)
+        self.stream.close()
+        for f in (future, self.written):
+            if f is not None and not f.done():
+                f.set_exception(tornado.httpclient.HTTPError(599, message))
+
+    def _on_close(self):
+        error = getattr(self.stream, "error", None)
+        self.dropped = True
+        future, self.future = self.future, None
+        for f in (future, self.written):
+            if f is not None and not f.done():
+                f.set_exception(tornado.httpclient.HTTPError(
+                    599, str(error) if error is not None else "Connection closed"))
+
+
+class ConnectionPool:
+    """A bounded pool of persistent HTTP/1.1 connections to a single host.
+
+    Every `Bridge` owns a pool of its own, so that a slow bridge cannot occupy
+    connections needed to communicate with other bridges. Connections are kept open
+    between requests, avoiding a new TCP handshake for each command. Since this is
+    implemented directly on top of `tornado.iostream.IOStream`, it works regardless
+    of whether the curl HTTP client is available.
+
+    A request that fails because the host closed a reused connection is sent again
+    on another connection if time remains, but only if it is idempotent or was not
+    written at all, so that for instance a group is never created twice.
+    """
+    idempotent_methods = {"GET", "HEAD", "PUT", "DELETE"}
+
+    def __init__(self, host, port=None, size=2):
+        """Initializes the `ConnectionPool`. No connections are opened until
+        `warm` or `fetch` is called.
+
+        :param str host: The host to connect to, optionally followed by ``:port``.
+        :param int port: The port to connect to. Defaults to the port given in ``host``,
+                         or 80.
+        :param int size: The maximum number of connections to keep open at the same time.
+        """
+        if port is None:
+            host, _, port = host.partition(":")
+            port = int(port) if port else 80
+        self.host = host
+        self.port = port
+        self.size = size
+
+        self._idle = []
+        self._busy = set()
+        self._waiting = collections.deque()
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+    @property
+    def connections(self):
+        """The number of connections currently open or being opened."""
+        return len(self._idle) + len(self._busy)
+
+    def warm(self):
+        """Start opening new connections until the pool is full, without waiting
+        for the connection attempts to complete.
+        """
+        while self.connections < self.size:
+            future = tornado.concurrent.TracebackFuture()
+            self._connect(future)
+            self.ioloop.add_future(future, self._release_unused)
+
+    def _release_unused(self, future):
+        if future.exception() is None:
+            self._release(future.result())
+
+    def close(self):
+        """Close all connections in the pool."""
+        for conn in self._idle + list(self._busy):
+            conn.abort("Connection pool closed")
+        self._idle = []
+        self._busy.clear()
+
+    @tornado.gen.coroutine
+    def fetch(self, method, url, body=None, timeout=2):
+        """Send an HTTP request using a connection from the pool.
+
+        :param str method: HTTP request method (POST/GET/PUT/DELETE).
+        :param str url: The path to send this request to.
+        :param str body: HTTP request body.
+        :param float timeout: The time in seconds to wait for the request to complete,
+                              including any time spent waiting for a free connection.
+        :return: A `tornado.concurrent.Future` that resolves to the response when complete.
+        :rtype: `Response`
+        :raises: `RequestTimedOutException` if the request timed out.
+
+                 `tornado.httpclient.HTTPError` if the request failed, or if the response
+                 status code was not in the 2xx range.
+        """
+        deadline = self.ioloop.time() + timeout
+        while True:
+            waiter = tornado.concurrent.TracebackFuture()
+            self._acquire(waiter)
+            conn = yield self._until(waiter, deadline, lambda: self._cancel(waiter))
+            reused = conn.requests > 0
+            try:
+                response = yield self._until(conn.request(method, url, body), deadline,
+                                             lambda: conn.abort("Timeout"))
+            except tornado.httpclient.HTTPError:
+                self._busy.discard(conn)
+                self._notify()
+                if self._may_resend(conn, reused, method, deadline):
+                    continue
+                raise
+            self._release(conn)
+            break
+
+        if not 200 <= response.code < 300:
+            raise tornado.httpclient.HTTPError(response.code, response=response)
+        return response
+
+    @tornado.gen.coroutine
+    def send(self, method, url, body=None, timeout=2):
+        """Send an HTTP request using a connection from the pool, without waiting
+        for the response.
+
+        The connection stays occupied until the response has been read in the
+        background. If a reused connection turns out to have been closed by the host,
+        the request may be sent again on another connection, as with `fetch`.
+
+        :param str method: HTTP request method (POST/GET/PUT/DELETE).
+        :param str url: The path to send this request to.
+        :param str body: HTTP request body.
+        :param float timeout: The time in seconds to wait for the request to complete,
+                              including any time spent waiting for a free connection.
+        :return: A `tornado.concurrent.Future` that resolves as soon as the request has
+                 been written, to another `tornado.concurrent.Future` that resolves
+                 as `fetch` does.
+        :raises: `RequestTimedOutException` if the request could not be written in time.
+
+                 `tornado.httpclient.HTTPError` if the request could not be written.
+        """
+        deadline = self.ioloop.time() + timeout
+        waiter = tornado.concurrent.TracebackFuture()
+        self._acquire(waiter)
+        conn = yield self._until(waiter, deadline, lambda: self._cancel(waiter))
+        reused = conn.requests > 0
+        abort = lambda: conn.abort("Timeout")
+        response = self._until(conn.request(method, url, body), deadline, abort)
+        result = tornado.concurrent.TracebackFuture()
+
+        def done(future):
+            if future.exception() is None:
+                self._release(conn)
+                response = future.result()
+                if 200 <= response.code < 300:
+                    result.set_result(response)
+                else:
+                    result.set_exception(tornado.httpclient.HTTPError(response.code,
+                                                                      response=response))
+                return
+            self._busy.discard(conn)
+            self._notify()
+            if self._may_resend(conn, reused, method, deadline):
+                retry = self.fetch(method, url, body, deadline - self.ioloop.time())
+                tornado.concurrent.chain_future(retry, result)
+            else:
+                tornado.concurrent.chain_future(future, result)
+
+        self.ioloop.add_future(response, done)
+        try:
+            yield self._until(conn.written, deadline, abort)
+        except tornado.httpclient.HTTPError:
+            if not self._may_resend(conn, reused, method, deadline):
+                raise
+            # the response callback resends the request on another connection
+        return result
+
+    def _may_resend(self, conn, reused, method, deadline):
+        # The host may have closed an idle connection just before the request was sent
+        # on it. Only requests that are safe to repeat are sent again, unless none of the
+        # request had been written: the host may otherwise already have acted on it.
+        return (reused and conn.dropped and self.ioloop.time() < deadline
+                and (not conn.sent or method in self.idempotent_methods))
+
+    def _until(self, future, deadline, on_timeout):
+        result = tornado.concurrent.TracebackFuture()
+
+        def timed_out():
+            if not result.done():
+                on_timeout()
+                result.set_exception(RequestTimedOutException())
+
+        handle = self.ioloop.add_timeout(deadline, timed_out)
+
+        def done(f):
+            self.ioloop.remove_timeout(handle)
+            if not result.done():
+                tornado.concurrent.chain_future(f, result)
+            else:
+                f.exception()  # the request timed out, so its outcome is of no interest
+
+        self.ioloop.add_future(future, done)
+        return result
+
+    def _acquire(self, waiter):
+        while len(self._idle) > 0:
+            conn = self._idle.pop()
+            if not conn.closed():
+                self._busy.add(conn)
+                waiter.set_result(conn)
+                return
+        if self.connections < self.size:
+            self._connect(waiter)
+        else:
+            self._waiting.append(waiter)
+
+    def _cancel(self, waiter):
+        try:
+            self._waiting.remove(waiter)
+        except ValueError:
+            # a connection is or will be handed to the waiter, but is no longer needed
+            self.ioloop.add_future(waiter, self._release_unused)
+
+    def _connect(self, waiter):
+        conn = _Connection(self)
+        self._busy.add(conn)
+
+        def connected(future):
+            if future.exception() is not None:
+                self._busy.discard(conn)
+                self._notify()
+            tornado.concurrent.chain_future(future, waiter)
+
+        self.ioloop.add_future(conn.connect(), connected)
+
+    def _release(self, conn):
+        self._busy.discard(conn)
+        if not conn.closed():
+            while len(self._waiting) > 0:
+                waiter = self._waiting.popleft()
+                if not waiter.done():
+                    self._busy.add(conn)
+                    waiter.set_result(conn)
+                    return
+            self._idle.append(conn)
+        self._notify()
+
+    def _notify(self):
+        # open a new connection for the next waiter if there is room for one
+        while len(self._waiting) > 0 and self.connections < self.size:
+            waiter = self._waiting.popleft()
+            if not waiter.done():
+                self._connect(waiter)
+
+
+class SimulatedTransport:
+    """An in-process simulation of a Hue bridge, usable as the transport of a `Bridge`
+    in place of a `ConnectionPool`.
+
+    The simulated bridge keeps track of the state of its lights, groups and scenes and
+    answers requests the way a real bridge would, so that the whole library can be
+    exercised and profiled without any hardware. Requests are processed one at a time;
+    each takes ``1 / rate`` seconds of the bridge's time, and is answered ``latency``
+    seconds after it has been processed. If more than ``max_backlog`` seconds worth of
+    requests are waiting to be processed, further requests are rejected with
+    HTTP status 503, like an overloaded bridge.
+
+    Example usage::
+
+        bridge = yield Bridge("10.0.0.1", "simulateduser",
+                              transport=SimulatedTransport("10.0.0.1", lights=50))
+    """
+    statekeys = {"on", "bri", "hue", "sat", "xy", "ct", "alert", "effect",
+                 "transitiontime", "scene"}
+
+    def __init__(self, host, lights=10, latency=0.02, rate=25, max_backlog=1,
+                 usernames=None, link_button=True, max_groups=16, max_scenes=200):
+        """Initializes the `SimulatedTransport`.
+
+        :param str host: The IP address of the simulated bridge. The MAC address and
+                         serial number of the bridge are derived from it.
+        :param int lights: The number of lights connected to the bridge.
+        :param float latency: The network round-trip time in seconds.
+        :param float rate: The number of requests the bridge can process per second.
+        :param float max_backlog: The number of seconds worth of requests that may be
+                                  waiting to be processed before requests are rejected.
+        :param usernames: The usernames accepted by the bridge, or `None` to accept
+                          any username that is at least 10 characters long.
+        :param bool link_button: Whether the link button is pressed, allowing new users
+                                 to be created.
+        :param int max_groups: The maximum number of groups the bridge can hold.
+        :param int max_scenes: The maximum number of scenes the bridge can hold.
+        """
+        self.host = host
+        self.latency = latency
+        self.rate = rate
+        self.max_backlog = max_backlog
+        self.usernames = set(usernames) if usernames is not None else None
+        self.link_button = link_button
+        self.max_groups = max_groups
+        self.max_scenes = max_scenes
+
+        digest = zlib.crc32(host.encode())
+        self.mac = "00:17:88:{:02x}:{:02x}:{:02x}".format(
+            digest >> 16 & 0xff, digest >> 8 & 0xff, digest & 0xff)
+        self.serial_number = self.mac.replace(":", "")
+
+        self.lights = {i: {"on": True, "bri": 254, "hue": 0, "sat": 0, "xy": [0.3127, 0.329],
+                           "ct": 153, "alert": "none", "effect": "none", "colormode": "hs",
+                           "reachable": True}
+                       for i in range(1, lights + 1)}
+        self.groups = {}
+        self.scenes = {}
+        self.requests = 0
+
+        self._busy_until = 0
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+    def warm(self):
+        pass
+
+    def close(self):
+        pass
+
+    def fetch(self, method, url, body=None, timeout=2):
+        """Send a request to the simulated bridge. See `ConnectionPool.fetch`."""
+        future = tornado.concurrent.TracebackFuture()
+        now = self.ioloop.time()
+        self.requests += 1
+
+        if self._busy_until - now > self.max_backlog:
+            response = Response(503, tornado.httputil.HTTPHeaders(), b"")
+            delay = self.latency
+        else:
+            self._busy_until = max(now, self._busy_until) + 1 / self.rate
+            response = self._handle(method, url, body)
+            delay = self._busy_until - now + self.latency
+
+        def respond():
+            if future.done():
+                return
+            if 200 <= response.code < 300:
+                future.set_result(response)
+            else:
+                future.set_exception(tornado.httpclient.HTTPError(response.code,
+                                                                  response=response))
+
+        def timed_out():
+            if not future.done():
+                future.set_exception(RequestTimedOutException())
+
+        if delay > timeout:
+            self.ioloop.add_timeout(now + timeout, timed_out)
+        else:
+            self.ioloop.add_timeout(now + delay, respond)
+        return future
+
+    def send(self, method, url, body=None, timeout=2):
+        """Send a request to the simulated bridge without waiting for the response.
+        See `ConnectionPool.send`.
+        """
+        future = tornado.concurrent.TracebackFuture()
+        future.set_result(self.fetch(method, url, body, timeout))
+        return future
+
+    def _handle(self, method, url, body):
+        path = [p for p in url.split("?", 1)[0].split("/") if p != ""]
+        if path == ["description.xml"] and method == "GET":
+            return Response(200, tornado.httputil.HTTPHeaders({"Content-Type": "text/xml"}),
+                            self._description().encode())
+        if len(path) == 0 or path[0] != "api":
+            return Response(404, tornado.httputil.HTTPHeaders(), b"")
+
+        try:
+            if isinstance(body, bytes):
+                body = body.decode()
+            body = json.loads(body) if body else {}
+        except ValueError:
+            result = [self._error(2, "/", "body contains invalid json")]
+        else:
+            if len(path) == 1:
+                result = self._create_user(method, body)
+            else:
+                result = self._handle_api(method, path[1], path[2:], body)
+        return Response(200, tornado.httputil.HTTPHeaders({"Content-Type": "application/json"}),
+                        json.dumps(result).encode())
+
+    def _description(self):
+        return ('<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0"><device>'
+                '<friendlyName>Philips hue ({})</friendlyName>'
+                '<modelName>Philips hue bridge 2012</modelName>'
+                '<serialNumber>{}</serialNumber></device></root>').format(
+                    self.host, self.serial_number)
+
+    @staticmethod
+    def _error(error_type, address, description):
+        return {"error": {"type": error_type, "address": address, "description": description}}
+
+    def _authorized(self, username):
+        if self.usernames is None:
+            return len(username) >= 10
+        return username in self.usernames
+
+    def _create_user(self, method, body):
+        if method != "POST":
+            return [self._error(4, "/", "method, {}, not available for resource, /".format(
+                method))]
+        if not self.link_button:
+            return [self._error(101, "", "link button not pressed")]
+        username = body.get("username", "sim{:016x}".format(self.requests))
+        if self.usernames is not None:
+            self.usernames.add(username)
+        return [{"success": {"username": username}}]
+
+    def _config(self):
+        return {"name": "Philips hue", "mac": self.mac, "ipaddress": self.host,
+                "gateway": "0.0.0.0", "netmask": "255.255.255.0", "swversion": "01012917"}
+
+    def _handle_api(self, method, username, path, body):
+        address = "/" + "/".join(path)
+        if not self._authorized(username):
+            if path == ["config"] and method == "GET":
+                return {"name": "Philips hue", "mac": self.mac, "swversion": "01012917"}
+            return [self._error(1, address, "unauthorized user")]
+
+        if len(path) == 0 and method == "GET":
+            return {"config": self._config(), "lights": self._get_lights(),
+                    "groups": self._get_groups(), "schedules": {}, "scenes": self._get_scenes()}
+        if path == ["config"] and method == "GET":
+            return self._config()
+
+        if path[0] == "lights":
+            if len(path) == 1 and method == "GET":
+                return self._get_lights()
+            if len(path) == 1 and method == "POST":
+                return [{"success": {"/lights": "Searching for new devices"}}]
+            if path[1:] == ["new"] and method == "GET":
+                return {"lastscan": "none"}
+            light = self._id(path[1], self.lights)
+            if light is None:
+                return [self._error(3, address, "resource, {}, not available".format(address))]
+            if len(path) == 2 and method == "GET":
+                return self._get_lights()[str(light)]
+            if path[2:] == ["state"] and method == "PUT":
+                return self._set_state([light], body, "/lights/{}/state".format(light))
+        elif path[0] == "groups":
+            if len(path) == 1 and method == "GET":
+                return self._get_groups()
+            if len(path) == 1 and method == "POST":
+                return self._create_group(body)
+            group = self._id(path[1], self.groups)
+            if group is None and path[1] != "0":
+                return [self._error(3, address, "resource, {}, not available".format(address))]
+            lights = sorted(self.lights) if group is None else self.groups[group]["lights"]
+            if len(path) == 2 and method == "GET":
+                return {"name": "Lightset 0" if group is None else self.groups[group]["name"],
+                        "lights": [str(light) for light in lights]}
+            if len(path) == 2 and method == "PUT" and group is not None:
+                return self._set_group_attributes(group, body)
+            if len(path) == 2 and method == "DELETE" and group is not None:
+                del self.groups[group]
+                return [{"success": "/groups/{} deleted".format(group)}]
+            if path[2:] == ["action"] and method == "PUT":
+                return self._set_state(lights, body, "/groups/{}/action".format(path[1]))
+        elif path[0] == "scenes":
+            if len(path) == 1 and method == "GET":
+                return self._get_scenes()
+            if len(path) == 2 and method == "PUT":
+                return self._create_scene(path[1], body)
+            if len(path) == 2 and method == "DELETE" and path[1] in self.scenes:
+                del self.scenes[path[1]]
+                return [{"success": "/scenes/{} deleted".format(path[1])}]
+            if (len(path) == 5 and path[2] == "lights" and path[4] == "state"
+                    and method == "PUT" and path[1] in self.scenes):
+                return self._store_scene_state(path[1], path[3], body)
+
+        return [self._error(4, address, "method, {}, not available for resource, {}".format(
+            method, address))]
+
+    @staticmethod
+    def _id(value, resources):
+        try:
+            value = int(value)
+        except ValueError:
+            return None
+        return value if value in resources else None
+
+    def _get_lights(self):
+        return {str(i): {"state": dict(state), "type": "Extended color light",
+                         "name": "Hue Lamp {}".format(i), "modelid": "LCT001",
+                         "swversion": "66009461"}
+                for i, state in self.lights.items()}
+
+    def _get_groups(self):
+        return {str(i): {"name": group["name"],
+                         "lights": [str(light) for light in group["lights"]]}
+                for i, group in self.groups.items()}
+
+    def _get_scenes(self):
+        return {scene_id: {"name": scene["name"],
+                           "lights": [str(light) for light in sorted(scene["states"])]}
+                for scene_id, scene in self.scenes.items()}
+
+    def _create_group(self, body):
+        if len(self.groups) >= self.max_groups:
+            return [self._error(301, "/groups",
+                                "group could not be created. Group table is full.")]
+        lights = [self._id(light, self.lights) for light in body.get("lights", [])]
+        if None in lights:
+            return [self._error(7, "/groups/lights", "invalid value for parameter, lights")]
+        group = min(set(range(1, self.max_groups + 1)) - set(self.groups))
+        self.groups[group] = {"name": body.get("name", "Group {}".format(group)),
+                              "lights": lights}
+        return [{"success": {"id": "/groups/{}".format(group)}}]
+
+    def _set_group_attributes(self, group, body):
+        result = []
+        if "lights" in body:
+            lights = [self._id(light, self.lights) for light in body["lights"]]
+            if None in lights:
+                return [self._error(7, "/groups/{}/lights".format(group),
+                                    "invalid value for parameter, lights")]
+            self.groups[group]["lights"] = lights
+            result.append({"success": {"/groups/{}/lights".format(group): body["lights"]}})
+        if "name" in body:
+            self.groups[group]["name"] = body["name"]
+            result.append({"success": {"/groups/{}/name".format(group): body["name"]}})
+        return result
+
+    def _create_scene(self, scene_id, body):
+        if scene_id not in self.scenes and len(self.scenes) >= self.max_scenes:
+            return [self._error(301, "/scenes", "scene could not be created. "
+                                                "Scene table is full.")]
+        lights = [self._id(light, self.lights) for light in body.get("lights", [])]
+        if None in lights:
+            return [self._error(7, "/scenes/lights", "invalid value for parameter, lights")]
+        self.scenes[scene_id] = {"name": body.get("name", ""),
+                                 "states": {light: {k: v for k, v in self.lights[light].items()
+                                                    if k in ("on", "bri", "hue", "sat")}
+                                            for light in lights}}
+        return [{"success": {"id": scene_id}}]
+
+    def _store_scene_state(self, scene_id, light, body):
+        states = self.scenes[scene_id]["states"]
+        light = self._id(light, states)
+        if light is None:
+            return [self._error(3, "/scenes/{}/lights".format(scene_id),
+                                "resource not available")]
+        states[light].update(body)
+        return [{"success": {"/scenes/{}/lights/{}/state/{}".format(scene_id, light, k): v}}
+                for k, v in body.items()]
+
+    def _set_state(self, lights, body, address):
+        result = []
+        if "scene" in body:
+            scene = self.scenes.get(body["scene"])
+            if scene is None:
+                return [self._error(7, address + "/scene", "invalid value, {}, for parameter, "
+                                                           "scene".format(body["scene"]))]
+            for light, state in scene["states"].items():
+                self._apply(light, state)
+        for k, v in body.items():
+            if k not in self.statekeys:
+                result.append(self._error(6, "{}/{}".format(address, k),
+                                          "parameter, {}, not available".format(k)))
+                continue
+            if k in ("on", "transitiontime", "scene") or body.get("on") is True:
+                targets = lights
+            else:
+                # lights that are turned off ignore other state changes
+                targets = [light for light in lights if self.lights[light]["on"]]
+            if len(targets) == 0 and address.startswith("/lights"):
+                result.append(self._error(201, "{}/{}".format(address, k),
+                                          "parameter, {}, is not modifiable. "
+                                          "Device is set to off.".format(k)))
+            else:
+                result.append({"success": {"{}/{}".format(address, k): v}})
+                for light in targets:
+                    self._apply(light, {k: v})
+        return result
+
+    def _apply(self, light, state):
+        current = self.lights[light]
+        for k, v in state.items():
+            if k in ("transitiontime", "scene"):
+                continue
+            current[k] = v
+            if k in ("hue", "sat"):
+                current["colormode"] = "hs"
+            elif k in ("xy", "ct"):
+                current["colormode"] = k
+
+
+class LRUCache:
+    """A mapping holding at most ``maxsize`` entries.
+
+    Looking up an entry using `get` marks it as recently used; when the cache is full,
+    adding a new entry evicts the least recently used one.
+    """
+    def __init__(self, maxsize=None):
+        """Initializes the `LRUCache`.
+
+        :param int maxsize: The maximum number of entries, or `None` for no limit.
+        """
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        """Iterate over the keys, from least to most recently used."""
+        return iter(self._data)
+
+    def items(self):
+        """Return a list of ``(key, value)`` pairs, from least to most recently used."""
+        return list(self._data.items())
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key, value):
+        """Add or replace an entry, marking it as the most recently used.
+
+        :return: The evicted ``(key, value)`` pair if an entry was evicted; `None` otherwise.
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            return self._data.popitem(last=False)
+        return None
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def popitem(self):
+        """Remove and return the least recently used ``(key, value)`` pair."""
+        return self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class GroupPool:
+    """A bounded pool of light groups created on demand for a `Bridge`.
+
+    Sets of lights that are repeatedly changed to the same state are given a group of
+    their own on the bridge, so that later changes can be sent to all of them using
+    a single group command. A bridge can only hold a limited number of groups; when
+    no more groups fit, the least recently used pooled group is deleted to make room.
+    Groups not created by the pool are never deleted.
+    """
+    groupname = "playhouse pool"
+
+    def __init__(self, bridge, max_groups=16):
+        """Initializes the `GroupPool`.
+
+        :param Bridge bridge: The bridge to create groups on.
+        :param int max_groups: The maximum number of groups the bridge can hold,
+                               including groups not created by the pool.
+        """
+        self.bridge = bridge
+        self.max_groups = max_groups
+        self.groups = LRUCache()
+        self._candidates = LRUCache(64)
+        self._creating = set()
+        # groups managed elsewhere, which must not be used for other state changes
+        self.reserved = set()
+
+    def adopt(self, group, lights):
+        """Add an existing group on the bridge to the pool.
+
+        :param int group: ID of the group.
+        :param lights: IDs of the lights in the group.
+        """
+        self.groups.put(frozenset(lights), group)
+
+    def clear(self):
+        self.groups.clear()
+        self._candidates.clear()
+
+    def discard(self, group):
+        """Remove a group from the pool, if present, without deleting it from the bridge."""
+        for key, pooled in self.groups.items():
+            if pooled == group:
+                self.groups.pop(key)
+
+    def find(self, lights):
+        """Find a group consisting of exactly the given lights.
+
+        If no such group exists and the same set of lights has been looked up before,
+        a new pooled group is created in the background for use by later lookups.
+
+        :param lights: IDs of the lights.
+        :return: The group ID, or `None` if there is no matching group yet.
+        """
+        key = frozenset(lights)
+        group = self._lookup(key)
+        if group is not None:
+            return group
+
+        if self._candidates.pop(key) is not None:
+            self._create(key)
+        else:
+            self._candidates.put(key, True)
+        return None
+
+    @tornado.gen.coroutine
+    def prepare(self, lights):
+        """Make sure a group consisting of exactly the given lights exists, creating one
+        right away if necessary, rather than once the same lights have been looked up
+        twice as with `find`.
+
+        :param lights: IDs of the lights.
+        :return: A `tornado.concurrent.Future` that resolves to the group ID, or `None`
+                 if no group could be created.
+        """
+        key = frozenset(lights)
+        group = self._lookup(key)
+        if group is None:
+            yield self._create(key)
+            group = self._lookup(key)
+        return group
+
+    def _lookup(self, key):
+        if self.bridge.is_all_lights(key):
+            return 0
+
+        group = self.groups.get(key)
+        if group is not None:
+            return group
+        for group, members in self.bridge.groups.items():
+            if (len(members) == len(key) and key == frozenset(members) and
+                    group not in self.reserved):
+                return group
+        return None
+
+    @tornado.gen.coroutine
+    def _create(self, key):
+        if key in self._creating:
+            return
+        self._creating.add(key)
+        try:
+            while len(self.bridge.groups) + len(self._creating) > self.max_groups:
+                group = self._evictable()
+                if group is None:
+                    logging.debug("No room for a new group on %s", self.bridge.serial_number)
+                    return
+                yield self.bridge.delete_group(group)
+            res = yield self.bridge.create_group(sorted(key), name=self.groupname)
+            self.groups.put(key, _group_id(res))
+        except (HueAPIException, tornado.httpclient.HTTPError):
+            logging.warning("Couldn't create a pooled group on %s", self.bridge.serial_number,
+                            exc_info=True)
+        finally:
+            self._creating.discard(key)
+
+    def _evictable(self):
+        for key, group in self.groups.items():
+            # don't delete a group while a command to it is still waiting to be sent
+            if '/groups/{}/action'.format(group) not in self.bridge.queue:
+                self.groups.pop(key)
+                return group
+        return None
+
+
+class _Scene:
+    """A scene stored on a bridge by a `SceneCache`."""
+    __slots__ = ("id", "states")
+
+    def __init__(self, scene_id, states):
+        self.id = scene_id
+        self.states = states
+
+
+class SceneCache:
+    """Keeps track of the scenes stored on a single `Bridge`.
+
+    A scene stores the states of a number of lights on the bridge itself, so that all
+    of the lights can later be changed back to those states using a single command.
+    The bridge has room for a limited number of scenes and light states; when a new
+    scene does not fit, it overwrites the least recently recalled scene, and any further
+    scenes that have to make room for it are deleted from the bridge.
+    """
+    idprefix = "playhouse"
+
+    def __init__(self, bridge, max_scenes=200, max_lightstates=2048):
+        """Initializes the `SceneCache`.
+
+        :param Bridge bridge: The bridge to store scenes on.
+        :param int max_scenes: The maximum number of scenes the bridge can hold.
+        :param int max_lightstates: The maximum number of light states the bridge can hold
+                                    in total for all scenes.
+        """
+        self.bridge = bridge
+        self.max_scenes = max_scenes
+        self.max_lightstates = max_lightstates
+        self.scenes = LRUCache()
+
+        self._lightstates = 0
+        self._free_ids = []
+        self._next_id = 0
+
+    def __contains__(self, name):
+        return name in self.scenes
+
+    def is_current(self, name, states):
+        """Check whether the scene with the given name is stored with the given light states.
+
+        :param str name: Name of the scene.
+        :param dict states: Dictionary of light ID -> Hue state pairs.
+        """
+        scene = self.scenes.pop(name)
+        if scene is None:
+            return False
+        self.scenes.put(name, scene)
+        return scene.states == states
+
+    @tornado.gen.coroutine
+    def store(self, name, states):
+        """Store a scene on the bridge, replacing any scene with the same name.
+
+        Nothing is sent to the bridge if the scene is already stored with the same states.
+
+        :param str name: Name of the scene.
+        :param dict states: Dictionary of light ID -> Hue state pairs.
+        :return: A `tornado.concurrent.Future` that completes when the scene has been stored.
+        :raises: `tornado.httpclient.HTTPError` if an HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        if self.is_current(name, states):
+            return
+
+        scene = self.scenes.pop(name)
+        if scene is not None:
+            self._lightstates -= len(scene.states)
+
+        evicted = []
+        while len(self.scenes) > 0 and (
+                len(self.scenes) >= self.max_scenes or
+                self._lightstates + len(states) > self.max_lightstates):
+            _, old = self.scenes.popitem()
+            logging.debug("Evicting scene %s from %s", old.id, self.bridge.serial_number)
+            self._lightstates -= len(old.states)
+            evicted.append(old)
+
+        if scene is None:
+            # overwrite an evicted scene on the bridge, whose scene table may be full
+            scene = _Scene(evicted.pop().id if len(evicted) > 0 else self._new_id(), None)
+        for old in evicted:
+            self._delete(old.id)
+
+        url = "/scenes/{}".format(scene.id)
+        try:
+            yield self.bridge.queue.put(url, {"name": name[:32],
+                                              "lights": [str(light) for light in sorted(states)]},
+                                        confirm=True)
+            yield [self.bridge.queue.put("{}/lights/{}/state".format(url, light), state,
+                                         confirm=True)
+                   for light, state in states.items()]
+        except Exception:
+            self._free_ids.append(scene.id)
+            raise
+
+        scene.states = states
+        self.scenes.put(name, scene)
+        self._lightstates += len(states)
+
+    def recall(self, name):
+        """Change every light in a stored scene to its stored state.
+
+        :param str name: Name of the scene.
+        :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
+                 converted from JSON to a Python dictionary, when complete.
+        :raises: `KeyError` if no scene with the given name is stored on the bridge.
+        """
+        scene = self.scenes.get(name)
+        if scene is None:
+            raise KeyError(name)
+
+        for light, state in scene.states.items():
+            for k, v in state.items():
+                if k not in self.bridge.ignoredkeys:
+                    self.bridge.light_data[light][k] = v
+        self.bridge.state_version += 1
+        self.bridge.external_version += 1
+
+        return self.bridge.queue.put("/groups/0/action", {"scene": scene.id})
+
+    @tornado.gen.coroutine
+    def _delete(self, scene_id):
+        try:
+            yield self.bridge.send_request("DELETE", "/scenes/{}".format(scene_id),
+                                           priority=CommandQueue.BACKGROUND)
+        except (HueAPIException, tornado.httpclient.HTTPError):
+            logging.warning("Couldn't delete scene %s from %s", scene_id,
+                            self.bridge.serial_number, exc_info=True)
+        # even if still on the bridge, the scene is overwritten when its ID is reused
+        self._free_ids.append(scene_id)
+
+    def clear(self):
+        """Forget about all stored scenes. The scenes themselves are left on the bridge."""
+        self.scenes.clear()
+        self._lightstates = 0
+        self._free_ids = []
+        self._next_id = 0
+
+    def _new_id(self):
+        if len(self._free_ids) > 0:
+            return self._free_ids.pop()
+        self._next_id += 1
+        return "{}{}".format(self.idprefix, self._next_id)
+
+
+class RTTEstimator:
+    """Keeps a running estimate of the round-trip time of requests to a bridge,
+    and derives request timeouts from it.
+
+    The estimate is a moving average of the round-trip time together with a moving
+    average of its deviation, in the same way as TCP computes its retransmission
+    timeout (RFC 6298). Each timeout doubles the timeout used for the following
+    requests, until a request completes in time again.
+    """
+    alpha = 1 / 8
+    beta = 1 / 4
+    max_backoff = 8
+    # the largest fraction of the timeout in use that the estimate may take up for a
+    # timed out request to be retried
+    retry_fraction = 1 / 2
+
+    def __init__(self, initial=2, minimum=0.25, maximum=10):
+        """Initializes the `RTTEstimator`.
+
+        :param float initial: The timeout to use before any round trips have been measured.
+        :param float minimum: The lowest timeout to ever use.
+        :param float maximum: The highest timeout to ever use.
+        """
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+
+    def sample(self, rtt):
+        """Update the estimate with the round-trip time of a completed request.
+
+        :param float rtt: The measured round-trip time in seconds.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.backoff = 1
+
+    def timed_out(self):
+        """Register that a request timed out, increasing the timeout."""
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    @property
+    def timeout(self):
+        """The time in seconds to wait for the next request to complete."""
+        if self.srtt is None:
+            base = self.initial
+        else:
+            base = self.srtt + 4 * self.rttvar
+        return max(self.minimum, min(self.maximum, base * self.backoff))
+
+    def should_retry(self):
+        """Whether a request that just timed out is worth retrying.
+
+        A timeout is more likely to be caused by a busy bridge than by an unreachable one
+        if the bridge answered the request before it, and its estimated round-trip time
+        including deviation is within `retry_fraction` of the timeout now in use.
+        Consecutive timeouts are not retried, so that an unreachable bridge is given up
+        on quickly however fast it used to answer.
+
+        Call after `timed_out`.
+        """
+        return (self.srtt is not None and self.backoff <= 2 and
+                self.srtt + 4 * self.rttvar <= self.retry_fraction * self.timeout)
+
+
+class CircuitBreaker:
+    """Keeps track of whether a bridge is reachable, so that requests to an unreachable
+    bridge can fail immediately instead of waiting for a timeout.
+
+    The breaker starts out closed. After ``threshold`` consecutive requests have failed
+    to reach the bridge, it opens, and requests are rejected without being sent. After
+    a delay the breaker becomes half-open, allowing a single probe request through;
+    if the probe succeeds the breaker closes again, otherwise it reopens, doubling the
+    delay up to ``max_delay``.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=3, delay=1, max_delay=30):
+        """Initializes the `CircuitBreaker`.
+
+        :param int threshold: The number of consecutive failures after which to open.
+        :param float delay: The time in seconds to stay open before the first probe.
+        :param float max_delay: The longest time in seconds to stay open between probes.
+        """
+        self.threshold = threshold
+        self.delay = delay
+        self.max_delay = max_delay
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_delay = delay
+        self.opened = 0
+        self.failed_probes = 0
+
+    @property
+    def closed(self):
+        """Whether requests may be sent normally."""
+        return self.state == self.CLOSED
+
+    def succeeded(self):
+        """Register that a request reached the bridge, closing the breaker."""
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retry_delay = self.delay
+
+    def failed(self):
+        """Register that a request failed to reach the bridge.
+
+        :return: `True` if the breaker opened as a result; `False` otherwise.
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.failed_probes += 1
+            self.state = self.OPEN
+            self.retry_delay = min(self.retry_delay * 2, self.max_delay)
+        elif self.state == self.CLOSED and self.failures >= self.threshold:
+            self.state = self.OPEN
+            self.opened += 1
+            return True
+        return False
+
+    def half_open(self):
+        """Allow a probe request through after the breaker has been open."""
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+
+
+class BridgeMetrics:
+    """Counters describing the traffic to a single `Bridge`.
+
+    Recording a measurement only increments a counter, so that it is cheap enough to do
+    for every request; the counters are only collected into samples, along with the
+    state of the bridge's queue, when they are exported using `samples`.
+    """
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    # metric name -> (type, help text), in the order in which they are exported
+    descriptions = collections.OrderedDict([
+        ("playhouse_bridge_requests_total",
+         ("counter", "Requests sent to the bridge, by HTTP method.")),
+        ("playhouse_bridge_request_bytes_total",
+         ("counter", "Request body bytes sent to the bridge.")),
+        ("playhouse_bridge_request_duration_seconds",
+         ("histogram", "Time until the bridge responded to a request.")),
+        ("playhouse_bridge_errors_total",
+         ("counter", "Failed requests (type http) and Hue API errors, by error type.")),
+        ("playhouse_bridge_deduplicated_total",
+         ("counter", "State changes not sent since the light was already in that state.")),
+        ("playhouse_bridge_merged_total",
+         ("counter", "State changes merged into a command waiting in the queue.")),
+        ("playhouse_bridge_commands_sent_total",
+         ("counter", "Commands sent from the queue.")),
+        ("playhouse_bridge_queue_depth",
+         ("gauge", "Commands waiting in the queue, by lane.")),
+        ("playhouse_bridge_in_flight",
+         ("gauge", "Commands waiting for a response from the bridge.")),
+        ("playhouse_bridge_breaker_open",
+         ("gauge", "Whether the bridge is considered unreachable.")),
+        ("playhouse_bridge_breaker_opened_total",
+         ("counter", "Times the bridge has been found unreachable.")),
+    ])
+
+    def __init__(self, bridge):
+        """Initializes the `BridgeMetrics`.
+
+        :param Bridge bridge: The bridge whose traffic is measured.
+        """
+        self.bridge = bridge
+        self.requests = collections.Counter()
+        # Hue error type, or "http" for failed requests -> number of errors
+        self.errors = collections.Counter()
+        self.deduplicated = 0
+        self.bytes_sent = 0
+        # the last bucket counts the requests slower than every bucket bound
+        self.latency_counts = [0] * (len(self.latency_buckets) + 1)
+        self.latency_sum = 0
+
+    def request(self, method, body):
+        """Register a request sent to the bridge.
+
+        :param str method: HTTP request method.
+        :param body: The request body, if any.
+        """
+        self.requests[method] += 1
+        if body:
+            self.bytes_sent += len(body)
+
+    def observe(self, seconds):
+        """Register the time it took the bridge to respond to a request.
+
+        :param float seconds: The round-trip time in seconds.
+        """
+        self.latency_counts[bisect.bisect_left(self.latency_buckets, seconds)] += 1
+        self.latency_sum += seconds
+
+    def samples(self):
+        """Collect the current values of the metrics.
+
+        :return: A dictionary of metric name -> list of ``(suffix, labels, value)``
+                 samples, where ``suffix`` is appended to the metric name and ``labels``
+                 is a tuple of ``(label, value)`` pairs. The metric names are those in
+                 `descriptions`.
+        :rtype: `dict`
+        """
+        queue = self.bridge.queue
+        buckets = []
+        total = 0
+        for bound, count in zip(self.latency_buckets + ("+Inf",), self.latency_counts):
+            total += count
+            buckets.append(("_bucket", (("le", str(bound)),), total))
+        errors = []
+        for error_type, count in sorted(self.errors.items(), key=lambda item: str(item[0])):
+            name = "http" if error_type == "http" else \
+                HUE_ERRORS.get(error_type, HueAPIException).__name__
+            errors.append(("", (("type", str(error_type)), ("error", name)), count))
+
+        return {
+            "playhouse_bridge_requests_total": [
+                ("", (("method", method),), count)
+                for method, count in sorted(self.requests.items())],
+            "playhouse_bridge_request_bytes_total": [("", (), self.bytes_sent)],
+            "playhouse_bridge_request_duration_seconds": buckets + [
+                ("_sum", (), self.latency_sum), ("_count", (), total)],
+            "playhouse_bridge_errors_total": errors,
+            "playhouse_bridge_deduplicated_total": [("", (), self.deduplicated)],
+            "playhouse_bridge_merged_total": [("", (), queue.merged)],
+            "playhouse_bridge_commands_sent_total": [("", (), queue.sent)],
+            "playhouse_bridge_queue_depth": [
+                ("", (("lane", CommandQueue.INTERACTIVE),), queue.depth),
+                ("", (("lane", CommandQueue.BACKGROUND),), queue.background_depth)],
+            "playhouse_bridge_in_flight": [("", (), queue.in_flight)],
+            "playhouse_bridge_breaker_open": [
+                ("", (), 0 if self.bridge.breaker.closed else 1)],
+            "playhouse_bridge_breaker_opened_total": [("", (), self.bridge.breaker.opened)],
+        }
+
+
+class _Command:
+    """A state change or other request waiting in a `CommandQueue`."""
+    __slots__ = ("url", "light", "group", "args", "futures", "confirm", "send", "queued")
+
+    def __init__(self, url, light, group, args, future, confirm, send=None):
+        self.url = url
+        self.light = light
+        self.group = group
+        self.args = args
+        self.futures = [future]
+        self.confirm = confirm
+        # for requests other than state changes, a callable sending the request
+        self.send = send
+        # when the command took its place in the queue; see CommandQueue._overtaken
+        self.queued = 0
+
+
+class CommandQueue:
+    """Outbound queue of state changes for a single `Bridge`.
+
+    Hue bridges can only process around ten light commands per second; commands sent
+    beyond that are dropped or delayed by the bridge itself. Instead, state changes are
+    queued here and sent to the bridge at a rate of at most ``rate`` commands per second.
+    A state change for a light or group that is still waiting in the queue is merged
+    into the pending command, with later values overriding earlier ones, so that an
+    overloaded bridge is sent fewer and more recent commands. The merged command keeps
+    its place in the queue, unless a command affecting the same lights, such as a group
+    command, was queued after it; it then moves to the back, so that it isn't
+    overridden by the older command.
+
+    At most ``window`` commands are in flight at any time; the remaining state changes
+    are kept in the queue until earlier commands have completed.
+
+    Commands are queued in one of two lanes. `INTERACTIVE` commands, such as changes
+    requested by users, are sent before any `BACKGROUND` commands, such as pings,
+    blinking and syncing, except that at least a ``background_share`` fraction of the
+    commands sent while both lanes are busy are taken from the background lane, so that
+    background work is delayed but never starved.
+    """
+    INTERACTIVE = "interactive"
+    BACKGROUND = "background"
+
+    # keys that have no effect unless sent together with an actual state change
+    passivekeys = {"transitiontime"}
+
+    def __init__(self, bridge, rate=10, window=4, background_share=0.1):
+        """Initializes the `CommandQueue`.
+
+        :param Bridge bridge: The bridge to send commands to.
+        :param float rate: The maximum number of commands to send per second.
+        :param int window: The maximum number of commands waiting for a response
+                           from the bridge at the same time.
+        :param float background_share: The minimum fraction of commands to send from
+                                       the background lane while interactive commands
+                                       are waiting as well.
+        """
+        self.bridge = bridge
+        self.rate = rate
+        self.window = window
+        self.background_share = background_share
+        self.pending = collections.OrderedDict()
+        self.background = collections.OrderedDict()
+        # number of interactive commands sent ahead of waiting background commands
+        self._skipped = 0
+
+        self.in_flight = 0
+        self.merged = 0
+        self.sent = 0
+        # light ID -> value of `sent` when a command affecting the light was last sent
+        self.touched = {}
+        # counter ordering the state changes in the queue, and light ID -> its value
+        # when a light or group command affecting the light last took its place in the
+        # queue; commands affecting every light, such as scene recalls, are recorded
+        # in _everything_queued
+        self._queued = 0
+        self._light_queued = {}
+        self._group_queued = {}
+        self._everything_queued = 0
+
+        self._waiters = []
+
+        self._tokens = rate
+        self._last_refill = None
+        self._timeout_handle = None
+        self.ioloop = tornado.ioloop.IOLoop.current()
+
+    def __contains__(self, url):
+        return url in self.pending or url in self.background
+
+    @property
+    def depth(self):
+        """The number of interactive commands currently waiting to be sent."""
+        return len(self.pending)
+
+    @property
+    def background_depth(self):
+        """The number of background commands currently waiting to be sent."""
+        return len(self.background)
+
+    @property
+    def saturated(self):
+        """Whether commands are waiting to be sent, or as many commands as allowed
+        are in flight."""
+        return (len(self.pending) > 0 or len(self.background) > 0 or
+                self.in_flight >= self.window)
+
+    def wait(self, depth=0):
+        """Wait for the queue to shrink.
+
+        :param int depth: The number of commands that may still be waiting to be sent.
+        :return: A `tornado.concurrent.Future` that completes as soon as no more than
+                 ``depth`` commands are waiting to be sent.
+        """
+        future = tornado.concurrent.TracebackFuture()
+        if self.depth <= depth:
+            future.set_result(None)
+        else:
+            self._waiters.append((depth, future))
+        return future
+
+    def _notify_waiters(self):
+        if len(self._waiters) == 0:
+            return
+        waiters, self._waiters = self._waiters, []
+        for depth, future in waiters:
+            if self.depth <= depth:
+                future.set_result(None)
+            else:
+                self._waiters.append((depth, future))
+
+    def put(self, url, args, light=None, group=None, confirm=False, priority=INTERACTIVE):
+        """Queue a state change.
+
+        :param str url: The URL to send the state change to, relative to ``/api/<username>``.
+        :param dict args: Hue state changes.
+        :param int light: ID of the light whose state is changed, if any.
+        :param group: IDs of the lights affected by the state change if it is sent to a group.
+                      Any pending changes to these lights that are overridden by ``args``
+                      are discarded.
+        :param bool confirm: Whether to always wait for and check the response from the
+                             bridge, even if the bridge is set to `fire_and_forget` mode.
+        :param str priority: The lane to queue the state change in; `INTERACTIVE` or
+                             `BACKGROUND`. A state change merged with a pending command
+                             is sent in the more urgent of their lanes.
+        :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
+                 converted from JSON to a Python dictionary, when the command has been sent.
+                 In `fire_and_forget <Bridge.fire_and_forget>` mode, the future instead
+                 resolves to `None` as soon as the command has been written.
+                 If the bridge's `CircuitBreaker` is open, the future fails right away
+                 with `BridgeUnavailableException`.
+        """
+        future = tornado.concurrent.TracebackFuture()
+
+        if not self.bridge.breaker.closed:
+            self.bridge._forget_state([light] if group is None else group, args)
+            future.set_exception(BridgeUnavailableException(self.bridge))
+            return future
+
+        if group is not None:
+            self._discard_overridden(group, args, future)
+
+        lane = self.pending if priority == self.INTERACTIVE else self.background
+        command = self.pending.get(url)
+        if command is None:
+            command = self.background.get(url)
+        if command is not None:
+            command.args.update(args)
+            command.futures.append(future)
+            command.confirm = command.confirm or confirm
+            if lane is self.pending and url in self.background:
+                # an interactive caller must not wait behind background traffic
+                self.pending[url] = self.background.pop(url)
+                self._took_place(command)
+            elif self._overtaken(command):
+                # sent in its old place, the merged command would be overridden by
+                # commands queued in the meantime
+                (self.pending if url in self.pending else self.background).move_to_end(url)
+                self._took_place(command)
+            self.merged += 1
+        elif set(args) <= self.passivekeys:
+            future.set_result([])
+            return future
+        else:
+            command = lane[url] = _Command(url, light, group, dict(args), future, confirm)
+            self._took_place(command)
+
+        self._dispatch()
+        return future
+
+    def _took_place(self, command):
+        self._queued += 1
+        command.queued = self._queued
+        if command.light is not None:
+            self._light_queued[command.light] = self._queued
+        elif command.group is not None:
+            for light in command.group:
+                self._group_queued[light] = self._queued
+        else:
+            self._everything_queued = self._queued
+
+    def _overtaken(self, command):
+        """Check whether a state change affecting any of the lights of a queued command
+        has taken its place in the queue after the command."""
+        queued = command.queued
+        if command.light is not None:
+            return max(self._group_queued.get(command.light, 0),
+                       self._everything_queued) > queued
+        elif command.group is not None:
+            return self._everything_queued > queued or any(
+                self._light_queued.get(light, 0) > queued or
+                self._group_queued.get(light, 0) > queued for light in command.group)
+        return self._queued > queued
+
+    def request(self, method, url, body=None, timeout=None, priority=BACKGROUND):
+        """Queue a request other than a state change.
+
+        Identical ``GET`` requests waiting in the queue are merged into one.
+
+        :param str method: HTTP request method (POST/GET/PUT/DELETE).
+        :param str url: The full URL to send the request to, including ``/api/<username>``.
+        :param dict body: HTTP request body as a Python dictionary.
+        :param int timeout: The time to wait for the request to complete; see
+                            `Bridge.send_raw`.
+        :param str priority: The lane to queue the request in; `INTERACTIVE` or `BACKGROUND`.
+                             A request merged with a waiting one is sent in the more
+                             urgent of their lanes.
+        :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
+                 converted from JSON to a Python dictionary, when complete.
+        """
+        future = tornado.concurrent.TracebackFuture()
+
+        if not self.bridge.breaker.closed:
+            future.set_exception(BridgeUnavailableException(self.bridge))
+            return future
+
+        lane = self.pending if priority == self.INTERACTIVE else self.background
+        # requests are keyed so that they never clash with state changes to the same URL
+        key = (method, url) if method == "GET" else (method, url, future)
+        command = self.pending.get(key)
+        if command is None:
+            command = self.background.get(key)
+            if command is not None and lane is self.pending:
+                # an interactive caller must not wait behind background traffic
+                self.pending[key] = self.background.pop(key)
+        if command is not None:
+            command.futures.append(future)
+            self.merged += 1
+        else:
+            lane[key] = _Command(url, None, None, None, future, True, functools.partial(
+                self.bridge.send_raw, method, url, body, timeout))
+
+        self._dispatch()
+        return future
+
+    def _discard_overridden(self, group, args, future):
+        keys = set(args) - self.passivekeys
+        lights = set(group)
+        for lane in (self.pending, self.background):
+            for url, command in list(lane.items()):
+                if command.light is None or command.light not in lights:
+                    continue
+                for k in keys:
+                    command.args.pop(k, None)
+                if set(command.args) <= self.passivekeys:
+                    # nothing left to send; complete along with the group command instead
+                    del lane[url]
+                    for waiting in command.futures:
+                        tornado.concurrent.chain_future(future, waiting)
+                    self.merged += 1
+        self._notify_waiters()
+
+    def _on_timeout(self):
+        self._timeout_handle = None
+        self._dispatch()
+
+    def pending_lights(self):
+        """Return the set of IDs of the lights affected by commands waiting to be sent."""
+        lights = set()
+        for command in itertools.chain(self.pending.values(), self.background.values()):
+            if command.light is not None:
+                lights.add(command.light)
+            elif command.group is not None:
+                lights.update(command.group)
+        return lights
+
+    def spare(self):
+        """Claim room for one request sent to the bridge outside of the queue.
+
+        Room is only available if no commands are waiting to be sent, so that
+        requests such as background refreshes never delay state changes, and never
+        while the bridge is unavailable.
+
+        :return: `True` if the request may be sent now; `False` otherwise.
+        """
+        self._refill()
+        if self.saturated or self._tokens < 1 or not self.bridge.breaker.closed:
+            return False
+        self._tokens -= 1
+        return True
+
+    def _refill(self):
+        now = self.ioloop.time()
+        if self._last_refill is not None:
+            self._tokens = min(self.rate,
+                               self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        return now
+
+    def _dispatch(self):
+        now = self._refill()
+
+        while self._tokens >= 1 and self.in_flight < self.window:
+            lane = self._next_lane()
+            if lane is None:
+                break
+            _, command = lane.popitem(last=False)
+            self._tokens -= 1
+            self._send(command)
+        self._notify_waiters()
+
+        # once the window is full, the next completed command triggers a new dispatch
+        if ((len(self.pending) > 0 or len(self.background) > 0) and
+                self.in_flight < self.window and self._timeout_handle is None):
+            self._timeout_handle = self.ioloop.add_timeout(
+                now + (1 - self._tokens) / self.rate, self._on_timeout)
+
+    def _next_lane(self):
+        if len(self.background) == 0:
+            return self.pending if len(self.pending) > 0 else None
+        if len(self.pending) == 0:
+            return self.background
+        # both lanes are busy; let background commands earn their share of the budget
+        self._skipped += 1
+        if self._skipped * self.background_share >= 1:
+            self._skipped = 0
+            return self.background
+        return self.pending
+
+    def _send(self, command):
+        self.sent += 1
+        self.in_flight += 1
+        if command.light is not None:
+            self.touched[command.light] = self.sent
+        elif command.group is not None:
+            for light in command.group:
+                self.touched[light] = self.sent
+        try:
+            if command.send is not None:
+                future = command.send()
+            elif self.bridge.fire_and_forget and not command.confirm:
+                lights = [command.light] if command.group is None else command.group
+                future = self.bridge.send_nowait("PUT", command.url, body=command.args,
+                                                 lights=lights)
+            else:
+                future = self.bridge.send_request("PUT", command.url, body=command.args)
+        except Exception: # pylint: disable=broad-except
+            future = tornado.concurrent.TracebackFuture()
+            future.set_exc_info(sys.exc_info())
+        for waiting in command.futures:
+            tornado.concurrent.chain_future(future, waiting)
+        self.ioloop.add_future(future, functools.partial(self._on_sent, command))
+
+    def _on_sent(self, command, future):
+        self.in_flight -= 1
+        if future.exception() is not None and command.send is None:
+            # the bridge may not have applied the change, so don't assume it did
+            self.bridge._forget_state([command.light] if command.group is None
+                                      else command.group, command.args)
+        self._dispatch()
+
+
+class StateSync:
+    """Keeps the shadow state of a `Bridge` in sync with the bridge itself.
+
+    Rather than fetching the full bridge state, only ``/lights``, ``/groups`` or
+    individual lights are fetched, and the results are merged into the bridge's
+    `light_data <Bridge.light_data>` and `groups <Bridge.groups>`. Lights that have
+    state changes waiting in the bridge's `CommandQueue`, or that were sent a command
+    while the request was in progress, are left untouched, since the bridge's answer
+    may not reflect the latest changes yet.
+
+    Once started, the sync refreshes one light at a time in round-robin order,
+    using only room in the command budget that isn't needed for state changes.
+    Lights whose shadow state can't be trusted can also be handed to `verify`,
+    which refreshes them one by one in the same way.
+    """
+    def __init__(self, bridge):
+        """Initializes the `StateSync`.
+
+        :param Bridge bridge: The bridge to keep in sync.
+        """
+        self.bridge = bridge
+        self.selected = None
+        self.refreshed = 0
+        self.unverified = set()
+
+        self._next = 0
+        self._refreshing = False
+        self._verifying = False
+        self._timer = None
+
+    def select(self, lights):
+        """Choose the lights to refresh periodically.
+
+        :param lights: IDs of the lights, or `None` to refresh all lights.
+        """
+        self.selected = sorted(lights) if lights is not None else None
+        self._next = 0
+
+    def start(self, interval):
+        """Start refreshing lights periodically.
+
+        :param float interval: The time in seconds between refreshing two lights.
+        """
+        if self._timer is not None:
+            self._timer.stop()
+        self._timer = tornado.ioloop.PeriodicCallback(self._tick, interval * 1000)
+        self._timer.start()
+
+    def stop(self):
+        """Stop refreshing lights, including any lights waiting to be verified."""
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self.unverified.clear()
+
+    def verify(self, lights):
+        """Refresh the given lights one at a time in the background, as soon as there is
+        room in the command budget. Lights that are synced in the meantime, for example
+        by `sync_lights`, are not refreshed again.
+
+        :param lights: IDs of the lights.
+        """
+        self.unverified.update(lights)
+        if not self._verifying:
+            self._verify()
+
+    @tornado.gen.coroutine
+    def _verify(self):
+        self._verifying = True
+        ioloop = tornado.ioloop.IOLoop.current()
+        try:
+            while len(self.unverified) > 0:
+                if not self.bridge.logged_in or not self.bridge.queue.spare():
+                    yield tornado.gen.Task(ioloop.add_timeout,
+                                           ioloop.time() + 1 / self.bridge.queue.rate)
+                    continue
+                light = min(self.unverified)
+                self.unverified.discard(light)
+                try:
+                    yield self.refresh([light])
+                except (HueAPIException, tornado.httpclient.HTTPError):
+                    logging.debug("Couldn't verify light %s on %s", light,
+                                  self.bridge.serial_number, exc_info=True)
+        finally:
+            self._verifying = False
+
+    @tornado.gen.coroutine
+    def sync_lights(self):
+        """Fetch the state of every light and merge it into the shadow state.
+
+        Lights no longer known to the bridge are removed from the shadow state, and
+        `Bridge.all_lights` is set to the IDs of the lights on the bridge.
+
+        :return: A `tornado.concurrent.Future` that resolves to the set of IDs of the
+                 lights whose shadow state changed.
+        :rtype: `set`
+        :raises: `tornado.httpclient.HTTPError` if the HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        sent = self.bridge.queue.sent
+        data = yield self.bridge.send_request("GET", "/lights",
+                                              priority=CommandQueue.BACKGROUND)
+        lights = {int(i): light["state"] for i, light in data.items()}
+        self.bridge.all_lights = frozenset(lights)
+
+        changed = set(self.bridge.light_data) - set(lights)
+        for i in changed:
+            del self.bridge.light_data[i]
+        if len(changed) > 0:
+            self.bridge.state_version += 1
+            self.bridge.external_version += 1
+        changed.update(self._merge(lights, sent))
+        return changed
+
+    @tornado.gen.coroutine
+    def sync_groups(self):
+        """Fetch the list of groups and merge it into `Bridge.groups`, adopting any groups
+        created by a `GroupPool` into the bridge's pool and any group created for
+        blinking lights as the bridge's `blink_group <Bridge.blink>`.
+
+        :return: A `tornado.concurrent.Future` that resolves to the set of IDs of the
+                 groups that were added, changed or removed.
+        :rtype: `set`
+        :raises: `tornado.httpclient.HTTPError` if the HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        data = yield self.bridge.send_request("GET", "/groups",
+                                              priority=CommandQueue.BACKGROUND)
+        groups = self.bridge.groups
+        pool = self.bridge.group_pool
+
+        changed = set(groups) - {int(i) for i in data}
+        for i in changed:
+            del groups[i]
+            pool.discard(i)
+            if i == self.bridge.blink_group:
+                self.bridge._forget_blink_group()
+        for i, group in data.items():
+            i = int(i)
+            lights = [int(x) for x in group["lights"]]
+            if groups.get(i) == lights:
+                continue
+            changed.add(i)
+            groups[i] = lights
+            pool.discard(i)
+            if group.get("name") == GroupPool.groupname:
+                pool.adopt(i, lights)
+            elif group.get("name") == BlinkScheduler.groupname and (
+                    self.bridge.blink_group in (None, i)):
+                self.bridge.blink_group = i
+                self.bridge.blink_members = frozenset(lights)
+                pool.reserved.add(i)
+        return changed
+
+    @tornado.gen.coroutine
+    def refresh(self, lights):
+        """Fetch the state of the given lights and merge it into the shadow state.
+
+        :param lights: IDs of the lights.
+        :return: A `tornado.concurrent.Future` that resolves to the set of IDs of the
+                 lights whose shadow state changed.
+        :rtype: `set`
+        :raises: `tornado.httpclient.HTTPError` if an HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        sent = self.bridge.queue.sent
+        data = yield {i: self.bridge.send_request("GET", "/lights/{}".format(i))
+                      for i in lights}
+        self.refreshed += len(data)
+        return self._merge({i: light["state"] for i, light in data.items()}, sent)
+
+    def _merge(self, lights, sent):
+        queue = self.bridge.queue
+        pending = queue.pending_lights()
+        changed = set()
+        for i, new_state in lights.items():
+            if i in pending or queue.touched.get(i, 0) > sent:
+                continue
+            self.unverified.discard(i)
+            state = self.bridge.light_data[i]
+            for k, v in new_state.items():
+                if k not in self.bridge.ignoredkeys and state.get(k) != v:
+                    state[k] = v
+                    changed.add(i)
+        if len(changed) > 0:
+            self.bridge.state_version += 1
+            self.bridge.external_version += 1
+        return changed
+
+    @tornado.gen.coroutine
+    def _tick(self):
+        lights = self.selected if self.selected is not None else sorted(self.bridge.light_data)
+        if (self._refreshing or len(lights) == 0 or not self.bridge.logged_in or
+                not self.bridge.queue.spare()):
+            return
+
+        light = lights[self._next % len(lights)]
+        self._next = (self._next + 1) % len(lights)
+        self._refreshing = True
+        try:
+            changed = yield self.refresh([light])
+            if len(changed) > 0:
+                logging.debug("Light %s on %s was changed outside of playhouse",
+                              light, self.bridge.serial_number)
+        except (HueAPIException, tornado.httpclient.HTTPError):
+            logging.debug("Couldn't refresh light %s on %s", light, self.bridge.serial_number,
+                          exc_info=True)
+        finally:
+            self._refreshing = False
+
+
+class BlinkScheduler:
+    """Keeps the lights in `Bridge.blinking_lights` blinking.
+
+    A light told to blink only does so for 15 seconds, so the blinking has to be
+    refreshed periodically. The refreshes of different bridges are spread over the
+    period by staggering the time each bridge is first due, and the refresh of
+    a bridge is postponed while its `CommandQueue` has no room to spare. Each bridge
+    keeps its blinking lights in a group of their own, so that they can be refreshed
+    using a single group command; see `Bridge.blink`.
+
+    Each `LightGrid` has a scheduler shared by its bridges; a bridge created on its own
+    has a scheduler of its own.
+    """
+    groupname = "playhouse blink"
+
+    def __init__(self, period=15, resolution=0.5):
+        """Initializes the `BlinkScheduler`.
+
+        :param float period: The time in seconds between refreshes of a single bridge.
+        :param float resolution: The time in seconds between two refreshes.
+        """
+        self.period = period
+        self.resolution = resolution
+        self.bridges = {}
+        self._added = 0
+        self._timer = tornado.ioloop.PeriodicCallback(self._tick, resolution * 1000)
+
+    def add(self, bridge):
+        """Start refreshing the blinking lights of a bridge."""
+        offset = (self._added * self.resolution) % self.period
+        self._added += 1
+        self.bridges[bridge] = tornado.ioloop.IOLoop.current().time() + offset
+        if len(self.bridges) == 1:
+            self._timer.start()
+
+    def remove(self, bridge):
+        """Stop refreshing the blinking lights of a bridge."""
+        self.bridges.pop(bridge, None)
+        if len(self.bridges) == 0:
+            self._timer.stop()
+
+    def _tick(self):
+        now = tornado.ioloop.IOLoop.current().time()
+        for bridge, due in sorted(self.bridges.items(), key=lambda item: item[1]):
+            if due > now:
+                break
+            if len(bridge.blinking_lights) == 0:
+                self.bridges[bridge] = now + self.period
+            elif not bridge.queue.saturated:
+                logging.debug("Running blinker on %s", bridge.serial_number)
+                self.bridges[bridge] = now + self.period
+                bridge.blink()
+
+
 class Bridge:
 
     # pylint: disable=too-many-instance-attributes
@@ -218,9 +2223,13 @@ class Bridge:
     http://developers.meethue.com/1_lightsapi.html#16_set_light_state for reference.
     """
     ignoredkeys = {"transitiontime", "alert", "effect", "colormode", "reachable"}
+    # the minimum number of lights to send an identical state change to using a group
+    group_threshold = 3
 
     @tornado.gen.coroutine
-    def __new__(cls, ipaddress, username=None, defaults=None, timeout=2):
+    def __new__(cls, ipaddress, username=None, defaults=None, timeout=2, rate=10, pool_size=2,
+                max_groups=16, max_scenes=200, window=4, fire_and_forget=False,
+                validation_sample=16, sync_interval=None, transport=None, blinker=None):
         """Create a new Bridge object. Example usage::
 
             @tornado.gen.coroutine
@@ -237,59 +2246,257 @@ class Bridge:
                              Required for most commands.
         :param dict defaults: A dictionary containing default state changes to be sent with any
                               state-changing commands.
-        :param int timeout: The time in seconds to wait for any requests to the Hue bridge
-                            to complete.
+        :param int timeout: The time in seconds to wait for requests to the Hue bridge
+                            to complete until the round-trip time has been measured;
+                            after that the timeout is adapted to the measured round-trip time.
+                            See `RTTEstimator`.
+        :param float rate: The maximum number of state changes to send to the bridge per second.
+                           Any further state changes are queued; see `CommandQueue`.
+        :param int pool_size: The maximum number of persistent connections to keep open
+                              to the bridge; see `ConnectionPool`.
+        :param int max_groups: The maximum number of groups the bridge can hold. Some of these
+                               may be used for sending identical state changes to several
+                               lights at once; see `set_lights`.
+        :param int max_scenes: The maximum number of scenes the bridge can hold;
+                               see `SceneCache`.
+        :param int window: The maximum number of state changes to have in flight
+                           at the same time; see `CommandQueue`.
+        :param bool fire_and_forget: Whether state changes should be considered complete as
+                                     soon as they have been sent, rather than when the bridge
+                                     has responded; see `send_nowait`.
+        :param int validation_sample: In fire-and-forget mode, check every n-th response for
+                                      errors reported by the Hue API.
+        :param float sync_interval: The time in seconds between refreshing the state of two
+                                    lights in the background, or `None` to not refresh
+                                    lights periodically; see `StateSync`.
+        :param transport: The object to send requests to the bridge through, such as a
+                          `SimulatedTransport`, or a callable creating one given the
+                          IP address. Defaults to a `ConnectionPool` of ``pool_size``
+                          connections.
+        :param BlinkScheduler blinker: The scheduler keeping the bridge's blinking lights
+                                       blinking, such as the one shared by the bridges
+                                       of a `LightGrid`. Defaults to a scheduler of the
+                                       bridge's own.
         :return: A `tornado.concurrent.Future` that resolves to a bridge object when completed.
         :raises: :exc:`NoBridgeFoundException` if no bridge was found at the given IP address.
         """
+        self = cls._create(ipaddress, username, defaults, timeout, rate, pool_size, max_groups,
+                           max_scenes, window, fire_and_forget, validation_sample,
+                           sync_interval, transport, blinker)
+        self.ready = self._connect()
+        yield self.ready
+        return self
+
+    @classmethod
+    def _create(cls, ipaddress, username=None, defaults=None, timeout=2, rate=10, pool_size=2,
+                max_groups=16, max_scenes=200, window=4, fire_and_forget=False,
+                validation_sample=16, sync_interval=None, transport=None, blinker=None):
         self = super(Bridge, cls).__new__(cls)
 
         self.defaults = defaults if defaults is not None else {"transitiontime": 0}
         self.username = username
         self.ipaddress = ipaddress
-        self.client = tornado.httpclient.AsyncHTTPClient()
-        self.timeout = timeout
+        if transport is None:
+            transport = ConnectionPool(ipaddress, size=pool_size)
+        elif callable(transport):
+            transport = transport(ipaddress)
+        self.transport = transport
+        self.rtt = RTTEstimator(timeout)
+        self.queue = CommandQueue(self, rate, window)
         self.light_data = collections.defaultdict(dict)
+        # incremented whenever light_data changes, so that readers can tell when it hasn't
+        self.state_version = 0
+        # incremented whenever light_data changes other than by sending state changes to
+        # single lights or groups, such as when a sync finds a light in another state
+        self.external_version = 0
+        # IDs of every light on the bridge as reported by the last full sync, or None
+        # until one has finished; light_data only holds the lights seen so far
+        self.all_lights = None
         self.groups = collections.defaultdict(list)
+        self.group_pool = GroupPool(self, max_groups)
+        self._url_cache = LRUCache(512)
+        self._url_cache_username = None
+        self._light_urls = {}
+        self.scenes = SceneCache(self, max_scenes)
+        self.fire_and_forget = fire_and_forget
+        self.validation_sample = validation_sample
+        self.metrics = BridgeMetrics(self)
+        self.errors = self.metrics.errors
+        self._unvalidated = 0
+        self.sync = StateSync(self)
+        self.breaker = CircuitBreaker()
+        self._probing = False
+        self.active = True
+
+        self.serial_number = None
+        self.description = None
+        self.name = None
+        self.mac = None
+        self.gateway = None
+        self.netmask = None
+
+        self.logged_in = False
+
+        self._sync_interval = sync_interval
+        self.blinking_lights = set()
+        self.blink_group = None
+        self.blink_members = frozenset()
+        self._updating_blink_group = False
+        self.blinker = blinker if blinker is not None else BlinkScheduler()
+        return self
+
+    @classmethod
+    def from_cache(cls, cache, username=None, defaults=None, **options):
+        """Create a Bridge object from data saved using `to_cache`, without waiting
+        for the bridge to respond.
+
+        The cached metadata is trusted right away, so that the bridge can be used
+        immediately. Meanwhile, the bridge is validated in the background as it would be
+        by `Bridge`, after which the metadata and light states are updated. The light
+        states themselves can be restored using `LightGrid.restore_snapshot`.
+        The outcome of the validation is available through ``ready``.
+
+        :param dict cache: Data returned by `to_cache`.
+        :param str username: The username for this bridge. Defaults to the cached username.
+        :param dict defaults: See `__new__`.
+        :param options: Any further keyword arguments accepted by `__new__`.
+        :return: The `Bridge` object. Its ``ready`` attribute is a `tornado.concurrent.Future`
+                 that completes when the bridge has been validated, raising
+                 `NoBridgeFoundException` if the bridge is gone or has been replaced.
+        :rtype: `Bridge`
+        :raises: `KeyError` if the cached data is incomplete.
+        """
+        if username is None:
+            username = cache.get("username")
+        self = cls._create(cache["ip"], username, defaults, **options)
+        self.serial_number = cache["serial_number"]
+        self.description = cache.get("description")
+        self.name = cache.get("name")
+        self.mac = cache.get("mac")
+        self.gateway = cache.get("gateway")
+        self.netmask = cache.get("netmask")
+        self.logged_in = cache.get("logged_in", False) and username == cache.get("username")
+
+        self.ready = self._connect()
+        return self
 
-        self.name = None
-        self.mac = None
-        self.gateway = None
-        self.netmask = None
+    def to_cache(self):
+        """Return the metadata of the bridge, for use with `from_cache`.
 
-        self.logged_in = False
+        :return: A JSON serializable dictionary.
+        :rtype: `dict`
+        """
+        return {
+            "ip": self.ipaddress,
+            "serial_number": self.serial_number,
+            "description": self.description,
+            "username": self.username,
+            "logged_in": self.logged_in,
+            "name": self.name,
+            "mac": self.mac,
+            "gateway": self.gateway,
+            "netmask": self.netmask
+        }
 
-        self.blinking_lights = set()
-        self.blinker = tornado.ioloop.PeriodicCallback(self.blink, 15 * 1000)
+    @tornado.gen.coroutine
+    def _connect(self):
+        self.transport.warm()
 
         try:
             if (yield self.send_request("GET", "/config",
                                         force_send=True)).get("name", "") != "Philips hue":
                 raise ValueError
         except (ValueError, UnicodeDecodeError, tornado.httpclient.HTTPError):
-            raise NoBridgeFoundException("{}: not a Philips Hue bridge".format(ipaddress))
+            self.transport.close()
+            raise NoBridgeFoundException("{}: not a Philips Hue bridge".format(self.ipaddress))
 
         # assume Philips Hue bridge from here on
         res = yield self.http_request("GET", "/description.xml")
 
         et, ns = parse_description(res.buffer)
-        self.serial_number = et.find('./default:device/default:serialNumber',
-                                        namespaces=ns).text
+        serial_number = et.find('./default:device/default:serialNumber',
+                                namespaces=ns).text
+        if self.serial_number is not None and serial_number != self.serial_number:
+            self.transport.close()
+            raise NoBridgeFoundException("{}: expected bridge {}, found {}".format(
+                self.ipaddress, self.serial_number, serial_number))
+        self.serial_number = serial_number
+        self.description = res.body.decode()
 
         yield self.update_info()
 
-        self.blinker.start()
+        self.blinker.add(self)
+        if self._sync_interval is not None:
+            self.sync.start(self._sync_interval)
 
-        return self
+    @property
+    def timeout(self):
+        """The current time in seconds to wait for a request to the bridge to complete."""
+        return self.rtt.timeout
 
     def deinit(self):
-        self.blinker.stop()
+        self.active = False
+        self.blinker.remove(self)
+        self.sync.stop()
+        self.transport.close()
+
+    def is_all_lights(self, lights):
+        """Check whether the given lights are exactly the lights on the bridge, as
+        reported by the last `StateSync.sync_lights`. Always `False` before the first
+        sync has finished, since the shadow state may not hold every light yet.
+
+        :param lights: IDs of the lights.
+        """
+        return self.all_lights is not None and frozenset(lights) == self.all_lights
 
     def blink(self):
-        logging.debug("Running blinker on %s", self.serial_number)
-        for light in self.blinking_lights:
-            logging.debug("Sending alert lselect to light %s on %s", light, self.serial_number)
-            self.set_state(light, alert="lselect")
+        """Make the lights in `blinking_lights` blink for another 15 seconds.
+
+        The lights are kept in a group named ``playhouse blink``, which is created or
+        updated as needed, so that a single group command suffices. Until the group is
+        up to date, each light is sent a command of its own. This method is called
+        periodically by the `BlinkScheduler`.
+        """
+        lights = frozenset(self.blinking_lights)
+        if len(lights) == 0:
+            return
+        if len(lights) > 1 and self.is_all_lights(lights):
+            self._set_state('/groups/0/action', {"alert": "lselect"}, group=list(lights),
+                            priority=CommandQueue.BACKGROUND)
+        elif len(lights) > 1 and lights == self.blink_members:
+            self._set_state('/groups/{}/action'.format(self.blink_group),
+                            {"alert": "lselect"}, group=list(lights),
+                            priority=CommandQueue.BACKGROUND)
+        else:
+            for light in lights:
+                logging.debug("Sending alert lselect to light %s on %s",
+                              light, self.serial_number)
+                self._set_state(self._light_url(light), {"alert": "lselect"}, light=light,
+                                priority=CommandQueue.BACKGROUND)
+            if len(lights) > 1:
+                self._update_blink_group(lights)
+
+    @tornado.gen.coroutine
+    def _update_blink_group(self, lights):
+        if self._updating_blink_group:
+            return
+        self._updating_blink_group = True
+        try:
+            if self.blink_group is None:
+                res = yield self.create_group(sorted(lights), name=BlinkScheduler.groupname)
+                self.blink_group = _group_id(res)
+                self.group_pool.reserved.add(self.blink_group)
+            else:
+                yield self.send_request("PUT", "/groups/{}".format(self.blink_group),
+                                        {"lights": [str(light) for light in sorted(lights)]},
+                                        priority=CommandQueue.BACKGROUND)
+                self.groups[self.blink_group] = sorted(lights)
+            self.blink_members = lights
+        except (HueAPIException, tornado.httpclient.HTTPError):
+            logging.warning("Couldn't update the blink group on %s", self.serial_number,
+                            exc_info=True)
+        finally:
+            self._updating_blink_group = False
 
     @tornado.gen.coroutine
     def http_request(self, method, url, body=None, timeout=None):
@@ -297,21 +2504,100 @@ class Bridge:
 
         :param str method: HTTP request method (POST/GET/PUT/DELETE)
         :param str url: The URL to send this request to.
-        :param str body: HTTP POST request body.
+        :param body: HTTP POST request body, as `str` or `bytes`.
         :param int timeout: The time to wait for this request to complete. Defaults to
-                            the timeout supplied to the `Bridge` constructor.
+                            a timeout derived from the measured round-trip time, in which
+                            case GET and PUT requests may be retried once upon timing out.
         :return: A `tornado.concurrent.Future` that resolves to the response from the bridge
                  when complete.
-        :rtype: `tornado.httpclient.HTTPResponse` if the HTTP request failed.
-        :raises: `tornado.httpclient.HTTPError` if the HTTP request failed.
+        :rtype: `Response`
+        :raises: `BridgeUnavailableException` without sending the request if the
+                 bridge's `CircuitBreaker` is open.
+
+                 `tornado.httpclient.HTTPError` if the HTTP request failed.
         """
+        if not self.breaker.closed:
+            raise BridgeUnavailableException(self)
+
         logging.debug("Sending request %s %s (data: %s) to %s",
                       method, url, body, self.ipaddress)
-        if timeout is None:
-            timeout = self.timeout
-        response = yield self.client.fetch("http://{}{}".format(self.ipaddress, url),
-                                           method=method, body=body, request_timeout=timeout)
-        return response
+        retry = timeout is None and method in ("GET", "PUT")
+        while True:
+            start = self.transport.ioloop.time()
+            self.metrics.request(method, body)
+            try:
+                response = yield self.transport.fetch(method, url, body,
+                                                 timeout if timeout is not None else self.timeout)
+            except RequestTimedOutException:
+                self.rtt.timed_out()
+                if retry and self.rtt.should_retry():
+                    logging.debug("Request %s %s to %s timed out, retrying with timeout %s",
+                                  method, url, self.ipaddress, self.timeout)
+                    retry = False
+                    continue
+                self.errors["http"] += 1
+                self._unreachable()
+                raise
+            except tornado.httpclient.HTTPError as e:
+                self.errors["http"] += 1
+                if e.code == 599:
+                    self._unreachable()
+                raise
+            elapsed = self.transport.ioloop.time() - start
+            self.rtt.sample(elapsed)
+            self.metrics.observe(elapsed)
+            self.breaker.succeeded()
+            return response
+
+    def _unreachable(self):
+        if self.breaker.failed():
+            logging.warning("Bridge %s at %s is unreachable; rejecting requests until it "
+                            "responds again", self.serial_number, self.ipaddress)
+            self._probe()
+
+    @tornado.gen.coroutine
+    def _probe(self):
+        if self._probing:
+            return
+        self._probing = True
+        ioloop = self.transport.ioloop
+        try:
+            while self.active and not self.breaker.closed:
+                yield tornado.gen.Task(ioloop.add_timeout,
+                                       ioloop.time() + self.breaker.retry_delay)
+                self.breaker.half_open()
+                try:
+                    yield self.transport.fetch("GET", self._api_url("/config", force_send=True),
+                                               timeout=self.rtt.maximum)
+                except tornado.httpclient.HTTPError as e:
+                    if e.code != 599:
+                        # the bridge answered, even if not successfully
+                        self.breaker.succeeded()
+                    else:
+                        self.breaker.failed()
+                        logging.debug("Bridge %s at %s is still unreachable; next probe in %s s",
+                                      self.serial_number, self.ipaddress,
+                                      self.breaker.retry_delay)
+                else:
+                    self.breaker.succeeded()
+            if self.active:
+                logging.info("Bridge %s at %s is reachable again",
+                             self.serial_number, self.ipaddress)
+                # changes may have been lost while the bridge was unreachable
+                self.sync.verify(self.light_data)
+        finally:
+            self._probing = False
+
+    def _forget_state(self, lights, args):
+        # drop shadow state set by changes that may not have reached the bridge,
+        # so that they aren't considered redundant when requested again
+        for light in lights:
+            state = self.light_data.get(light)
+            if state is not None:
+                for k in args:
+                    state.pop(k, None)
+        self.state_version += 1
+        self.external_version += 1
 
     @tornado.gen.coroutine
     def send_raw(self, method, url, body=None, timeout=None):
@@ -320,7 +2606,7 @@ class Bridge:
         :param str method: HTTP request method (POST/GET/PUT/DELETE).
         :param str url: The URL to send this request to.
         :param dict body: HTTP POST request body as a Python dictionary. The dictionary
-                          will be converted to a JSON string.
+                          will be converted to a JSON string; see `encode_body`.
         :param int timeout: The time to wait for this request to complete. Defaults to
                             the timeout supplied to the `Bridge` constructor.
         :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
@@ -331,7 +2617,7 @@ class Bridge:
                  `HueAPIException` if the Hue API returned an error.
         """
         if body is not None:
-            body = json.dumps(body)
+            body = encode_body(body)
         elif method in ("POST", "PUT"): # the curl http client doesn't accept body=None for POST/PUT
             body = ''
 
@@ -341,15 +2627,110 @@ class Bridge:
             return
         res = tornado.escape.json_decode(res.body)
         logging.debug("Got %s %s response from %s: %s", method, url, self.ipaddress, res)
+        self._check_errors(res)
+
+        return res
 
+    def _check_errors(self, res):
+        error = None
         if type(res) is list:
             for item in res:
                 if "error" in item:
-                    raise HUE_ERRORS.get(item["error"]["type"], HueAPIException)(item, self)
+                    self.errors[item["error"]["type"]] += 1
+                    if error is None:
+                        error = HUE_ERRORS.get(item["error"]["type"], HueAPIException)(item, self)
+        if error is not None:
+            raise error
 
-        return res
+    @tornado.gen.coroutine
+    def send_nowait(self, method, url, body=None, lights=None):
+        """Send an HTTP request to the bridge using this `Bridge` instance's `username`,
+        without waiting for the response.
+
+        The response is read in the background. Only every `validation_sample`-th response
+        is decoded and checked for errors reported by the Hue API, while failed requests
+        and responses with an unexpected status code are always noticed. Any errors found
+        are logged and counted in `errors`, but not raised. If the request changed the
+        state of ``lights``, their shadow state for the keys in ``body`` is forgotten
+        when an error is found, since the bridge may not have applied the change.
+
+        :param str method: HTTP request method (POST/GET/PUT/DELETE).
+        :param str url: The URL to send this request to. ``/api/`` followed by the username
+                        is automatically prepended to the URL.
+        :param dict body: HTTP request body as a Python dictionary; see `encode_body`.
+        :param lights: IDs of the lights whose state the request changes, if any.
+        :return: A `tornado.concurrent.Future` that resolves to `None` as soon as the request
+                 has been written.
+        :raises: `BridgeUnavailableException` without sending the request if the
+                 bridge's `CircuitBreaker` is open.
+
+                 `tornado.httpclient.HTTPError` if the request could not be written.
+
+                 `UnauthorizedUserException` if no username is set.
+        """
+        if not self.breaker.closed:
+            raise BridgeUnavailableException(self)
+
+        full_url = self._api_url(url)
+        args = body
+        body = encode_body(body) if body is not None else ''
+        start = self.transport.ioloop.time()
+        self.metrics.request(method, body)
+        try:
+            response = yield self.transport.send(method, full_url, body, self.timeout)
+        except RequestTimedOutException:
+            self.rtt.timed_out()
+            self.errors["http"] += 1
+            self._unreachable()
+            raise
+        except tornado.httpclient.HTTPError as e:
+            self.errors["http"] += 1
+            if e.code == 599:
+                self._unreachable()
+            raise
+
+        self._unvalidated += 1
+        validate = self._unvalidated >= self.validation_sample
+        if validate:
+            self._unvalidated = 0
+        self.transport.ioloop.add_future(response, functools.partial(
+            self._on_response, method, url, lights, args, start, validate))
+
+    def _on_response(self, method, url, lights, args, start, validate, future):
+        try:
+            response = future.result()
+        except tornado.httpclient.HTTPError as e:
+            if isinstance(e, RequestTimedOutException):
+                self.rtt.timed_out()
+            self.errors["http"] += 1
+            if e.code == 599:
+                self._unreachable()
+            logging.warning("%s %s request to %s failed: %s", method, url, self.ipaddress, e)
+            if lights is not None:
+                self._forget_state(lights, args)
+            return
+        elapsed = self.transport.ioloop.time() - start
+        self.rtt.sample(elapsed)
+        self.metrics.observe(elapsed)
+        self.breaker.succeeded()
+
+        if validate:
+            try:
+                self._check_errors(tornado.escape.json_decode(response.body))
+            except (ValueError, UnicodeDecodeError):
+                self.errors["http"] += 1
+                logging.warning("Invalid response to %s %s from %s",
+                                method, url, self.ipaddress)
+            except HueAPIException as e:
+                logging.warning("%s %s request to %s failed: %s",
+                                method, url, self.ipaddress, e)
+            else:
+                return
+            if lights is not None:
+                self._forget_state(lights, args)
 
-    def send_request(self, method, url, body=None, timeout=None, force_send=False):
+    def send_request(self, method, url, body=None, timeout=None, force_send=False,
+                     priority=None):
         """Send an HTTP request to the bridge using this `Bridge` instance's `username`.
 
         :param str method: HTTP request method (POST/GET/PUT/DELETE).
@@ -363,6 +2744,9 @@ class Bridge:
                                 `UnauthorizedUserException` will be raised if no username is set;
                                 setting this parameter to `True` will force a request using
                                 a dummy username (``none``).
+        :param str priority: If given, the request is queued in this lane of the bridge's
+                             `CommandQueue` (`CommandQueue.INTERACTIVE` or
+                             `CommandQueue.BACKGROUND`) rather than sent right away.
         :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
                  converted from JSON to a Python dictionary, when complete.
         :rtype: `dict`
@@ -371,6 +2755,12 @@ class Bridge:
                  `HueAPIException` if the Hue API returned an error.
 
         """
+        if priority is not None:
+            return self.queue.request(method, self._api_url(url, force_send), body, timeout,
+                                      priority)
+        return self.send_raw(method, self._api_url(url, force_send), body, timeout)
+
+    def _api_url(self, url, force_send=False):
         username = self.username
         if username is None and not force_send:
             raise UnauthorizedUserException({"error": {"type": 1, "address": url,
@@ -378,20 +2768,25 @@ class Bridge:
         elif username is None:
             username = "none" # dummy username guaranteed to be invalid (too short)
 
-        return self.send_raw(method, "/api/{}{}".format(username, url), body, timeout)
+        if username != self._url_cache_username:
+            self._url_cache.clear()
+            self._url_cache_username = username
+        full_url = self._url_cache.get(url)
+        if full_url is None:
+            full_url = "/api/{}{}".format(username, url)
+            self._url_cache.put(url, full_url)
+        return full_url
 
-    def _set_state(self, url, args):
-        return self.send_request("PUT", url, body=args)
+    def _set_state(self, url, args, light=None, group=None,
+                   priority=CommandQueue.INTERACTIVE):
+        return self.queue.put(url, args, light, group, priority=priority)
 
     def _state_preprocess(self, args, light):
         defs = self.defaults.copy()
         defs.update(args)
 
         if 'rgb' in defs:
-            hue, sat, lum = rgb_to_hsl(*defs['rgb'])
-            defs['hue'] = int(hue * 65536 / 360)
-            defs['sat'] = sat
-            del defs['rgb']
+            defs['hue'], defs['sat'] = rgb_to_hue_sat(*defs.pop('rgb'))
 
         if 'blink' in defs:
             if light is None:
@@ -411,6 +2806,9 @@ class Bridge:
     def set_state(self, i, **args):
         """Set state of a particular lamp.
 
+        The state change is sent through the bridge's `CommandQueue`, where it is merged
+        with any other pending changes to the same light.
+
         :param int i: ID number for the light whose state to change.
         :param args: Hue state changes. A full list of allowed state change can be found at
                      http://developers.meethue.com/1_lightsapi.html#16_set_light_state.
@@ -422,7 +2820,15 @@ class Bridge:
                  `HueAPIException` if the Hue API returned an error.
         """
         args = self._state_preprocess(args, i)
+        return self._set_state(self._light_url(i), self._reduce_state(i, args), light=i)
+
+    def _light_url(self, i):
+        url = self._light_urls.get(i)
+        if url is None:
+            url = self._light_urls[i] = '/lights/{}/state'.format(i)
+        return url
 
+    def _reduce_state(self, i, args):
         # Remove unnecessary commands
         state = self.light_data[i]
         final_send = dict()
@@ -431,12 +2837,86 @@ class Bridge:
                 final_send[k] = v
                 if k not in self.ignoredkeys:
                     state[k] = v
-            elif k in state and state[k] == v:
-                pass # Do not include this redundant command
-        #print("Started with:" + str(args))
-        #print("Reduced to:" + str(final_send))
+                    self.state_version += 1
+            else:
+                # Do not include this redundant command
+                self.metrics.deduplicated += 1
+        return final_send
+
+    def set_lights(self, changes):
+        """Set the state of several lights at once.
+
+        Lights that are to be changed to the same state are sent a single group command
+        if a group consisting of exactly those lights exists. Sets of lights that
+        are repeatedly changed together are given a group in the bridge's `GroupPool`;
+        until that group exists, each light is sent its own command.
+
+        :param dict changes: Dictionary of light ID -> Hue state changes pairs.
+        :return: A dictionary of light ID -> `tornado.concurrent.Future` pairs, where
+                 each future resolves to the response from the bridge to the command
+                 that changed the light.
+        :rtype: `dict`
+        """
+        alike = collections.defaultdict(list)
+        for i, args in changes.items():
+            args = self._state_preprocess(args, i)
+            alike[_freeze(args)].append((i, args))
+
+        futures = {}
+        for members in alike.values():
+            finals = {i: self._reduce_state(i, args) for i, args in members}
+            # send any attribute that needs to change for at least one member
+            keys = set().union(*finals.values())
+
+            group = None
+            if (len(members) >= self.group_threshold and
+                    not keys <= CommandQueue.passivekeys):
+                group = self.group_pool.find(finals)
+            if group is None:
+                for i, final in finals.items():
+                    futures[i] = self._set_state(self._light_url(i), final, light=i)
+                continue
+
+            args = members[0][1]
+            future = self._set_state('/groups/{}/action'.format(group),
+                                     {k: args[k] for k in keys}, group=finals)
+            for i in finals:
+                futures[i] = future
+
+        return futures
+
+    def store_scene(self, name, states):
+        """Store the given light states on the bridge as a scene, which can then be
+        recalled using `recall_scene`.
+
+        :param str name: Name of the scene.
+        :param dict states: Dictionary of light ID -> Hue state changes pairs. ``alert``
+                            and ``blink`` changes are not stored.
+        :return: A `tornado.concurrent.Future` that completes when the scene has been stored.
+        :raises: `tornado.httpclient.HTTPError` if an HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        return self.scenes.store(name, {
+            light: self._state_preprocess({k: v for k, v in args.items()
+                                           if k not in ("alert", "blink")}, None)
+            for light, args in states.items()
+        })
+
+    def recall_scene(self, name):
+        """Change the lights in a scene stored using `store_scene` to their stored states.
+
+        :param str name: Name of the scene.
+        :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
+                 converted from JSON to a Python dictionary, when complete.
+        :rtype: `dict`
+        :raises: `KeyError` if no scene with the given name is stored on the bridge.
 
-        return self._set_state('/lights/{}/state'.format(i), final_send)
+                 `tornado.httpclient.HTTPError` if the HTTP request failed.
+
+                 `HueAPIException` if the Hue API returned an error.
+        """
+        return self.scenes.recall(name)
 
     def set_group(self, i, **args):
         """Set the state of a given lamp group.
@@ -460,12 +2940,14 @@ class Bridge:
             else:
                 for lamp in keys:
                     self.light_data[lamp][k] = v
+                self.state_version += 1
 
-        return self._set_state('/groups/{}/action'.format(i), args)
+        return self._set_state('/groups/{}/action'.format(i), args, group=list(keys))
 
     @tornado.gen.coroutine
     def create_group(self, lights, name=None):
-        """Create a new group for this bridge.
+        """Create a new group for this bridge. The request is queued in the background
+        lane of the bridge's `CommandQueue`.
 
         :param list lights: a list of lamp IDs (`int`).
         :param str name: Name for this group, optional argument.
@@ -479,15 +2961,15 @@ class Bridge:
         body = {'lights':[str(x) for x in lights]}
         if name is not None:
             body['name'] = name
-        res = yield self.send_request("POST", "/groups", body)
-        match = re.match(r"/groups/(\d+)", res[0]["success"]["id"])
-        group = int(match.group(1))
-        self.groups[group] = lights.copy()
+        res = yield self.send_request("POST", "/groups", body,
+                                      priority=CommandQueue.BACKGROUND)
+        self.groups[_group_id(res)] = list(lights)
         return res
 
     @tornado.gen.coroutine
     def delete_group(self, i):
-        """Delete a new group from this bridge.
+        """Delete a new group from this bridge. The request is queued in the background
+        lane of the bridge's `CommandQueue`.
 
         :param int i: ID number for the group to be removed.
         :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
@@ -497,20 +2979,31 @@ class Bridge:
 
                  `HueAPIException` if the Hue API returned an error.
         """
-        res = (yield self.send_request("DELETE", "/groups/{}".format(i)))[0]
+        res = (yield self.send_request("DELETE", "/groups/{}".format(i),
+                                       priority=CommandQueue.BACKGROUND))[0]
         del self.groups[i]
+        self.group_pool.discard(i)
+        if i == self.blink_group:
+            self._forget_blink_group()
         return res
 
-    def get_lights(self):
+    def _forget_blink_group(self):
+        self.group_pool.reserved.discard(self.blink_group)
+        self.blink_group = None
+        self.blink_members = frozenset()
+
+    def get_lights(self, priority=None):
         """Fetch a list of all lights known to the bridge.
 
+        :param str priority: The `CommandQueue` lane to queue the request in, if any;
+                             see `send_request`.
         :return: A `tornado.concurrent.Future` that resolves to the response from the bridge,
                  converted from JSON to a Python dictionary, when complete.
         :rtype: `dict`
         :raises: `tornado.httpclient.HTTPError` if the HTTP request failed.
                  `HueAPIException` if the Hue API returned an error.
         """
-        return self.send_request("GET", "/lights")
+        return self.send_request("GET", "/lights", priority=priority)
 
     def search_lights(self):
         """Start a new light search.
@@ -608,7 +3101,8 @@ class Bridge:
 
         If the current `username` is valid, `logged_in` will be set to `True` and
         `gateway`, `netmask`, `name` and `mac` will be updated; otherwise, `logged_in`
-        will be set to `False` and the remaining attributes to `None`.
+        will be set to `False` and the remaining attributes to `None`. The lights and
+        groups are synced using `StateSync`.
 
         This method is called automatically by `create_user` and `set_username`.
 
@@ -618,27 +3112,21 @@ class Bridge:
                  `HueAPIException` if the Hue API returned an error.
         """
         try:
-            data = yield self.send_request("GET", "/")
-            info = data["config"]
+            info = yield self.send_request("GET", "/config", priority=CommandQueue.BACKGROUND)
+            # given an invalid username, the bridge answers with a partial configuration
+            # rather than an error
+            if 'gateway' not in info:
+                raise UnauthorizedUserException({"error": {"type": 1, "address": "/config",
+                                                           "description": "unauthorized user"}},
+                                                self)
+            # only synced once the username is known to be valid
+            yield [self.sync.sync_lights(), self.sync.sync_groups()]
 
             self.logged_in = True
             self.gateway = info['gateway']
             self.netmask = info['netmask']
             self.name = info['name']
             self.mac = info['mac']
-
-            self.light_data.clear()
-            self.groups.clear()
-            for lamp_num, lamp in data["lights"].items():
-                state = lamp["state"]
-                for k, v in state.items():
-                    if k in self.ignoredkeys:
-                        continue
-
-                    self.light_data[int(lamp_num)][k] = v
-            for group_num, group in data["groups"].items():
-                lights = group["lights"]
-                self.groups[int(group_num)] = [int(x) for x in lights]
         except UnauthorizedUserException:
             if self.username is not None:
                 logging.warning("Couldn't send request to %s using username %s",
@@ -698,10 +3186,313 @@ class Bridge:
             stream.close()
 
 
+class _Animation:
+    """A keyframe animation played by an `Animator`."""
+    __slots__ = ("cells", "times", "states", "repeat", "start", "next_step", "costs", "future")
+
+    def __init__(self, cells, keyframes, repeat, start, costs):
+        self.cells = cells
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+        self.times = [t for t, _ in keyframes]
+        self.states = [state for _, state in keyframes]
+        self.repeat = repeat
+        self.start = start
+        self.next_step = start
+        # bridge -> number of commands needed to change the lights of the animation
+        self.costs = costs
+        self.future = tornado.concurrent.TracebackFuture()
+
+    @property
+    def duration(self):
+        return self.times[-1]
+
+    def state_at(self, t):
+        """Interpolate the state of the lights ``t`` seconds into the animation."""
+        i = bisect.bisect_right(self.times, t)
+        if i == 0:
+            return dict(self.states[0])
+        if i == len(self.times):
+            return dict(self.states[-1])
+
+        t0, t1 = self.times[i - 1], self.times[i]
+        before, after = self.states[i - 1], self.states[i]
+        ratio = (t - t0) / (t1 - t0)
+        state = dict(before)
+        for key, start in before.items():
+            end = after.get(key)
+            if end is None or key not in Animator.interpolated:
+                continue
+            if key == "xy":
+                state[key] = [round(a + (b - a) * ratio, 4) for a, b in zip(start, end)]
+                continue
+            if key == "rgb":
+                state[key] = [int(round(a + (b - a) * ratio)) for a, b in zip(start, end)]
+                continue
+            if key == "hue":
+                # go around the colour wheel the shorter way
+                end = start + (end - start + 32768) % 65536 - 32768
+            state[key] = int(round(start + (end - start) * ratio))
+            if key == "hue":
+                state[key] %= 65536
+        return state
+
+
+class Animator:
+    """Plays keyframe animations on the lights of a `LightGrid`.
+
+    Rather than sending every intermediate state, the animator sends a state change
+    for each animation only every so often, with a ``transitiontime`` that makes the
+    lights fade smoothly to the state they should have by the next step. The time
+    between steps is chosen so that the animations on each bridge use no more than
+    a ``share`` of the command budget of the bridge, that is its configured ``rate`` or,
+    if the bridge answers more slowly than that, as many commands as its measured
+    round-trip time allows; the remaining budget is left for other state changes.
+    """
+    # attributes whose values are interpolated between keyframes; other attributes
+    # change when their keyframe is reached
+    interpolated = {"bri", "hue", "sat", "ct", "xy", "rgb"}
+
+    def __init__(self, grid, resolution=0.1, share=0.5):
+        """Initializes the `Animator`.
+
+        :param LightGrid grid: The grid to animate.
+        :param float resolution: The minimum time in seconds between two steps
+                                 of an animation.
+        :param float share: The fraction of each bridge's command budget that may be
+                            used by animations.
+        """
+        self.grid = grid
+        self.resolution = resolution
+        self.share = share
+        self.animations = []
+        self._timer = tornado.ioloop.PeriodicCallback(self._tick, resolution * 1000)
+
+    def add(self, cells, keyframes, repeat=False):
+        """Start an animation. Cells that are part of an animation already are removed
+        from that animation; see `stop`.
+
+        :param cells: The ``(x, y)`` coordinates to animate. Coordinates without a light
+                      are ignored.
+        :param keyframes: A list of ``(time, changes)`` pairs, where ``changes`` is
+                          a dictionary of Hue state changes that the lights should have
+                          reached ``time`` seconds after the animation started.
+        :param bool repeat: If `True`, the animation starts over after its last keyframe
+                            until it is stopped.
+        :return: A `tornado.concurrent.Future` that completes when the animation has
+                 finished or has been stopped.
+        :raises: `ValueError` if no keyframes are given, or a keyframe time is negative.
+        """
+        if len(keyframes) == 0 or any(t < 0 for t, _ in keyframes):
+            raise ValueError("invalid keyframes")
+
+        cells = set(cells)
+        self.stop(cells)
+        lights = collections.defaultdict(int)
+        for x, y in cells:
+            entry = self.grid._lookup(x, y)
+            if entry is not None and entry[0] is not None:
+                lights[entry[0]] += 1
+        # lights changed together are sent a single group command; see LightGrid.set_cells
+        costs = {bridge: 1 if count >= bridge.group_threshold else count
+                 for bridge, count in lights.items()}
+
+        animation = _Animation(cells, keyframes, repeat,
+                               tornado.ioloop.IOLoop.current().time(), costs)
+        self.animations.append(animation)
+        if len(self.animations) == 1:
+            self._timer.start()
+        return animation.future
+
+    def stop(self, cells=None):
+        """Stop animating the given cells. The lights are left in their current state.
+
+        :param cells: The ``(x, y)`` coordinates to stop animating, or `None` to stop
+                      all animations.
+        """
+        remaining = []
+        for animation in self.animations:
+            if cells is not None:
+                animation.cells -= cells
+            if cells is None or len(animation.cells) == 0:
+                animation.future.set_result(None)
+            else:
+                remaining.append(animation)
+        self.animations = remaining
+        if len(self.animations) == 0:
+            self._timer.stop()
+
+    def interval(self, animation):
+        """The time in seconds between two steps of an animation, such that all
+        animations together stay within the share of each bridge's command budget."""
+        load = collections.defaultdict(int)
+        for other in self.animations:
+            for bridge, cost in other.costs.items():
+                load[bridge] += cost
+
+        interval = self.resolution
+        for bridge in animation.costs:
+            budget = bridge.queue.rate
+            if bridge.rtt.srtt is not None:
+                budget = min(budget, bridge.queue.window / bridge.rtt.srtt)
+            interval = max(interval, load[bridge] / (budget * self.share))
+        return interval
+
+    def _tick(self):
+        now = tornado.ioloop.IOLoop.current().time()
+        finished = []
+        for animation in self.animations:
+            if animation.next_step > now:
+                continue
+
+            interval = transition = self.interval(animation)
+            target = now + interval - animation.start
+            if not animation.repeat and target >= animation.duration:
+                target = animation.duration
+                transition = max(animation.start + target - now, 0)
+                finished.append(animation)
+            elif animation.repeat and animation.duration > 0:
+                target %= animation.duration
+            animation.next_step = now + interval
+
+            state = animation.state_at(target)
+            state["transitiontime"] = int(round(transition * 10))
+            self.grid.set_cells(animation.cells, **state).add_done_callback(self._on_step)
+
+        for animation in finished:
+            self.animations.remove(animation)
+            animation.future.set_result(None)
+        if len(self.animations) == 0:
+            self._timer.stop()
+
+    @staticmethod
+    def _on_step(future):
+        if future.exception() is not None:
+            logging.warning("Animation step failed: %s", future.exception())
+        elif len(future.result()) > 0:
+            logging.debug("Animation step failed for %s", future.result())
+
+
+class ChangeScheduler:
+    """Applies state changes to the lights of a `LightGrid` after a delay.
+
+    The changes are kept in a timer wheel of ``slots`` buckets, each covering
+    ``resolution`` seconds of time; changes due further ahead than the wheel reaches
+    stay in their bucket until the wheel has come around enough times. At each tick,
+    every change that has become due is buffered and all of them are sent using
+    a single `LightGrid.commit`, rather than one timer and one commit per change.
+
+    At most ``max_changes`` changes may be waiting at the same time; see `schedule`.
+    """
+    def __init__(self, grid, resolution=0.05, slots=256, max_changes=100000):
+        """Initializes the `ChangeScheduler`.
+
+        :param LightGrid grid: The grid to apply the changes to.
+        :param float resolution: The time in seconds between two ticks. Changes are
+                                 applied at the first tick after they are due.
+        :param int slots: The number of buckets in the timer wheel.
+        :param int max_changes: The maximum number of changes waiting to be applied,
+                                or `None` for no limit.
+        """
+        self.grid = grid
+        self.resolution = resolution
+        self.max_changes = max_changes
+        self.wheel = [[] for _ in range(slots)]
+        # the number of changes waiting, and their approximate size in bytes
+        self.size = 0
+        self.memory = 0
+        self._origin = None
+        self._ticks = 0
+        self._timer = tornado.ioloop.PeriodicCallback(self._tick, resolution * 1000)
+
+    def schedule(self, changes):
+        """Apply state changes after a delay. Either all of the changes are scheduled,
+        or none of them are.
+
+        :param changes: A list of ``(delay, x, y, args)`` tuples, where ``delay`` is
+                        the time in seconds after which to set the state of the light
+                        at ``(x, y)`` according to the dictionary ``args``, as
+                        with `LightGrid.set_state`.
+        :raises: `ScheduleFullException` if this would make more than ``max_changes``
+                 changes wait at the same time.
+        """
+        if self.max_changes is not None and self.size + len(changes) > self.max_changes:
+            raise ScheduleFullException(self.max_changes)
+
+        now = tornado.ioloop.IOLoop.current().time()
+        if self._origin is None:
+            self._origin = now
+            self._ticks = 0
+            self._timer.start()
+
+        slots = len(self.wheel)
+        for delay, x, y, args in changes:
+            due = max(self._ticks + 1,
+                      int(math.ceil((now + delay - self._origin) / self.resolution)))
+            entry = (due, x, y, args)
+            self.wheel[due % slots].append(entry)
+            self.memory += sys.getsizeof(entry) + sys.getsizeof(args)
+        self.size += len(changes)
+
+    def clear(self):
+        """Drop all changes waiting to be applied."""
+        for bucket in self.wheel:
+            bucket.clear()
+        self.size = 0
+        self.memory = 0
+        self._stop()
+
+    def _stop(self):
+        self._timer.stop()
+        self._origin = None
+
+    def _tick(self):
+        now = int((tornado.ioloop.IOLoop.current().time() - self._origin) / self.resolution)
+        slots = len(self.wheel)
+        applied = 0
+        # catch up on ticks that were missed, visiting each bucket at most once
+        for tick in range(max(self._ticks + 1, now - slots + 1), now + 1):
+            bucket = self.wheel[tick % slots]
+            if len(bucket) == 0:
+                continue
+            waiting = []
+            for entry in bucket:
+                due, x, y, args = entry
+                if due > now:
+                    waiting.append(entry)
+                    continue
+                # buffered regardless of whether the grid is, so that a single commit
+                # sends every change due
+                self.grid._buffer_state(x, y, args)
+                self.memory -= sys.getsizeof(entry) + sys.getsizeof(args)
+                applied += 1
+            self.wheel[tick % slots] = waiting
+        self._ticks = now
+        self.size -= applied
+
+        if applied > 0:
+            self.grid.commit().add_done_callback(self._on_commit)
+        if self.size == 0:
+            self._stop()
+
+    @staticmethod
+    def _on_commit(future):
+        if future.exception() is not None:
+            logging.warning("Couldn't apply delayed changes: %s", future.exception())
+        else:
+            for (x, y), e in future.result().items():
+                logging.warning("Couldn't apply delayed change to (%s,%s): %s", x, y, e)
+
+
 class LightGrid:
     """Keeps track of several bridges, abstracting access to individual lights."""
+    # the attributes of each light returned by light_states
+    state_keys = ("on", "bri", "hue", "sat", "ct", "xy")
+    # the largest value of each channel of a colour passed to set_frame, by mode
+    frame_limits = {"rgb": (255, 255, 255), "hsb": (65535, 255, 255)}
+
     def __init__(self, usernames=None, grid=None, buffered=False, defaults=None,
-                 assert_reachable=True):
+                 assert_reachable=True, bridge_options=None, max_queue_depth=None,
+                 commit_rate=None):
         """Initializes the `LightGrid`.
 
         :param dict usernames: Dictionary of MAC address -> username pairs. When a bridge is
@@ -721,20 +3512,64 @@ class LightGrid:
                                       bridges are reachable; any unreachable bridge will be removed.
                                       Setting this parameter to `True` is equivalent to manually
                                       calling the `assert_reachable` method.
+        :param dict bridge_options: Additional keyword arguments to pass to `Bridge` whenever
+                                    a new bridge is created from an IP address, such as
+                                    ``rate`` or ``pool_size``.
+        :param int max_queue_depth: The number of commands that may be waiting to be sent
+                                    to a single bridge before `wait_for_capacity` starts
+                                    waiting, or `None` for no limit.
+        :param float commit_rate: The number of times per second to send buffered state
+                                  changes, or `None` to send them whenever `commit` is
+                                  called. See `set_commit_rate`.
         """
         self.defaults = defaults if defaults is not None else {}
+        self.bridge_options = bridge_options if bridge_options is not None else {}
+        self.max_queue_depth = max_queue_depth
         self.bridges = {}
         self.usernames = usernames if usernames is not None else {}
         self.buffered = buffered
-        self._buffer = collections.defaultdict(dict)
+        # (x, y) -> state changes buffered since the last commit
+        self._pending = {}
+        # buffered coordinates whose changes may differ from the state of their light;
+        # the others are known to match it as long as their bridge's state_version
+        # is the one recorded in _clean_versions at the end of the last commit
+        self._dirty = set()
+        self._clean_versions = {}
+        # future resolved by the next tick of the commit clock, if anyone is waiting for it
+        self._next_tick = None
+        self._ticker = None
+        self.commit_rate = None
+        self.scenes = {}
+        # the last frame passed to set_frame, and the colour mode, grid and bridge states
+        # it was compared against; see set_frame
+        self._frame = None
+        self._frame_key = None
+        # NumPy array telling which coordinates have a light, built by set_frame as needed
+        self._lit = None
 
         self.grid = []
         self.height = 0
         self.width = 0
+        # flat list of ``(bridge, light)`` pairs for the coordinate ``(x, y)`` at
+        # ``y * width + x``, with ``bridge`` being `None` for lights of bridges not in
+        # the grid, or `None` for coordinates without a light; see `_build_index`
+        self._index = []
+        # (mac_address, light_id) -> list of (x, y) coordinates of the light
+        self._coordinates = {}
+        self.bridge_lights = {}
+        self.animator = Animator(self)
+        self.scheduler = ChangeScheduler(self)
+        self.blinker = BlinkScheduler()
+        # incremented whenever the grid or the bridges in it change; see state_version
+        self._layout_version = 0
+        self._version_key = None
+        self._version = 0
+        self._states = None
 
         self.set_grid(grid if grid is not None else [])
 
         self.running = True
+        self.set_commit_rate(commit_rate)
 
         if assert_reachable:
             self.assert_reachable()
@@ -760,14 +3595,54 @@ class LightGrid:
         if isinstance(ip_address_or_bridge, Bridge):
             bridge = ip_address_or_bridge
         else:
-            bridge = yield Bridge(ip_address_or_bridge, username, self.defaults)
+            bridge = yield Bridge(ip_address_or_bridge, username, self.defaults,
+                                  blinker=self.blinker, **self.bridge_options)
 
         if self.has_bridge(bridge):
             raise BridgeAlreadyAddedException()
 
+        if bridge.blinker is not self.blinker:
+            if bridge in bridge.blinker.bridges:
+                bridge.blinker.remove(bridge)
+                self.blinker.add(bridge)
+            bridge.blinker = self.blinker
+
         if bridge.username is None and bridge.serial_number in self.usernames:
             yield bridge.set_username(self.usernames[bridge.serial_number])
         self.bridges[bridge.serial_number] = bridge
+        self._relink_bridge(bridge.serial_number)
+        return bridge
+
+    def add_cached_bridge(self, cache):
+        """Add a bridge to this light grid using data saved by `Bridge.to_cache`, without
+        waiting for the bridge to respond.
+
+        The bridge is validated in the background; see `Bridge.from_cache`. If the
+        validation fails, the bridge is removed from the grid again.
+
+        :param dict cache: Data returned by `Bridge.to_cache`.
+        :return: The `Bridge` instance added to the `LightGrid`.
+        :rtype: `Bridge`
+        :raises: `BridgeAlreadyAddedException` if the `Bridge` is already present
+                 in the `LightGrid`.
+
+                 `KeyError` if the cached data is incomplete.
+        """
+        if self.has_bridge(cache["serial_number"]):
+            raise BridgeAlreadyAddedException()
+
+        bridge = Bridge.from_cache(cache, self.usernames.get(cache["serial_number"]),
+                                   self.defaults, blinker=self.blinker, **self.bridge_options)
+        self.bridges[bridge.serial_number] = bridge
+        self._relink_bridge(bridge.serial_number)
+
+        def validated(future):
+            if future.exception() is not None and self.bridges.get(bridge.serial_number) is bridge:
+                logging.warning("Couldn't validate cached bridge %s at %s: %s",
+                                bridge.serial_number, bridge.ipaddress, future.exception())
+                self.remove_bridge(bridge.serial_number)
+
+        tornado.ioloop.IOLoop.current().add_future(bridge.ready, validated)
         return bridge
 
     def has_bridge(self, mac_or_bridge):
@@ -796,17 +3671,283 @@ class LightGrid:
         """
         self.usernames = usernames
 
+    def set_bridge_options(self, bridge_options):
+        """Sets the options used when creating new bridges.
+
+        :param dict bridge_options: Keyword arguments to pass to `Bridge`. See the
+                                    ``bridge_options`` parameter of `__init__`.
+        """
+        self.bridge_options = bridge_options
+
+    def set_max_queue_depth(self, max_queue_depth):
+        """Sets the queue depth used by `wait_for_capacity`.
+
+        :param int max_queue_depth: See the ``max_queue_depth`` parameter of `__init__`.
+        """
+        self.max_queue_depth = max_queue_depth
+
+    def set_commit_rate(self, commit_rate):
+        """Sets the rate at which buffered state changes are sent to the bridges.
+
+        While a rate is set, `commit` doesn't send the buffered changes itself, but waits
+        for the next tick of a fixed-rate clock. Each tick sends every change buffered
+        since the previous tick at once, so concurrent callers of `commit` share a single
+        dispatch, and changes to the same light are merged before they reach its bridge.
+        Ticks with nobody waiting in `commit` send nothing.
+
+        :param float commit_rate: The number of ticks per second, or `None` to send
+                                  buffered changes whenever `commit` is called.
+        """
+        if self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+        self.commit_rate = commit_rate
+        if commit_rate is not None:
+            self._ticker = tornado.ioloop.PeriodicCallback(self._tick, 1000 / commit_rate)
+            self._ticker.start()
+        else:
+            # don't leave anyone waiting for a tick that will never come
+            self._tick()
+
+    def _tick(self):
+        tick, self._next_tick = self._next_tick, None
+        if tick is not None:
+            tornado.concurrent.chain_future(self._commit(), tick)
+
+    def snapshot(self):
+        """Encode the shadow state of every light in the grid in a compact binary format,
+        for use with `restore_snapshot`.
+
+        Only the ``on``, ``bri``, ``hue``, ``sat``, ``ct`` and ``xy`` attributes are saved.
+
+        :return: The encoded snapshot.
+        :rtype: `bytes`
+        """
+        entries = []
+        for mac, bridge in self.bridges.items():
+            try:
+                serial = bytes.fromhex(mac)
+            except ValueError:
+                continue
+            for light, state in bridge.light_data.items():
+                mask = 0
+                for bit, key in enumerate(_SNAPSHOT_KEYS):
+                    if key in state:
+                        mask |= 1 << bit
+                if mask == 0:
+                    continue
+                x, y = state.get("xy", (0, 0))
+                try:
+                    entries.append(_SNAPSHOT_ENTRY.pack(
+                        serial, light, mask, bool(state.get("on")), state.get("bri", 0),
+                        state.get("hue", 0), state.get("sat", 0), state.get("ct", 0), x, y))
+                except struct.error:
+                    logging.debug("Not saving out of range state of light %s on %s: %s",
+                                  light, mac, state)
+        return _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, time.time(),
+                                     len(entries)) + b"".join(entries)
+
+    def restore_snapshot(self, data, max_age=None):
+        """Restore the shadow state of the lights in the grid from a snapshot created using
+        `snapshot`, so that state changes that wouldn't change anything can be left out
+        right away, without having to wait for the bridges to report the light states.
+
+        Lights of bridges not in the grid are ignored, as are attributes that already
+        have a known state. If the snapshot is older than ``max_age``, the light states
+        are considered stale and are not restored. Either way, the lights are queued for
+        verification by their bridge's `StateSync`, since even a recent snapshot misses
+        whatever changed after it was taken.
+
+        :param bytes data: The snapshot.
+        :param float max_age: The age in seconds after which the snapshot is considered
+                              stale, or `None` to never consider it stale.
+        :return: The number of lights whose state was restored.
+        :rtype: `int`
+        :raises: `ValueError` if the data is not a valid snapshot.
+        """
+        try:
+            magic, version, taken, count = _SNAPSHOT_HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError("truncated snapshot")
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError("not a light state snapshot")
+        if len(data) != _SNAPSHOT_HEADER.size + count * _SNAPSHOT_ENTRY.size:
+            raise ValueError("truncated snapshot")
+
+        stale = max_age is not None and time.time() - taken > max_age
+        restored_lights = collections.defaultdict(list)
+        restored = 0
+        for offset in range(_SNAPSHOT_HEADER.size, len(data), _SNAPSHOT_ENTRY.size):
+            serial, light, mask, *values = _SNAPSHOT_ENTRY.unpack_from(data, offset)
+            bridge = self.bridges.get(binascii.hexlify(serial).decode())
+            if bridge is None:
+                continue
+            restored_lights[bridge].append(light)
+            if stale:
+                continue
+
+            on, bri, hue, sat, ct, x, y = values
+            # coordinates are stored with single precision; the bridge uses four decimals
+            values = (on, bri, hue, sat, ct, [round(x, 4), round(y, 4)])
+            state = bridge.light_data[light]
+            for bit, (key, value) in enumerate(zip(_SNAPSHOT_KEYS, values)):
+                if mask >> bit & 1:
+                    state.setdefault(key, value)
+            bridge.state_version += 1
+            bridge.external_version += 1
+            restored += 1
+
+        for bridge, lights in restored_lights.items():
+            bridge.sync.verify(lights)
+        return restored
+
+    @property
+    def backlog(self):
+        """The total number of commands waiting to be sent to the bridges."""
+        return sum(bridge.queue.depth for bridge in self.bridges.values())
+
+    @tornado.gen.coroutine
+    def wait_for_capacity(self):
+        """Wait until no bridge has more than ``max_queue_depth`` commands waiting
+        to be sent.
+
+        Callers producing state changes faster than the bridges can handle should wait
+        for this before buffering more changes.
+
+        :return: A `tornado.concurrent.Future` that completes when there is room
+                 for more state changes.
+        """
+        if self.max_queue_depth is not None:
+            yield [bridge.queue.wait(self.max_queue_depth) for bridge in self.bridges.values()]
+
     def set_grid(self, grid):
         """Set the grid that maps coordinates to ``(mac_address, light_id)`` pairs.
 
+        Also updates `bridge_lights`, which maps the MAC address of each bridge in the grid
+        to the sorted list of IDs of its lights that appear in the grid.
+
         :param list grid: A list of lists of ``(mac_address, light_id)`` tuples. See the ``grid``
                           parameter of `__init__`.
         """
         self.grid = grid
         self.height = len(self.grid)
         self.width = max(len(x) for x in self.grid) if self.height > 0 else 0
+        self._frame = None
+        self._build_index()
+        self._layout_version += 1
+        self._clean_versions = {}
+
+    def _build_index(self):
+        # called whenever the grid changes, so that looking up the light at a coordinate
+        # is a single list access
+        index = [None] * (self.width * self.height)
+        coordinates = collections.defaultdict(list)
+        bridge_lights = collections.defaultdict(set)
+        for y, row in enumerate(self.grid):
+            for x, cell in enumerate(row):
+                if cell is None:
+                    continue
+                mac, light = cell
+                index[y * self.width + x] = (self.bridges.get(mac), light)
+                coordinates[(mac, light)].append((x, y))
+                bridge_lights[mac].add(light)
+        self._index = index
+        self._lit = None
+        self._coordinates = dict(coordinates)
+        self.bridge_lights = {mac: sorted(lights) for mac, lights in bridge_lights.items()}
+
+    def _relink_bridge(self, mac):
+        # called whenever a bridge is added or removed; only its own lights are updated
+        bridge = self.bridges.get(mac)
+        for light in self.bridge_lights.get(mac, ()):
+            for x, y in self._coordinates[(mac, light)]:
+                self._index[y * self.width + x] = (bridge, light)
+        self._layout_version += 1
+        self._clean_versions = {}
+
+    def coordinates(self, mac, light):
+        """Return the coordinates of a light in the grid.
+
+        :param str mac: The MAC address of the bridge the light belongs to.
+        :param int light: The ID of the light.
+        :return: A list of the ``(x, y)`` coordinates mapped to the light, which is empty
+                 if the light isn't in the grid.
+        :rtype: `list`
+        """
+        return self._coordinates.get((mac, light), [])
+
+    def bridge_coordinates(self, mac):
+        """Return the coordinates of all lights of a bridge in the grid.
+
+        :param str mac: The MAC address of the bridge.
+        :return: A list of ``(x, y)`` coordinates.
+        :rtype: `list`
+        """
+        return [coordinate for light in self.bridge_lights.get(mac, ())
+                for coordinate in self._coordinates[(mac, light)]]
+
+    def light_errors(self, mac, errors):
+        """Map errors raised when changing lights of a bridge to the coordinates of
+        the lights, in the same format as returned by `commit`.
+
+        :param str mac: The MAC address of the bridge.
+        :param dict errors: Dictionary of light ID -> exception object pairs.
+        :return: Dictionary of ``(x, y)`` coordinate -> exception object pairs. Lights that
+                 aren't in the grid are left out.
+        :rtype: `dict`
+        """
+        return {coordinate: e for light, e in errors.items()
+                for coordinate in self.coordinates(mac, light)}
+
+    @property
+    def state_version(self):
+        """A number that increases whenever the result of `light_states` may have
+        changed, that is whenever the known state of a light in the grid, the grid
+        itself or the bridges in the grid change.
+        """
+        key = (self._layout_version,) + tuple(bridge.state_version
+                                              for bridge in self.bridges.values())
+        if key != self._version_key:
+            self._version_key = key
+            self._version += 1
+        return self._version
+
+    def light_states(self):
+        """Return the known state of every light in the grid, as last sent to the light
+        or reported by its bridge. The bridges are not queried.
+
+        The result is cached until `state_version` changes, and must not be modified.
+
+        :return: A list of rows, one for each y coordinate, each of which is a list of
+                 states, one for each x coordinate. Each state is a list of the values of
+                 the attributes in `state_keys`, with `None` for unknown values, or `None`
+                 if there is no light at the coordinate or its bridge is not in the grid.
+        :rtype: `list`
+        """
+        version = self.state_version
+        if self._states is not None and self._states[0] == version:
+            return self._states[1]
+
+        index, width, keys = self._index, self.width, self.state_keys
+        rows = []
+        for y in range(self.height):
+            row = []
+            for entry in index[y * width:(y + 1) * width]:
+                state = None
+                if entry is not None and entry[0] is not None:
+                    bridge, light = entry
+                    state = bridge.light_data.get(light)
+                    state = [state.get(key) for key in keys] if state else None
+                row.append(state)
+            rows.append(row)
+        self._states = (version, rows)
+        return rows
+
+    def _lookup(self, x, y):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self._index[y * self.width + x]
+        return None
 
-    @tornado.gen.coroutine
     def set_state(self, x, y, **args):
         # pylint: disable=invalid-name
         """Set the state for the light at the given coordinate.
@@ -824,24 +3965,310 @@ class LightGrid:
                  `HueAPIException` if the grid is unbuffered and the Hue API returned an error.
         """
 
-        self._buffer[(x, y)].update(args)
+        self._buffer_state(x, y, args)
 
         if not self.buffered:
-            exceptions = yield self.commit()
-            if len(exceptions) > 0:
-                # pass on first (and only, since this grid isn't buffered) exception
-                raise next(iter(exceptions.values()))
+            return self._commit_state()
+        # buffering is by far the most common case, and cheaper without a coroutine
+        future = tornado.concurrent.TracebackFuture()
+        future.set_result(None)
+        return future
+
+    @tornado.gen.coroutine
+    def _commit_state(self):
+        exceptions = yield self.commit()
+        if len(exceptions) > 0:
+            # pass on first (and only, since this grid isn't buffered) exception
+            raise next(iter(exceptions.values()))
 
     @tornado.gen.coroutine
     def set_all(self, **args):
         """Set the state of every light known to every bridge added to this `LightGrid`.
+        Any animations are stopped.
 
         :param args: State argument, see the Philips Hue documentation.
         """
+        self.animator.stop()
+        self._frame = None
         _, exc = yield ExceptionCatcher({bridge.serial_number: bridge.set_group(0, **args)
                                            for bridge in self.bridges.values()})
         return exc
 
+    def set_region(self, x0, y0, x1, y1, **args):
+        """Set the lights in a rectangular region of the grid to the same state.
+
+        The state change is sent right away, without being buffered, using as few commands
+        as possible; see `set_cells`.
+
+        :param int x0: X coordinate of one corner of the region.
+        :param int y0: Y coordinate of one corner of the region.
+        :param int x1: X coordinate of the opposite corner of the region.
+        :param int y1: Y coordinate of the opposite corner of the region.
+        :param args: State argument, see the Philips Hue documentation.
+        :return: See `set_cells`.
+        """
+        return self.set_cells(self.region(x0, y0, x1, y1), **args)
+
+    def region(self, x0, y0, x1, y1):
+        """Return the coordinates in a rectangular region of the grid, including both
+        corners, clipped to the grid.
+
+        :return: A list of ``(x, y)`` coordinates.
+        :rtype: `list`
+        """
+        x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), self.width - 1)
+        y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), self.height - 1)
+        return [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+
+    def set_mask(self, mask, **args):
+        """Set the lights at the cells selected by a mask to the same state.
+
+        The state change is sent right away, without being buffered, using as few commands
+        as possible; see `set_cells`.
+
+        :param mask: A list of rows, which may be of different lengths, or
+                     a two-dimensional NumPy array, where ``mask[y][x]`` is true for
+                     the cells at ``(x, y)`` to change. Cells outside the grid are ignored.
+        :param args: State argument, see the Philips Hue documentation.
+        :return: See `set_cells`.
+        :raises: `ValueError` if the mask is a NumPy array that isn't two-dimensional.
+        """
+        if numpy is not None and isinstance(mask, numpy.ndarray):
+            if mask.ndim != 2:
+                raise ValueError("mask must be two-dimensional")
+            ys, xs = numpy.nonzero(mask[:self.height, :self.width])
+            cells = zip(xs.tolist(), ys.tolist())
+        else:
+            cells = [(x, y) for y, row in enumerate(mask[:self.height])
+                            for x, selected in enumerate(row[:self.width]) if selected]
+        return self.set_cells(cells, **args)
+
+    def animate(self, cells, keyframes, repeat=False):
+        """Fade the lights at the given coordinates through a series of keyframes,
+        sending intermediate states within the command budget of each bridge.
+        See `Animator.add`.
+
+        :return: A `tornado.concurrent.Future` that completes when the animation has
+                 finished or has been stopped.
+        """
+        return self.animator.add(cells, keyframes, repeat)
+
+    def stop_animations(self, cells=None):
+        """Stop animating the given coordinates, or all coordinates. See `Animator.stop`."""
+        self.animator.stop(cells)
+
+    @tornado.gen.coroutine
+    def set_cells(self, cells, **args):
+        """Set the lights at the given coordinates to the same state.
+
+        The state change is sent right away, without being buffered. The lights of each
+        bridge are changed using `Bridge.set_lights`, which sends a single group command
+        if a group consisting of exactly those lights exists, such as group 0 when all
+        lights of the bridge are changed. Otherwise, each light is sent its own command,
+        and a group is created for the lights in the bridge's `GroupPool` in the
+        background, so that the next change of the same cells needs a single command.
+        Buffered changes for the same coordinates and attributes are dropped, as they
+        are overridden.
+
+        :param cells: The ``(x, y)`` coordinates to change. Coordinates without a light
+                      are ignored.
+        :param args: State argument, see the Philips Hue documentation.
+        :return: A `tornado.concurrent.Future` that resolves to a dictionary of ``(x, y)``
+                 coordinate -> exception object pairs, as returned by `commit`.
+        :rtype: `dict`
+        """
+        exceptions = {}
+        bridge_lights = collections.defaultdict(dict)
+        coordinates = collections.defaultdict(list)
+        index, width, height = self._index, self.width, self.height
+        pending, frame = self._pending, self._frame
+        stale = None if numpy is None else -1
+        for x, y in cells:
+            entry = index[y * width + x] if 0 <= x < width and 0 <= y < height else None
+            if entry is None:
+                continue
+            bridge, light = entry
+            if bridge is None:
+                exceptions[(x, y)] = NoBridgeAtCoordinateException()
+                continue
+
+            bridge_lights[bridge][light] = args
+            coordinates[(bridge, light)].append((x, y))
+            if frame is not None:
+                frame[y][x] = stale
+            if (x, y) in pending:
+                changes = pending[(x, y)]
+                for k in args:
+                    changes.pop(k, None)
+                if not changes:
+                    del pending[(x, y)]
+                    self._dirty.discard((x, y))
+
+        futures = collections.defaultdict(list)
+        for bridge, changes in bridge_lights.items():
+            for light, future in bridge.set_lights(changes).items():
+                futures[future].extend(coordinates[(bridge, light)])
+            # a region is likely to be filled again, so give it a group for the next fill
+            # rather than waiting for it to be seen twice; this fill isn't held back
+            if len(changes) >= bridge.group_threshold:
+                bridge.group_pool.prepare(changes)
+
+        failed = yield gather_exceptions({future: future for future in futures})
+        for future, e in failed.items():
+            for coordinate in futures[future]:
+                exceptions[coordinate] = e
+        return exceptions
+
+    def set_frame(self, frame, mode="rgb", **args):
+        """Buffer the colours of every cell of the grid at once.
+
+        The frame is compared to the frame previously passed to `set_frame`, and only
+        the cells whose colour changed since then are converted and buffered; call
+        `commit` to send them. Cells changed in the meantime using `set_state`, or whose
+        commit failed, are always buffered. The whole frame is buffered if the state of
+        a bridge's lights changed other than through the grid, for example when a sync
+        finds that another client changed a light or a scene was recalled.
+
+        If NumPy is available, the frame is compared and converted in a vectorized pass;
+        otherwise, the cells are handled one at a time.
+
+        :param frame: A ``height`` x ``width`` x 3 array of colours, as a NumPy array or
+                      nested lists, where ``frame[y][x]`` is the colour at ``(x, y)``.
+        :param str mode: ``rgb`` if the colours are ``(red, green, blue)`` triplets in the
+                         range 0-255, converted the same way as the ``rgb`` state change
+                         of `Bridge.set_state`, or ``hsb`` if the colours are Hue
+                         ``(hue, sat, bri)`` values.
+        :param args: Additional state changes, such as ``transitiontime``, to buffer
+                     along with each changed colour.
+        :return: The list of ``(x, y)`` coordinates that were buffered.
+        :rtype: `list`
+        :raises: `ValueError` if the frame doesn't have the same size as the grid, holds
+                 anything but integers in the range of the mode, or the mode is unknown.
+        """
+        if mode not in ("rgb", "hsb"):
+            raise ValueError("unknown frame mode {}".format(mode))
+        key = (mode, self._layout_version) + tuple(bridge.external_version
+                                                   for bridge in self.bridges.values())
+        last = self._frame if self._frame_key == key else None
+
+        limits = self.frame_limits[mode]
+        index, width = self._index, self.width
+
+        if numpy is None:
+            if (len(frame) != self.height or any(len(row) != self.width for row in frame) or
+                    any(len(pixel) != 3 for row in frame for pixel in row)):
+                raise ValueError("frame doesn't match grid of size {}x{}".format(
+                    self.width, self.height))
+            frame = [[tuple(pixel) for pixel in row] for row in frame]
+            if not all(type(v) is int and 0 <= v <= limit for row in frame for pixel in row
+                       for v, limit in zip(pixel, limits)):
+                raise ValueError("{} frame colours must be integers within {}".format(mode, limits))
+            changed = [(x, y) for y, row in enumerate(frame) for x, pixel in enumerate(row)
+                       if (last is None or last[y][x] != pixel) and
+                       index[y * width + x] is not None]
+            if mode == "rgb":
+                values = [rgb_to_hue_sat(*frame[y][x]) for x, y in changed]
+            else:
+                values = [frame[y][x] for x, y in changed]
+            frame = [list(row) for row in frame]
+        else:
+            # copied, since the caller may change the array before the next frame
+            frame = numpy.array(frame)
+            if frame.shape != (self.height, self.width, 3):
+                raise ValueError("frame of size {} doesn't match grid of size {}".format(
+                    frame.shape, (self.height, self.width, 3)))
+            # anything but integers, such as floats, strings or oversized numbers,
+            # makes NumPy pick another type for the whole array
+            # reducing each channel on its own is much faster than over several axes
+            if frame.dtype.kind not in "iu" or (frame.size > 0 and (
+                    frame.min() < 0 or any(frame[..., channel].max() > limit
+                                           for channel, limit in enumerate(limits)))):
+                raise ValueError("{} frame colours must be integers within {}".format(mode, limits))
+            frame = frame.astype(numpy.int64, copy=False)
+            if self._lit is None:
+                self._lit = numpy.array([entry is not None for entry in index],
+                                        dtype=bool).reshape(self.height, self.width)
+            if last is None:
+                mask = self._lit
+            else:
+                # comparing channel by channel is much faster than reducing over the last axis
+                mask = ((frame[..., 0] != last[..., 0]) | (frame[..., 1] != last[..., 1]) |
+                        (frame[..., 2] != last[..., 2])) & self._lit
+            # only the changed cells are converted and handed back to Python
+            ys, xs = numpy.nonzero(mask)
+            changed = list(zip(xs.tolist(), ys.tolist()))
+            pixels = frame[ys, xs]
+            values = (rgb_to_hsl_array(pixels)[:, :2] if mode == "rgb" else pixels).tolist()
+        self._frame = frame
+        self._frame_key = key
+
+        if mode == "rgb":
+            cells = [{"hue": hue, "sat": sat} for hue, sat in values]
+        else:
+            cells = [{"hue": hue, "sat": sat, "bri": bri} for hue, sat, bri in values]
+        if args:
+            for changes in cells:
+                changes.update(args)
+        pending = self._pending
+        # cells whose colour changed since the last frame are very likely to differ from
+        # their light; any that don't are reduced to nothing by Bridge.set_lights
+        self._dirty.update(changed)
+        if not pending:
+            pending.update(zip(changed, cells))
+        else:
+            for coordinate, changes in zip(changed, cells):
+                buffered = pending.get(coordinate)
+                if buffered is None:
+                    pending[coordinate] = changes
+                else:
+                    buffered.update(changes)
+        return changed
+
+    def _forget_frame(self, coordinates):
+        # the lights at the coordinates no longer necessarily show the last frame
+        frame = self._frame
+        if frame is None:
+            return
+        stale = None if numpy is None else -1
+        for x, y in coordinates:
+            if 0 <= x < self.width and 0 <= y < self.height:
+                frame[y][x] = stale
+
+    def _buffer_state(self, x, y, args):
+        if 'rgb' in args:
+            # buffer the values actually sent, so that commit can compare them with
+            # the state of the light
+            args = dict(args)
+            args['hue'], args['sat'] = rgb_to_hue_sat(*args.pop('rgb'))
+        self._buffer_changes(x, y, args)
+        if self._frame is not None:
+            self._forget_frame(((x, y),))
+
+    def _buffer_changes(self, x, y, args):
+        coordinate = (x, y)
+        changes = self._pending.get(coordinate)
+        if changes is None:
+            changes = self._pending[coordinate] = dict(args)
+        else:
+            changes.update(args)
+
+        width = self.width
+        entry = self._index[y * width + x] if 0 <= x < width and 0 <= y < self.height else None
+        if entry is None or entry[0] is None:
+            self._dirty.add(coordinate)
+            return
+        bridge, light = entry
+        state = bridge.light_data.get(light)
+        if state is not None and self._clean_versions.get(bridge) == bridge.state_version:
+            # as in _differs, inlined since this runs for every buffered change
+            passive, ignored = CommandQueue.passivekeys, Bridge.ignoredkeys
+            for k, v in changes.items():
+                if k not in passive and (k in ignored or state.get(k, _MISSING) != v):
+                    break
+            else:
+                self._dirty.discard(coordinate)
+                return
+        self._dirty.add(coordinate)
 
     @tornado.gen.coroutine
     def commit(self):
@@ -850,6 +4277,23 @@ class LightGrid:
         This method is automatically called whenever `set_state` is called if the ``buffered``
         parameter of `__init__` was set to `False`.
 
+        If a commit rate is set (see `set_commit_rate`), the changes are sent at the next
+        tick together with those of any other callers, and the returned future only
+        includes exceptions for the coordinates that had changes buffered when this
+        method was called.
+
+        The changes are queued by each bridge's `CommandQueue`; the returned future completes
+        once they have all been sent. See `backlog` and `wait_for_capacity` for how
+        to avoid queueing changes faster than the bridges can handle them.
+
+        Only coordinates whose buffered changes differ from the committed state of their
+        light at the time of the commit, that is the state last sent to it or reported by
+        its bridge, are passed on to the bridges, so that buffering a light's current
+        state again costs no bridge traffic. The changes are compared as they are
+        buffered, so that a commit only visits the coordinates that changed; they are
+        only compared again for bridges whose shadow state has changed since the last
+        commit, for example through a sync, a failed command or a scene recall.
+
         :return: A `tornado.concurrent.Future` that resolves to a dictionary consisting of
                  ``(x, y)`` coordinate -> exception object key/value pairs, where a given
                  exception object is associated with the operation of changing the state
@@ -858,30 +4302,153 @@ class LightGrid:
         :raises: `tornado.httpclient.HTTPError` if the HTTP request failed.
                  `HueAPIException` if the Hue API returned an error.
         """
+        if self.commit_rate is None:
+            return (yield self._commit())
+        if not self._pending:
+            return {}
 
-        futures = {}
+        if self._next_tick is None:
+            self._next_tick = tornado.concurrent.Future()
+        buffered = set(self._pending)
+        exceptions = yield self._next_tick
+        return {coordinate: e for coordinate, e in exceptions.items() if coordinate in buffered}
+
+    @tornado.gen.coroutine
+    def _commit(self):
         exceptions = {}
-        for (x, y), changes in self._buffer.items():
-            try:
-                if x >= self.width or y >= self.height or self.grid[y][x] is None:
-                    raise OutsideGridException
+        bridge_changes = collections.defaultdict(dict)
+        index, width, height = self._index, self.width, self.height
+        # the grid may change while waiting for the bridges
+        light_coordinates = self._coordinates
+        pending, dirty = self._pending, self._dirty
+        self._pending, self._dirty = {}, set()
+
+        # Changes that wouldn't alter the shadow state of their light, which the bridge
+        # updates as changes are sent and keeps in sync with the light itself, are left
+        # out. They were sorted out as they were buffered; if a sync, a failed command or
+        # anything else has changed a bridge's shadow state since the last commit, the
+        # changes for its lights are sorted again.
+        clean_versions = self._clean_versions
+        stale = {bridge for bridge in self.bridges.values()
+                 if clean_versions.get(bridge) != bridge.state_version}
+        if stale and len(dirty) < len(pending):
+            for coordinate, changes in pending.items():
+                x, y = coordinate
+                entry = index[y * width + x] if 0 <= x < width and 0 <= y < height else None
+                if entry is None or entry[0] not in stale:
+                    continue
+                if _differs(entry[0].light_data.get(entry[1]), changes):
+                    dirty.add(coordinate)
+                else:
+                    dirty.discard(coordinate)
+
+        # a whole frame is cheaper to walk directly than through the dirty set
+        changed = (pending.items() if len(dirty) == len(pending) else
+                   ((coordinate, pending[coordinate]) for coordinate in dirty))
+        for coordinate, changes in changed:
+            x, y = coordinate
+            entry = index[y * width + x] if 0 <= x < width and 0 <= y < height else None
+            if entry is None:
+                exceptions[coordinate] = OutsideGridException()
+                continue
+            bridge, light = entry
+            if bridge is None:
+                exceptions[coordinate] = NoBridgeAtCoordinateException()
+                continue
+
+            # the buffered changes are no longer needed, so they are merged in place
+            lights = bridge_changes[bridge]
+            merged = lights.get(light)
+            if merged is None:
+                lights[light] = changes
+            else:
+                merged.update(changes)
+
+        # send identical changes to lights on the same bridge together; see Bridge.set_lights
+        sent = [(bridge, bridge.set_lights(changes))
+                for bridge, changes in bridge_changes.items()]
+        # the sorting above is only valid as long as the shadow states stay as they are now
+        self._clean_versions = {bridge: bridge.state_version
+                                for bridge in self.bridges.values()}
+
+        # wait once per command rather than once per coordinate, and only map failed
+        # commands back to coordinates, since most commits have none
+        failed = yield gather_exceptions({future: future for _, futures in sent
+                                          for future in futures.values()})
+        if len(failed) > 0:
+            for bridge, futures in sent:
+                for light, future in futures.items():
+                    e = failed.get(future)
+                    if e is None:
+                        continue
+                    for coordinate in light_coordinates.get((bridge.serial_number, light), ()):
+                        if coordinate in pending:
+                            exceptions[coordinate] = e
+            self._forget_frame(exceptions)
+        logging.debug("Got exceptions %s", exceptions)
+        return exceptions
 
-                mac, light = self.grid[y][x]
-                if mac not in self.bridges:
-                    raise NoBridgeAtCoordinateException
+    def _lights_by_bridge(self, states):
+        lights = collections.defaultdict(dict)
+        for (x, y), changes in states.items():
+            entry = self._lookup(x, y)
+            if entry is not None and entry[0] is not None:
+                bridge, light = entry
+                lights[bridge.serial_number].setdefault(light, {}).update(changes)
+        return lights
 
-                bridge = self.bridges[mac]
-                futures[(x, y)] = bridge.set_state(light, **changes)
-            except (OutsideGridException, NoBridgeAtCoordinateException) as e:
-                exceptions[(x, y)] = e
+    @tornado.gen.coroutine
+    def store_scene(self, name, states):
+        """Store a picture as a named scene on every bridge it involves.
+
+        A stored scene can later be shown using `recall_scene`, which only needs to send
+        a single command to each bridge, rather than one command per light.
+
+        :param str name: Name of the scene.
+        :param dict states: Dictionary of ``(x, y)`` coordinate -> state change pairs.
+                            Coordinates without a light are ignored.
+        :return: A `tornado.concurrent.Future` that resolves to a dictionary of
+                 MAC address -> exception object pairs for each bridge on which the scene
+                 could not be stored.
+        :rtype: `dict`
+        """
+        self.scenes[name] = states
+        _, exc = yield ExceptionCatcher({
+            mac: self.bridges[mac].store_scene(name, lights)
+            for mac, lights in self._lights_by_bridge(states).items()
+        })
+        return exc
 
-        self._buffer.clear()
+    @tornado.gen.coroutine
+    def recall_scene(self, name):
+        """Show a scene stored using `store_scene`.
 
-        res, exc = yield ExceptionCatcher(futures)
-        exceptions.update(exc)
-        logging.debug("Got results %s", res)
-        logging.debug("Got exceptions %s", exceptions)
-        return exceptions
+        If a bridge no longer holds an up-to-date copy of the scene, for example because
+        the grid has changed or the scene has been evicted, the scene is stored
+        on the bridge again before being recalled.
+
+        :param str name: Name of the scene.
+        :return: A `tornado.concurrent.Future` that resolves to a dictionary of
+                 MAC address -> exception object pairs for each bridge on which the scene
+                 could not be recalled.
+        :rtype: `dict`
+        :raises: `UnknownSceneException` if no scene with the given name has been stored.
+        """
+        if name not in self.scenes:
+            raise UnknownSceneException(name)
+        self._frame = None
+
+        @tornado.gen.coroutine
+        def recall(bridge, lights):
+            yield bridge.store_scene(name, lights)
+            res = yield bridge.recall_scene(name)
+            return res
+
+        _, exc = yield ExceptionCatcher({
+            mac: recall(self.bridges[mac], lights)
+            for mac, lights in self._lights_by_bridge(self.scenes[name]).items()
+        })
+        return exc
 
     @tornado.gen.coroutine
     def assert_reachable(self):
@@ -889,12 +4456,16 @@ class LightGrid:
 
         If a bridge cannot be reached three times in a row, it is removed from the `LightGrid`.
         Upon removing a bridge, `discover` will be run once as a last-ditch effort to find
-        the lost bridge.
+        the lost bridge. A bridge whose `CircuitBreaker` is open isn't pinged, since the
+        request would be rejected anyway; instead, it only counts as unreachable if the
+        breaker's own probe has failed since the previous check.
 
         This method is automatically called if the ``assert_reachable`` parameter of `__init__`
         was set to `True`.
         """
         strikes = collections.defaultdict(int)
+        # IP address -> number of failed breaker probes at the previous check
+        probes = {}
 
         while self.running:
             try:
@@ -903,11 +4474,20 @@ class LightGrid:
 
                 macs_to_remove = set()
                 for mac, bridge in self.bridges.items():
-                    logging.debug("Pinging bridge %s at %s",
-                                  mac, bridge.ipaddress)
+                    failed_probes = bridge.breaker.failed_probes
+                    last_failed_probes = probes.get(bridge.ipaddress, failed_probes)
+                    probes[bridge.ipaddress] = failed_probes
                     try:
-                        res = yield bridge.send_request("GET", "/config",
-                                                        timeout=5, force_send=True)
+                        if not bridge.breaker.closed:
+                            if failed_probes == last_failed_probes:
+                                logging.debug("Waiting for probe of bridge %s at %s",
+                                              mac, bridge.ipaddress)
+                                continue
+                            raise BridgeUnavailableException(bridge)
+                        logging.debug("Pinging bridge %s at %s",
+                                      mac, bridge.ipaddress)
+                        res = yield bridge.send_request("GET", "/config", force_send=True,
+                                                        priority=CommandQueue.BACKGROUND)
                         if res['name'] != 'Philips hue':
                             raise ValueError
                         strikes[bridge.ipaddress] = 0
@@ -922,8 +4502,10 @@ class LightGrid:
                             del strikes[bridge.ipaddress]
 
                 for mac in macs_to_remove:
-                    logging.error("Removing bridge %s at %s", mac, bridge.ipaddress)
-                    self.remove_bridge(mac)
+                    ipaddress = self.bridges[mac].ipaddress
+                    lost = self.remove_bridge(mac)
+                    logging.error("Removed bridge %s at %s, which controlled %s grid coordinates",
+                                  mac, ipaddress, len(lost))
 
                 if len(macs_to_remove) > 0:
                     logging.info("Attempting to find lost bridges")
@@ -941,7 +4523,16 @@ class LightGrid:
                 logging.exception("Encountered exception while pinging bridges")
 
     def remove_bridge(self, mac):
+        """Remove a bridge from the grid.
+
+        :param str mac: The MAC address of the bridge.
+        :return: The coordinates of the lights of the bridge, which are now left without
+                 a bridge.
+        :rtype: `list`
+        """
         self.bridges.pop(mac).deinit()
+        self._relink_bridge(mac)
+        return self.bridge_coordinates(mac)
 
 
 default_lamp = {
@@ -996,7 +4587,6 @@ class DummyLightGrid:
         return defs
 
 
-    @tornado.gen.coroutine
     def set_state(self, x, y, **args):
         # pylint: disable=invalid-name
         """Set the state for the light at the given coordinate.
@@ -1054,7 +4644,7 @@ class DummyLightGrid:
         exceptions = {}
         for (x, y), changes in self._buffer.items():
             try:
-                if x >= self.width or y >= self.height:
+                if not (0 <= x < self.width and 0 <= y < self.height):
                     raise OutsideGridException
 
                 self._lamp_data[y][x].update(changes)
@@ -1189,6 +4779,64 @@ def discover(attempts=2, timeout=2):
 
     return bridges
 
+def _freeze(args):
+    """Convert a dictionary of state changes to a hashable representation."""
+    # include the type, since e.g. True == 1 but they are encoded differently
+    return frozenset((k, type(v), tuple(v) if isinstance(v, list) else v)
+                     for k, v in args.items())
+
+_ENCODED_BODIES = LRUCache(1024)
+
+# placeholder for keys missing from a dictionary, where None is a valid value
+_MISSING = object()
+
+def _differs(state, changes):
+    """Check whether sending state changes to a light with the given shadow state, or
+    `None` if unknown, would change anything."""
+    if state is None:
+        return True
+    passive, ignored = CommandQueue.passivekeys, Bridge.ignoredkeys
+    for k, v in changes.items():
+        if k not in passive and (k in ignored or state.get(k, _MISSING) != v):
+            return True
+    return False
+
+_SNAPSHOT_MAGIC = b"PHLS"
+_SNAPSHOT_VERSION = 1
+# magic, version, time the snapshot was taken, number of entries
+_SNAPSHOT_HEADER = struct.Struct("<4sHdI")
+# bridge serial number, light ID, bitmask of the keys present, on, bri, hue, sat, ct, x, y
+_SNAPSHOT_ENTRY = struct.Struct("<6sHB?BHBHff")
+_SNAPSHOT_KEYS = ("on", "bri", "hue", "sat", "ct", "xy")
+
+def encode_body(body):
+    """Encode a request body as JSON.
+
+    The same few state changes are sent over and over during animations, so
+    encoded bodies are memoized in a bounded cache keyed on the contents of the body.
+
+    :param dict body: The request body.
+    :return: The JSON encoded body.
+    :rtype: `bytes`
+    """
+    # the value types are part of the key, since e.g. True == 1 but they are encoded
+    # differently; this is cheaper than building a canonical, order-independent key
+    key = (tuple(body.items()), tuple(map(type, body.values())))
+    try:
+        hash(key)
+    except TypeError: # unhashable values such as lists
+        return json.dumps(body).encode()
+    encoded = _ENCODED_BODIES.get(key)
+    if encoded is None:
+        encoded = json.dumps(body).encode()
+        _ENCODED_BODIES.put(key, encoded)
+    return encoded
+
+def _group_id(response):
+    """Extract the ID of a new group from the response to a group creation request."""
+    match = re.match(r"/groups/(\d+)", response[0]["success"]["id"])
+    return int(match.group(1))
+
 def parse_description(document):
     root = None
     namespaces = {}
@@ -1224,3 +4872,50 @@ def rgb_to_hsl(r, g, b):
     sat = c / divisor * 255
 
     return int(hue), int(sat), int(lum)
+
+def rgb_to_hue_sat(r, g, b):
+    """Convert a colour to the ``(hue, sat)`` values sent by `Bridge.set_state` for
+    an ``rgb`` state change, with the hue in the range 0-65535 used by the Hue API."""
+    hue, sat, _ = rgb_to_hsl(r, g, b)
+    return int(hue * 65536 / 360), sat
+
+def rgb_to_hsl_array(rgb):
+    """Vectorized version of `rgb_to_hsl`, converting the colours to the values sent
+    by `Bridge.set_state` for an ``rgb`` state change.
+
+    :param rgb: A NumPy array whose last axis holds ``(red, green, blue)`` triplets in
+                the range 0-255.
+    :return: An integer array of the same shape holding ``(hue, sat, lum)`` triplets, with
+             the hue scaled to the range 0-65535 used by the Hue API.
+    """
+    rgb = numpy.asarray(rgb, dtype=numpy.float64)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    M, m = rgb.max(axis=-1), rgb.min(axis=-1)
+    c = M - m
+
+    # pick the numerator and offset of rgb_to_hsl's branch for each colour, and only
+    # divide where the colour has a hue, rather than evaluating every branch
+    red = M == r
+    green = ~red & (M == g)
+    numerator = numpy.where(red, g - b, numpy.where(green, b - r, r - g))
+    hue = numpy.zeros(c.shape)
+    numpy.divide(numerator, c, out=hue, where=c != 0)
+    hue *= 360
+    hue += numpy.where(red, 360 * 6, numpy.where(green, 360 * 2, 360 * 4))
+    numpy.remainder(hue, 360 * 6, out=hue, where=red)
+    hue[c == 0] = 0
+    hue /= 6
+
+    lum = M/2 + m/2
+    divisor = 2 * numpy.where(lum < 128, lum, 256 - lum)
+    black = divisor == 0
+    sat = numpy.zeros(c.shape)
+    numpy.divide(c, divisor, out=sat, where=~black)
+    sat *= 255
+
+    result = numpy.empty(rgb.shape, dtype=numpy.int64)
+    result[..., 0] = hue.astype(numpy.int64) * 65536 // 360
+    result[..., 1] = sat.astype(numpy.int64)
+    result[..., 2] = lum.astype(numpy.int64)
+    result[black] = 0
+    return result
@@ -0,0 +1,278 @@
+# Playhouse: Making buildings into interactive displays using remotely controllable lights.
+# Copyright (C) 2014  John Eriksson, Arvid Fahlström Myrman, Jonas Höglund,
+#                     Hannes Leskelä, Christian Lidström, Mattias Palo,
+#                     Markus Videll, Tomas Wickman, Emil Öhman.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for `playhouse.Bridge`, run against a `playhouse.SimulatedTransport`.
+
+Run by executing ``python3 -m unittest test_bridge``.
+"""
+
+import types
+import unittest
+
+import tornado.gen
+import tornado.testing
+
+import playhouse
+
+
+class RTTEstimatorTest(unittest.TestCase):
+    def test_should_retry(self):
+        rtt = playhouse.RTTEstimator(initial=2, maximum=10)
+        rtt.timed_out()
+        self.assertFalse(rtt.should_retry())
+
+        rtt.sample(0.1)
+        rtt.timed_out()
+        self.assertTrue(rtt.should_retry())
+        # the bridge didn't answer in between
+        rtt.timed_out()
+        self.assertFalse(rtt.should_retry())
+
+    def test_should_not_retry_near_maximum(self):
+        rtt = playhouse.RTTEstimator(initial=2, maximum=10)
+        rtt.sample(4)
+        rtt.timed_out()
+        self.assertEqual(rtt.timeout, 10)
+        self.assertFalse(rtt.should_retry())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_failed_probes(self):
+        breaker = playhouse.CircuitBreaker(threshold=2)
+        self.assertFalse(breaker.failed())
+        self.assertTrue(breaker.failed())
+        self.assertFalse(breaker.closed)
+        self.assertEqual(breaker.failed_probes, 0)
+
+        breaker.half_open()
+        breaker.failed()
+        self.assertEqual(breaker.failed_probes, 1)
+        self.assertEqual(breaker.retry_delay, 2)
+        breaker.half_open()
+        breaker.succeeded()
+        self.assertTrue(breaker.closed)
+        self.assertEqual(breaker.failed_probes, 1)
+
+
+class BlinkSchedulerTest(tornado.testing.AsyncTestCase):
+    class FakeBridge:
+        serial_number = "simulated"
+
+        def __init__(self, saturated=False):
+            self.blinking_lights = {1}
+            self.queue = types.SimpleNamespace(saturated=saturated)
+            self.blinks = 0
+
+        def blink(self):
+            self.blinks += 1
+
+    def test_refreshes_every_due_bridge(self):
+        scheduler = playhouse.BlinkScheduler(period=15, resolution=0.5)
+        bridges = [self.FakeBridge() for _ in range(40)]
+        saturated = self.FakeBridge(saturated=True)
+        for bridge in bridges + [saturated]:
+            scheduler.add(bridge)
+        # first refreshes are staggered one tick apart
+        due = list(scheduler.bridges.values())
+        self.assertAlmostEqual(due[1] - due[0], 0.5, places=2)
+        self.assertAlmostEqual(due[29] - due[0], 14.5, places=2)
+        self.assertAlmostEqual(due[30], due[0], places=2)
+        try:
+            for bridge in scheduler.bridges:
+                scheduler.bridges[bridge] = 0
+            scheduler._tick()
+            self.assertTrue(all(bridge.blinks == 1 for bridge in bridges))
+            self.assertEqual(saturated.blinks, 0)
+            scheduler._tick()
+            self.assertTrue(all(bridge.blinks == 1 for bridge in bridges))
+        finally:
+            for bridge in bridges + [saturated]:
+                scheduler.remove(bridge)
+
+
+class BridgeTest(tornado.testing.AsyncTestCase):
+    ip = "10.0.0.1"
+    username = "simulateduser"
+
+    def setUp(self):
+        super().setUp()
+        self.bridges = []
+
+    def tearDown(self):
+        for bridge in self.bridges:
+            bridge.deinit()
+        super().tearDown()
+
+    @tornado.gen.coroutine
+    def make_bridge(self, lights=10, transport_options=None, **options):
+        transport = playhouse.SimulatedTransport(self.ip, lights=lights, latency=0.001,
+                                                 **(transport_options or {}))
+        bridge = yield playhouse.Bridge(self.ip, self.username, transport=transport, **options)
+        self.bridges.append(bridge)
+        return bridge
+
+    def sleep(self, seconds):
+        return tornado.gen.Task(self.io_loop.add_timeout, self.io_loop.time() + seconds)
+
+    @tornado.testing.gen_test
+    def test_fire_and_forget_failure_forgets_state(self):
+        bridge = yield self.make_bridge(rate=100, fire_and_forget=True)
+        # overload the bridge only once it has been set up
+        bridge.transport.rate = 5
+        bridge.transport.max_backlog = 0.2
+        lights = range(1, 11)
+        for light in lights:
+            bridge.set_state(light, bri=17 + light)
+        yield self.sleep(1)
+        self.assertGreater(bridge.errors["http"], 0)
+        for light in lights:
+            self.assertIn(bridge.light_data[light].get("bri"), (None, 17 + light))
+
+        # resending the same frame must reach every light the first attempt missed
+        bridge.transport.rate = 100
+        for light in lights:
+            bridge.set_state(light, bri=17 + light)
+        yield self.sleep(0.5)
+        self.assertEqual([bridge.transport.lights[light]["bri"] for light in lights],
+                         [17 + light for light in lights])
+
+    @tornado.testing.gen_test
+    def test_fire_and_forget_api_error_forgets_state(self):
+        bridge = yield self.make_bridge(fire_and_forget=True, validation_sample=1)
+        # switched off behind the bridge's back, so that the change is rejected
+        bridge.transport.lights[3]["on"] = False
+        yield bridge.set_state(3, bri=100)
+        self.assertEqual(bridge.light_data[3]["bri"], 100)
+        yield self.sleep(0.1)
+        self.assertEqual(bridge.errors[201], 1)
+        self.assertNotIn("bri", bridge.light_data[3])
+
+    @tornado.testing.gen_test
+    def test_scene_eviction(self):
+        bridge = yield self.make_bridge(transport_options={"max_scenes": 2}, max_scenes=2)
+        for bri in (10, 20, 30):
+            yield bridge.store_scene("bri{}".format(bri),
+                                     {light: {"bri": bri} for light in (1, 2)})
+        self.assertEqual(len(bridge.transport.scenes), 2)
+        self.assertNotIn("bri10", bridge.scenes)
+
+        yield bridge.recall_scene("bri30")
+        self.assertEqual(bridge.transport.lights[1]["bri"], 30)
+        yield bridge.recall_scene("bri20")
+        self.assertEqual(bridge.transport.lights[2]["bri"], 20)
+        with self.assertRaises(KeyError):
+            bridge.recall_scene("bri10")
+
+    @tornado.testing.gen_test
+    def test_scene_eviction_for_light_states(self):
+        bridge = yield self.make_bridge(max_scenes=10)
+        bridge.scenes.max_lightstates = 4
+        yield bridge.store_scene("a", {1: {"bri": 10}, 2: {"bri": 10}})
+        yield bridge.store_scene("b", {3: {"bri": 20}, 4: {"bri": 20}})
+        yield bridge.store_scene("c", {light: {"bri": 30} for light in (5, 6, 7)})
+        yield self.sleep(0.1)
+        # one of the evicted scenes is overwritten, the other deleted
+        self.assertEqual(len(bridge.transport.scenes), 1)
+        yield bridge.recall_scene("c")
+        self.assertEqual([bridge.transport.lights[light]["bri"] for light in (4, 5, 6, 7)],
+                         [254, 30, 30, 30])
+
+    @tornado.testing.gen_test
+    def test_update_info_invalid_username(self):
+        bridge = yield self.make_bridge(transport_options={"usernames": ["otheruser00"]})
+        self.assertFalse(bridge.logged_in)
+        self.assertIsNone(bridge.mac)
+
+        # the lights and groups aren't synced using an invalid username
+        requests = bridge.transport.requests
+        with self.assertLogs(level="WARNING") as logs:
+            yield bridge.update_info()
+        self.assertFalse(bridge.logged_in)
+        self.assertEqual(bridge.transport.requests, requests + 1)
+        self.assertEqual([record.levelname for record in logs.records], ["WARNING"])
+
+        bridge.transport.usernames.add(self.username)
+        yield bridge.update_info()
+        self.assertTrue(bridge.logged_in)
+        self.assertEqual(bridge.mac, bridge.transport.mac)
+
+    @tornado.testing.gen_test
+    def test_merged_command_keeps_place(self):
+        bridge = yield self.make_bridge()
+        queue = bridge.queue
+        # hold every command in the queue
+        queue.window = 0
+        futures = [bridge.set_state(1, hue=10), bridge.set_state(2, hue=10),
+                   bridge.set_state(1, hue=20)]
+        self.assertEqual([command.light for command in queue.pending.values()], [1, 2])
+
+        # merged behind the group command, which would otherwise override it
+        futures += [bridge.set_group(0, bri=30), bridge.set_state(2, bri=40)]
+        self.assertEqual([command.light for command in queue.pending.values()], [1, None, 2])
+
+        queue.window = 4
+        queue._dispatch()
+        yield futures
+        self.assertEqual([(bridge.transport.lights[light]["hue"],
+                           bridge.transport.lights[light]["bri"]) for light in (1, 2, 3)],
+                         [(20, 30), (10, 40), (0, 30)])
+
+    @tornado.testing.gen_test
+    def test_group_fan_out(self):
+        bridge = yield self.make_bridge()
+        lights = [1, 2, 3]
+        # the first two changes are sent light by light; the second creates a group
+        for bri in (10, 20):
+            yield list(bridge.set_lights({light: {"bri": bri} for light in lights}).values())
+        yield self.sleep(0.1)
+        self.assertEqual([group["lights"] for group in bridge.transport.groups.values()],
+                         [lights])
+
+        requests = bridge.transport.requests
+        futures = bridge.set_lights({light: {"bri": 30} for light in lights})
+        self.assertEqual(len(set(futures.values())), 1)
+        yield list(futures.values())
+        self.assertEqual(bridge.transport.requests, requests + 1)
+        self.assertEqual([bridge.transport.lights[light]["bri"] for light in range(1, 5)],
+                         [30, 30, 30, 254])
+
+        # every light of the bridge is changed through group 0
+        futures = bridge.set_lights({light: {"bri": 40} for light in range(1, 11)})
+        yield list(futures.values())
+        self.assertEqual(bridge.transport.requests, requests + 2)
+
+    @tornado.testing.gen_test
+    def test_group_pool_eviction(self):
+        bridge = yield self.make_bridge(transport_options={"max_groups": 2}, max_groups=2)
+        for lights in ([1, 2, 3], [4, 5, 6], [7, 8, 9]):
+            group = yield bridge.group_pool.prepare(lights)
+            self.assertIsNotNone(group)
+        self.assertEqual(sorted(group["lights"] for group in bridge.transport.groups.values()),
+                         [[4, 5, 6], [7, 8, 9]])
+        self.assertIsNone(bridge.group_pool.groups.get(frozenset([1, 2, 3])))
+
+        # the least recently used group makes room
+        self.assertIsNotNone(bridge.group_pool.find([4, 5, 6]))
+        yield bridge.group_pool.prepare([1, 2, 3])
+        self.assertEqual(sorted(group["lights"] for group in bridge.transport.groups.values()),
+                         [[1, 2, 3], [4, 5, 6]])
+
+
+if __name__ == '__main__':
+    unittest.main()
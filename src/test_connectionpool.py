@@ -0,0 +1,245 @@
+# Playhouse: Making buildings into interactive displays using remotely controllable lights.
+# Copyright (C) 2014  John Eriksson, Arvid Fahlström Myrman, Jonas Höglund,
+#                     Hannes Leskelä, Christian Lidström, Mattias Palo,
+#                     Markus Videll, Tomas Wickman, Emil Öhman.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for `playhouse.ConnectionPool`, run against a local Tornado server.
+
+Run by executing ``python3 -m unittest test_connectionpool``.
+"""
+
+import time
+import unittest
+
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.netutil
+import tornado.tcpserver
+import tornado.testing
+import tornado.web
+
+import playhouse
+
+
+class OkHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("ok")
+
+    def post(self):
+        self.write("created")
+
+
+class ChunkedHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write("first ")
+        self.flush()
+        self.write("second")
+
+
+class NoContentHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_status(204)
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        yield tornado.gen.Task(ioloop.add_timeout, ioloop.time() + 1)
+        self.write("late")
+
+
+class CloseAfterHandler(tornado.web.RequestHandler):
+    """Answers, then closes the connection shortly afterwards, as a bridge closing
+    an idle connection would."""
+    def get(self):
+        self.write("ok")
+        stream = self.request.connection.stream
+        ioloop = tornado.ioloop.IOLoop.current()
+        ioloop.add_timeout(ioloop.time() + 0.05, stream.close)
+
+
+class DropHandler(tornado.web.RequestHandler):
+    """Closes the connection without answering the first request it receives,
+    as if the response had been lost."""
+    def initialize(self, received):
+        self.received = received
+
+    def get(self):
+        self.drop()
+
+    def post(self):
+        self.drop()
+
+    def drop(self):
+        self.received.append(self.request.method)
+        if len(self.received) == 1:
+            self.request.connection.stream.close()
+        else:
+            self.write("ok")
+
+
+class RawServer(tornado.tcpserver.TCPServer):
+    """Answers every request with a fixed sequence of bytes."""
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+    def handle_stream(self, stream, address):
+        stream.read_until(b"\r\n\r\n", lambda _: stream.write(self.response))
+
+
+class ConnectionPoolTest(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pools = []
+        self.servers = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        for server in self.servers:
+            server.stop()
+        super().tearDown()
+
+    def get_app(self):
+        self.received = []
+        return tornado.web.Application([
+            (r"/ok", OkHandler),
+            (r"/chunked", ChunkedHandler),
+            (r"/nocontent", NoContentHandler),
+            (r"/slow", SlowHandler),
+            (r"/closeafter", CloseAfterHandler),
+            (r"/drop", DropHandler, {"received": self.received}),
+        ])
+
+    def make_pool(self, port=None, size=1):
+        pool = playhouse.ConnectionPool("127.0.0.1", port or self.get_http_port(), size)
+        self.pools.append(pool)
+        return pool
+
+    def sleep(self, seconds):
+        return tornado.gen.Task(self.io_loop.add_timeout, self.io_loop.time() + seconds)
+
+    def raw_port(self, response):
+        sock, port = tornado.testing.bind_unused_port()
+        server = RawServer(response)
+        server.add_sockets([sock])
+        self.servers.append(server)
+        return port
+
+    @tornado.testing.gen_test
+    def test_keep_alive(self):
+        pool = self.make_pool()
+        response = yield pool.fetch("GET", "/ok")
+        self.assertEqual((response.code, response.body), (200, b"ok"))
+        conn = pool._idle[0]
+        response = yield pool.fetch("GET", "/ok")
+        self.assertEqual(response.body, b"ok")
+        self.assertIs(pool._idle[0], conn)
+        self.assertEqual(conn.requests, 2)
+
+    @tornado.testing.gen_test
+    def test_idle_connection_closed_by_server(self):
+        pool = self.make_pool()
+        yield pool.fetch("GET", "/closeafter")
+        conn = pool._idle[0]
+        yield self.sleep(0.2)
+        response = yield pool.fetch("POST", "/ok", "")
+        self.assertEqual(response.body, b"created")
+        self.assertIsNot(pool._idle[0], conn)
+
+    @tornado.testing.gen_test
+    def test_dropped_response_resends_get(self):
+        pool = self.make_pool()
+        yield pool.fetch("GET", "/ok")
+        response = yield pool.fetch("GET", "/drop")
+        self.assertEqual(response.body, b"ok")
+        self.assertEqual(self.received, ["GET", "GET"])
+
+    @tornado.testing.gen_test
+    def test_dropped_response_does_not_resend_post(self):
+        pool = self.make_pool()
+        yield pool.fetch("GET", "/ok")
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield pool.fetch("POST", "/drop", "")
+        yield self.sleep(0.1)
+        self.assertEqual(self.received, ["POST"])
+
+    @tornado.testing.gen_test
+    def test_send_does_not_resend_post(self):
+        pool = self.make_pool()
+        yield pool.fetch("GET", "/ok")
+        response = yield pool.send("POST", "/drop", "")
+        with self.assertRaises(tornado.httpclient.HTTPError):
+            yield response
+        self.assertEqual(self.received, ["POST"])
+
+    @tornado.testing.gen_test
+    def test_chunked_body(self):
+        pool = self.make_pool()
+        response = yield pool.fetch("GET", "/chunked")
+        self.assertEqual(response.body, b"first second")
+        response = yield pool.fetch("GET", "/ok")
+        self.assertEqual(response.body, b"ok")
+        self.assertEqual(pool._idle[0].requests, 2)
+
+    @tornado.testing.gen_test
+    def test_chunked_trailers_and_interim_response(self):
+        port = self.raw_port(b"HTTP/1.1 100 Continue\r\n\r\n"
+                             b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                             b"5;ext=1\r\nhello\r\n0\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\n")
+        pool = self.make_pool(port)
+        response = yield pool.fetch("GET", "/", timeout=0.5)
+        self.assertEqual((response.code, response.body), (200, b"hello"))
+        self.assertEqual(len(pool._idle), 1)
+
+    @tornado.testing.gen_test
+    def test_no_content(self):
+        pool = self.make_pool()
+        start = time.time()
+        response = yield pool.fetch("GET", "/nocontent", timeout=0.5)
+        self.assertEqual((response.code, response.body), (204, b""))
+        self.assertLess(time.time() - start, 0.25)
+        response = yield pool.fetch("GET", "/ok")
+        self.assertEqual(pool._idle[0].requests, 2)
+
+    @tornado.testing.gen_test
+    def test_not_modified_without_length(self):
+        port = self.raw_port(b"HTTP/1.1 304 Not Modified\r\nETag: \"1\"\r\n\r\n")
+        pool = self.make_pool(port)
+        with self.assertRaises(tornado.httpclient.HTTPError) as cm:
+            yield pool.fetch("GET", "/", timeout=0.5)
+        self.assertEqual(cm.exception.code, 304)
+        self.assertEqual(len(pool._idle), 1)
+
+    @tornado.testing.gen_test
+    def test_timeout_aborts_connection(self):
+        pool = self.make_pool()
+        yield pool.fetch("GET", "/ok")
+        conn = pool._idle[0]
+        with self.assertRaises(playhouse.RequestTimedOutException):
+            yield pool.fetch("GET", "/slow", timeout=0.2)
+        self.assertTrue(conn.closed())
+        self.assertEqual(pool.connections, 0)
+        response = yield pool.fetch("GET", "/ok")
+        self.assertEqual(response.body, b"ok")
+
+
+if __name__ == '__main__':
+    unittest.main()
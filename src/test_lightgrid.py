@@ -0,0 +1,264 @@
+# Playhouse: Making buildings into interactive displays using remotely controllable lights.
+# Copyright (C) 2014  John Eriksson, Arvid Fahlström Myrman, Jonas Höglund,
+#                     Hannes Leskelä, Christian Lidström, Mattias Palo,
+#                     Markus Videll, Tomas Wickman, Emil Öhman.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for `playhouse.LightGrid`, run against bridges using a
+`playhouse.SimulatedTransport`.
+
+Run by executing ``python3 -m unittest test_lightgrid``.
+"""
+
+import functools
+import random
+import time
+import unittest
+import unittest.mock
+
+import tornado.gen
+import tornado.testing
+
+import playhouse
+
+
+class LightGridTest(tornado.testing.AsyncTestCase):
+    username = "simulateduser"
+
+    def setUp(self):
+        super().setUp()
+        self.grids = []
+
+    def tearDown(self):
+        for grid in self.grids:
+            grid.set_commit_rate(None)
+            for bridge in grid.bridges.values():
+                bridge.deinit()
+        super().tearDown()
+
+    @tornado.gen.coroutine
+    def make_grid(self, width, height, bridges=1, transport_options=None, **options):
+        """Create a buffered grid whose lights are spread evenly over simulated bridges,
+        row by row."""
+        lights = width * height // bridges
+        transport = functools.partial(playhouse.SimulatedTransport, lights=lights, latency=0.001,
+                                      **(transport_options or {}))
+        grid = playhouse.LightGrid(buffered=True, assert_reachable=False,
+                                   bridge_options=dict(options, transport=transport))
+        self.grids.append(grid)
+        macs = []
+        for i in range(bridges):
+            bridge = yield grid.add_bridge("10.0.0.{}".format(i + 1), self.username)
+            macs.append(bridge.serial_number)
+        grid.set_grid([[(macs[(y * width + x) // lights], (y * width + x) % lights + 1)
+                        for x in range(width)] for y in range(height)])
+        return grid
+
+    def light(self, grid, x, y):
+        mac, light = grid.grid[y][x]
+        return grid.bridges[mac].transport.lights[light]
+
+    def sleep(self, seconds):
+        return tornado.gen.Task(self.io_loop.add_timeout, self.io_loop.time() + seconds)
+
+    @unittest.skipIf(playhouse.numpy is None, "NumPy is not available")
+    def test_rgb_to_hsl_array(self):
+        rng = random.Random(0)
+        colours = [(0, 0, 0), (255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255),
+                   (255, 0, 255), (128, 128, 127)]
+        colours += [tuple(rng.randrange(256) for _ in range(3)) for _ in range(5000)]
+        converted = playhouse.rgb_to_hsl_array(playhouse.numpy.array(colours)).tolist()
+        for colour, values in zip(colours, converted):
+            hue, sat = playhouse.rgb_to_hue_sat(*colour)
+            self.assertEqual(values, [hue, sat, playhouse.rgb_to_hsl(*colour)[2]], colour)
+
+    @tornado.gen.coroutine
+    def check_set_frame(self, frame):
+        grid = yield self.make_grid(4, 3)
+        self.assertEqual(len(grid.set_frame(frame)), 12)
+        yield grid.commit()
+        hue, sat = playhouse.rgb_to_hue_sat(10, 20, 30)
+        self.assertEqual((self.light(grid, 3, 2)["hue"], self.light(grid, 3, 2)["sat"]),
+                         (hue, sat))
+
+        # only the changed cells are buffered again
+        frame[1][2] = [200, 0, 0]
+        self.assertEqual(grid.set_frame(frame), [(2, 1)])
+        self.assertEqual(grid.set_frame(frame), [])
+        yield grid.commit()
+        self.assertEqual(self.light(grid, 2, 1)["hue"], 0)
+        self.assertEqual(self.light(grid, 2, 1)["sat"], 255)
+
+        with self.assertRaises(ValueError):
+            grid.set_frame([[[0, 0, 0]] * 4] * 2)
+        with self.assertRaises(ValueError):
+            grid.set_frame([[[0, 0, 256]] * 4] * 3)
+
+    @unittest.skipIf(playhouse.numpy is None, "NumPy is not available")
+    @tornado.testing.gen_test
+    def test_set_frame_numpy(self):
+        yield self.check_set_frame(playhouse.numpy.array([[[10, 20, 30]] * 4] * 3))
+
+    @tornado.testing.gen_test
+    def test_set_frame_python(self):
+        numpy, playhouse.numpy = playhouse.numpy, None
+        try:
+            yield self.check_set_frame([[[10, 20, 30] for _ in range(4)] for _ in range(3)])
+        finally:
+            playhouse.numpy = numpy
+
+    @tornado.testing.gen_test
+    def test_commit_skips_unchanged_cells(self):
+        grid = yield self.make_grid(2, 2)
+        transport = grid.bridges[grid.grid[0][0][0]].transport
+        grid.set_state(0, 0, bri=50)
+        grid.set_state(1, 0, bri=60)
+        self.assertEqual((yield grid.commit()), {})
+        requests = transport.requests
+
+        # buffering the committed state again costs no bridge traffic
+        grid.set_state(0, 0, bri=50)
+        grid.set_state(1, 0, bri=60)
+        self.assertEqual((yield grid.commit()), {})
+        self.assertEqual(transport.requests, requests)
+
+        # a change that may not have reached the light is sent again
+        transport.max_backlog = -1
+        grid.set_state(0, 0, bri=70)
+        exceptions = yield grid.commit()
+        self.assertEqual(list(exceptions), [(0, 0)])
+        transport.max_backlog = 1
+        grid.set_state(0, 0, bri=70)
+        self.assertEqual((yield grid.commit()), {})
+        self.assertEqual(self.light(grid, 0, 0)["bri"], 70)
+
+    @tornado.testing.gen_test
+    def test_commit_compares_at_commit_time(self):
+        grid = yield self.make_grid(2, 2)
+        bridge = grid.bridges[grid.grid[0][0][0]]
+        grid.set_state(0, 0, bri=50)
+        yield grid.commit()
+
+        # buffered while the light was at 50, but changed elsewhere before the commit
+        grid.set_state(0, 0, bri=50)
+        yield bridge.set_state(1, bri=10)
+        yield grid.commit()
+        self.assertEqual(self.light(grid, 0, 0)["bri"], 50)
+
+        # the same, with a change of another light buffered as well, and a sync finding
+        # the light changed by another client
+        grid.set_state(0, 0, bri=50)
+        grid.set_state(1, 0, bri=60)
+        bridge.transport.lights[1]["bri"] = 20
+        yield bridge.sync.sync_lights()
+        self.assertEqual(bridge.light_data[1]["bri"], 20)
+        yield grid.commit()
+        self.assertEqual([self.light(grid, x, 0)["bri"] for x in range(2)], [50, 60])
+
+    @tornado.testing.gen_test
+    def test_bridges_share_grid_blinker(self):
+        grid = yield self.make_grid(2, 2, bridges=2)
+        other = yield self.make_grid(1, 1)
+        bridges = list(grid.bridges.values())
+        self.assertEqual(set(grid.blinker.bridges), set(bridges))
+        self.assertNotIn(bridges[0], other.blinker.bridges)
+
+        # a bridge created on its own moves over to the grid's scheduler
+        transport = playhouse.SimulatedTransport("10.0.0.9", lights=1, latency=0.001)
+        bridge = yield playhouse.Bridge("10.0.0.9", self.username, transport=transport)
+        own = bridge.blinker
+        yield other.add_bridge(bridge)
+        self.assertIs(bridge.blinker, other.blinker)
+        self.assertIn(bridge, other.blinker.bridges)
+        self.assertNotIn(bridge, own.bridges)
+
+    @tornado.testing.gen_test
+    def test_scheduler_beyond_one_revolution(self):
+        grid = yield self.make_grid(2, 2)
+        # a revolution of the wheel takes 0.2 seconds; all three changes share a bucket
+        grid.scheduler = scheduler = playhouse.ChangeScheduler(grid, resolution=0.05, slots=4)
+        scheduler.schedule([(0.1, 0, 0, {"bri": 10}), (0.3, 1, 0, {"bri": 20}),
+                            (0.5, 0, 1, {"bri": 30})])
+        self.assertEqual(scheduler.size, 3)
+        cells = [(0, 0), (1, 0), (0, 1)]
+
+        yield self.sleep(0.2)
+        self.assertEqual([self.light(grid, x, y)["bri"] for x, y in cells], [10, 254, 254])
+        yield self.sleep(0.2)
+        self.assertEqual([self.light(grid, x, y)["bri"] for x, y in cells], [10, 20, 254])
+        yield self.sleep(0.2)
+        self.assertEqual([self.light(grid, x, y)["bri"] for x, y in cells], [10, 20, 30])
+        self.assertEqual((scheduler.size, scheduler.memory), (0, 0))
+        self.assertIsNone(scheduler._origin)
+
+    @tornado.testing.gen_test
+    def test_scheduler_full(self):
+        grid = yield self.make_grid(2, 2)
+        grid.scheduler = scheduler = playhouse.ChangeScheduler(grid, max_changes=2)
+        scheduler.schedule([(0.1, 0, 0, {"bri": 10})])
+        with self.assertRaises(playhouse.ScheduleFullException):
+            scheduler.schedule([(0.1, 1, 0, {"bri": 10}), (0.1, 0, 1, {"bri": 10})])
+        self.assertEqual(scheduler.size, 1)
+        scheduler.clear()
+
+    @tornado.testing.gen_test
+    def test_snapshot_round_trip(self):
+        grid = yield self.make_grid(2, 2)
+        bridge = next(iter(grid.bridges.values()))
+        grid.set_state(0, 0, bri=10, hue=1000, sat=200)
+        grid.set_state(1, 0, on=False)
+        yield grid.commit()
+        yield bridge.set_state(3, xy=[0.4, 0.5])
+        saved = {light: dict(state) for light, state in bridge.light_data.items()}
+        data = grid.snapshot()
+
+        bridge.light_data.clear()
+        bridge.light_data[2]["on"] = True
+        # changed after the snapshot was taken
+        bridge.transport.lights[4]["bri"] = 99
+        self.assertEqual(grid.restore_snapshot(data), len(saved))
+        # attributes with a known state are left alone
+        self.assertTrue(bridge.light_data[2]["on"])
+        for light, state in saved.items():
+            if light != 2:
+                self.assertEqual({key: bridge.light_data[light][key] for key in state}, state)
+
+        # the restored lights are synced in the background soon after
+        yield self.sleep(1)
+        self.assertEqual(len(bridge.sync.unverified), 0)
+        self.assertFalse(bridge.light_data[2]["on"])
+        self.assertEqual(bridge.light_data[4]["bri"], 99)
+
+        with self.assertRaises(ValueError):
+            grid.restore_snapshot(data[:-1])
+        with self.assertRaises(ValueError):
+            grid.restore_snapshot(b"not a snapshot at all")
+
+    @tornado.testing.gen_test
+    def test_stale_snapshot(self):
+        grid = yield self.make_grid(2, 2)
+        bridge = next(iter(grid.bridges.values()))
+        data = grid.snapshot()
+        bridge.light_data.clear()
+        with unittest.mock.patch.object(bridge.sync, "verify") as verify, \
+                unittest.mock.patch("time.time", return_value=time.time() + 120):
+            self.assertEqual(grid.restore_snapshot(data, max_age=60), 0)
+        self.assertEqual(sorted(verify.call_args[0][0]), [1, 2, 3, 4])
+        self.assertEqual(len(bridge.light_data), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()